@@ -0,0 +1,241 @@
+#benchmarks for sf2tools: a deterministic synthetic SoundFont generator and a harness that times the
+#main code paths, writes the timings as JSON and fails when they regress against a saved baseline
+#
+#	python sf2bench.py generate big.sf2 --presets 256 --zones 16 --pcm-mb 2048
+#	python sf2bench.py run big.sf2 --output now.json --baseline before.json --threshold 0.25
+#	python sf2bench.py run --presets 128 --zones 8 --output now.json   (generates a scratch font first)
+
+import struct
+import os
+import sys
+import time
+import json
+import array
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+
+import sf2tools
+
+#generators the synthetic zones draw from, with the range their amounts are picked in
+syntheticGenerators = ((8, 1500, 13500), (17, -500, 500), (29, 0, 1000), (34, -12000, 0), (36, -12000, 2000), (38, -12000, 2000), (48, 0, 400), (51, -12, 12), (52, -99, 99), (54, 0, 1))
+
+def riffchunk(tag, data):
+	#SF2 chunks are padded to an even size
+	if (len(data) % 2): data = data + b'\x00'
+	return tag + struct.pack('<I', len(data)) + data
+
+def makeSyntheticSF2(pathname, presets=128, zones=8, generators=6, samples=256, pcmbytes=64*1024*1024, seed=1, blocksize=1024*1024):
+	#write a valid SF2 of the given scale to pathname; the same arguments always give the same bytes.
+	#Every preset has zones zones, each pointing at an instrument with zones key-split zones of its own, and every
+	#zone carries generators extra generators. pcmbytes of 16 bit PCM is spread over samples samples (pairs of
+	#them linked as left/right) and streamed out in blocks, so multi-GB fonts need no more memory than small ones
+	r = random.Random(seed)
+	instruments = presets
+	if (presets * zones + 1 > 65535 or instruments * zones + 1 > 65535): raise RuntimeError("too many zones: bag indexes are 16 bit")
+	if (presets * zones * (generators + 2) + 1 > 65535 or instruments * zones * (generators + 2) + 1 > 65535): raise RuntimeError("too many generators: generator indexes are 16 bit")
+	if (samples < 1): raise RuntimeError("need at least one sample")
+	frames = max(int(pcmbytes / 2 / samples) - 46, 32) #46 frames of padding follow every sample
+	if ((frames + 46) * 2 * samples > 0xFFFFFFF0): raise RuntimeError("sample data does not fit a RIFF chunk")
+
+	waveform = array.array('h', [int(r.gauss(0, 6000)) for x in range(65536)]) #noise every sample is cut from
+	if (sys.byteorder == 'big'): waveform.byteswap()
+	waveform = waveform.tobytes()
+
+	shdr = bytearray()
+	for x in range(samples):
+		start = x * (frames + 46)
+		link = 0
+		sampletype = 1 #mono
+		if (x % 2 == 0 and x + 1 < samples): link, sampletype = x + 1, 4 #left
+		elif (x % 2 == 1): link, sampletype = x - 1, 2 #right
+		shdr.extend(struct.pack('<20sIIIIIBbHH', ('Sample %d' % (x // 2)).encode(), start, start + frames, start + 8, start + frames - 8, 44100 if (x % 3) else 22050, 36 + (x % 60), r.randint(-20, 20), link, sampletype))
+	shdr.extend(struct.pack('<20sIIIIIBbHH', b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0))
+
+	def zonegenerators(ops, keylo, keyhi):
+		words = [struct.pack('<HBB', 43, keylo, keyhi)]
+		for x in range(generators):
+			operator, lowest, highest = syntheticGenerators[x % len(syntheticGenerators)]
+			words.append(struct.pack('<Hh', operator, r.randint(lowest, highest)))
+		return words + ops
+
+	split = max(int(128 / zones), 1)
+	inst = bytearray(); ibag = bytearray(); igen = bytearray(); imod = bytearray()
+	generatorcount = 0
+	for x in range(instruments):
+		inst.extend(struct.pack('<20sH', ('Instrument %d' % (x // 4)).encode(), int(len(ibag) / 4)))
+		for z in range(zones):
+			ibag.extend(struct.pack('<HH', generatorcount, 0))
+			keylo = min(z * split, 127)
+			words = zonegenerators([struct.pack('<HH', 53, (x * zones + z) % samples)], keylo, min(keylo + split - 1, 127) if (z < zones - 1) else 127)
+			igen.extend(b''.join(words))
+			generatorcount += len(words)
+	inst.extend(struct.pack('<20sH', b'EOI', int(len(ibag) / 4)))
+	ibag.extend(struct.pack('<HH', generatorcount, 0))
+	igen.extend(b'\x00' * 4)
+	imod.extend(b'\x00' * 10)
+
+	phdr = bytearray(); pbag = bytearray(); pgen = bytearray(); pmod = bytearray()
+	generatorcount = 0
+	for x in range(presets):
+		phdr.extend(struct.pack('<20sHHHIII', ('Preset %d' % (x // 4)).encode(), x % 128, x // 128, int(len(pbag) / 4), 0, 0, 0))
+		for z in range(zones):
+			pbag.extend(struct.pack('<HH', generatorcount, 0))
+			keylo = min(z * split, 127)
+			words = zonegenerators([struct.pack('<HH', 41, (x + z) % instruments)], keylo, min(keylo + split - 1, 127) if (z < zones - 1) else 127)
+			pgen.extend(b''.join(words))
+			generatorcount += len(words)
+	phdr.extend(struct.pack('<20sHHHIII', b'EOP', 0, 0, int(len(pbag) / 4), 0, 0, 0))
+	pbag.extend(struct.pack('<HH', generatorcount, 0))
+	pgen.extend(b'\x00' * 4)
+	pmod.extend(b'\x00' * 10)
+
+	info = b'INFO' + riffchunk(b'ifil', struct.pack('<HH', 2, 1)) + riffchunk(b'isng', b'EMU8000\x00') + riffchunk(b'INAM', b'Synthetic benchmark font\x00') + riffchunk(b'ISFT', b'sf2bench\x00')
+	pdta = b'pdta' + b''.join(riffchunk(tag, bytes(data)) for tag, data in ((b'phdr', phdr), (b'pbag', pbag), (b'pmod', pmod), (b'pgen', pgen), (b'inst', inst), (b'ibag', ibag), (b'imod', imod), (b'igen', igen), (b'shdr', shdr)))
+	sampledatasize = (frames + 46) * 2 * samples
+
+	with open(pathname, 'wb') as outfile:
+		outfile.write(b'RIFF' + struct.pack('<I', 4 + (8 + len(info)) + (8 + 12 + sampledatasize) + (8 + len(pdta))) + b'sfbk')
+		outfile.write(riffchunk(b'LIST', info))
+		outfile.write(b'LIST' + struct.pack('<I', 12 + sampledatasize) + b'sdta' + b'smpl' + struct.pack('<I', sampledatasize))
+		padding = b'\x00' * 92
+		for x in range(samples):
+			offset = ((x * 7919) % 32768) * 2 #every sample starts somewhere else in the waveform
+			remaining = frames * 2
+			while (remaining > 0):
+				block = waveform[offset:offset + min(remaining, blocksize)]
+				outfile.write(block)
+				remaining -= len(block)
+				offset = 0
+			outfile.write(padding)
+		outfile.write(riffchunk(b'LIST', pdta))
+	return pathname
+
+def timeit(function, repeat):
+	#best wall time of repeat runs, in seconds; setup work belongs in function's caller
+	best = None
+	for x in range(repeat):
+		started = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - started
+		if (best is None or elapsed < best): best = elapsed
+	return best
+
+def benchmarkSF2(pathname, repeat=3, scratchdir=None, names=2000):
+	#time the main code paths on pathname; returns a JSON-ready dict with one best-of-repeat time per benchmark
+	scratchdir = scratchdir or tempfile.mkdtemp(prefix='sf2bench')
+	timings = {}
+
+	def openarchive(mode):
+		thearchive = sf2tools.SF2Archive()
+		thearchive.open(pathname, load_samples=mode)
+		return thearchive
+
+	for mode in ("eager", "mmap", "lazy"):
+		timings['open.' + mode] = timeit(lambda: openarchive(mode).close(), repeat)
+
+	thearchive = openarchive("lazy")
+	pdtadata = thearchive.presetdatachunk.data
+	def parse():
+		sf2tools.SF2PresetDataChunk(thearchive).parse(pdtadata, objects=False)
+	timings['parse'] = timeit(parse, repeat)
+
+	def link():
+		thechunk = sf2tools.SF2PresetDataChunk(thearchive)
+		thechunk.parse(pdtadata, objects=False)
+		started = time.perf_counter()
+		thechunk.buildobjects()
+		return time.perf_counter() - started
+	timings['link'] = min(link() for x in range(repeat))
+
+	def uniquenames():
+		fresh = openarchive("lazy")
+		for x in range(names):
+			fresh.unusedSampleNameFromBaseName('Sample 1')
+			fresh.unusedInstrumentNameFromBaseName('Instrument 1')
+			fresh.unusedPresetNameFromBaseName('Preset 1')
+	timings['names'] = timeit(uniquenames, repeat) - timings['open.lazy']
+
+	mapped = openarchive("mmap")
+	def readsamples():
+		for x in mapped.presetdatachunk.samples: bytes(x.sampledata)
+	timings['samples.mmap'] = timeit(readsamples, repeat)
+	def readlazy():
+		for x in thearchive.presetdatachunk.samples: thearchive.readsampledata(x.start, x.end)
+	timings['samples.read'] = timeit(readlazy, repeat)
+
+	outpath = os.path.join(scratchdir, 'write.sf2')
+	timings['write.streaming'] = timeit(lambda: thearchive.writeSF2(outpath, streaming=True), repeat)
+	timings['write.dedup'] = timeit(lambda: thearchive.writeSF2(outpath, streaming=True, dedup=True), repeat)
+	timings['serialize.pdta'] = timeit(thearchive.presetdatachunk.serialize, repeat)
+	mapped.close()
+
+	thechunk = thearchive.presetdatachunk
+	return {'font': pathname, 'size': os.path.getsize(pathname), 'repeat': repeat,
+		'presets': len(thechunk.presets), 'instruments': len(thechunk.instruments), 'samples': len(thechunk.samples),
+		'generators': len(thechunk.presetzonegenerators) + len(thechunk.instrumentzonegenerators),
+		'python': platform.python_version(), 'platform': platform.platform(), 'timings': timings}
+
+def compareBenchmarks(results, baseline, threshold=0.25, floor=0.002):
+	#benchmarks that got more than threshold (a fraction) slower than in baseline; times under floor seconds
+	#in both runs are too noisy to judge and are skipped
+	regressions = []
+	for name, before in baseline.get('timings', {}).items():
+		after = results['timings'].get(name)
+		if (after is None or max(before, after) < floor): continue
+		if (after > before * (1 + threshold)):
+			regressions.append({'benchmark': name, 'baseline': before, 'current': after, 'ratio': after / before if before else float('inf')})
+	return regressions
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python sf2bench.py', description='Synthetic SoundFonts and benchmarks for sf2tools')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	generate = subparsers.add_parser('generate', help='write a synthetic font')
+	generate.add_argument('output')
+	run = subparsers.add_parser('run', help='time a font (or a freshly generated one) and compare with a baseline')
+	run.add_argument('font', nargs='?', default=None, help='font to time; without one a synthetic font is generated')
+	run.add_argument('--repeat', type=int, default=3, help='runs per benchmark, the best one counts (default: 3)')
+	run.add_argument('--output', default=None, help='write the JSON results here instead of stdout')
+	run.add_argument('--baseline', default=None, help='JSON results to compare against')
+	run.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown as a fraction (default: 0.25)')
+	for subparser in (generate, run):
+		subparser.add_argument('--presets', type=int, default=128)
+		subparser.add_argument('--zones', type=int, default=8, help='zones per preset and per instrument')
+		subparser.add_argument('--generators', type=int, default=6, help='extra generators per zone')
+		subparser.add_argument('--samples', type=int, default=256)
+		subparser.add_argument('--pcm-mb', type=float, default=64, help='total sample data in MiB')
+		subparser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args(argv)
+
+	scale = {'presets': args.presets, 'zones': args.zones, 'generators': args.generators, 'samples': args.samples, 'pcmbytes': int(args.pcm_mb * 1024 * 1024), 'seed': args.seed}
+	if (args.command == 'generate'):
+		makeSyntheticSF2(args.output, **scale)
+		return 0
+
+	scratchdir = tempfile.mkdtemp(prefix='sf2bench')
+	try:
+		font = args.font
+		if (font is None):
+			font = makeSyntheticSF2(os.path.join(scratchdir, 'synthetic.sf2'), **scale)
+		results = benchmarkSF2(font, args.repeat, scratchdir)
+		if (args.font is None): results['synthetic'] = scale
+		status = 0
+		if (args.baseline is not None):
+			with open(args.baseline) as baselinefile:
+				results['regressions'] = compareBenchmarks(results, json.load(baselinefile), args.threshold)
+			results['threshold'] = args.threshold
+			if (results['regressions']): status = 1
+		if (args.output is not None):
+			with open(args.output, 'w') as outputfile:
+				json.dump(results, outputfile, indent=1)
+		else:
+			json.dump(results, sys.stdout, indent=1)
+			sys.stdout.write('\n')
+		return status
+	finally:
+		shutil.rmtree(scratchdir, ignore_errors=True)
+
+if __name__ == '__main__':
+	sys.exit(main())
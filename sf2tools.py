@@ -3,17 +3,148 @@
 import struct
 import os
 import array
+import mmap
 import sys
+import time
+import json
+import signal
+import hashlib
+import gc
+import sqlite3
+import threading
+import weakref
+import argparse
+import asyncio
+import concurrent.futures
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from operator import attrgetter
 from pathlib import Path
 
+try:
+	import numpy
+except ImportError: #numpy is optional -- only the numpy-backed tables need it
+	numpy = None
+
 generatorEnumerators = ["startAddrsOffset","endAddrsOffset","startloopAddrsOffset","endloopAddrsOffset","startAddrsCoarseOffset","modLfoToPitch","vibLfoToPitch","modEnvToPitch","initialFilterFc","initialFilterQ","modLfoToFilterFc","modEnvToFilterFc","endAddrsCoarseOffset","modLfoToVolume","unused1","chorusEffectsSend","reverbEffectsSend","pan","unused2","unused3","unused4","delayModLFO","freqModLFO","delayVibLFO","freqVibLFO","delayModEnv","attackModEnv","holdModEnv","decayModEnv","sustainModEnv","releaseModEnv","keynumToModEnvHold","keynumToModEnvDecay","delayVolEnv","attackVolEnv","holdVolEnv","decayVolEnv","sustainVolEnv","releaseVolEnv","keynumToVolEnvHold","keynumToVolEnvDecay","instrument","reserved1","keyRange","velRange","startloopAddrsCoarseOffset","keynum","velocity","initialAttenuation","reserved2","endloopAddrsCoarseOffset","coarseTune","fineTune","sampleID","sampleModes","reserved3","scaleTuning","exclusiveClass","overridingRootKey","unused5","endOper"]
 
+#SF2 2.04 default value of every generator, indexed like generatorEnumerators; key/velocity ranges are packed lo | hi << 8
+generatorDefaults = [0,0,0,0,0,0,0,0,13500,0,0,0,0,0,0,0,0,0,0,0,0,-12000,0,-12000,0,-12000,-12000,-12000,-12000,0,-12000,0,0,-12000,-12000,-12000,-12000,0,-12000,0,0,0,0,127 << 8,127 << 8,0,-1,-1,0,0,0,0,0,0,0,0,100,0,-1,0,0]
+
+#generators a preset zone may set; their preset values are added to the instrument's (ranges intersect instead)
+presetAdditiveGenerators = frozenset(range(61)) - frozenset([0,1,2,3,4,12,14,18,19,20,41,42,43,44,45,46,47,49,50,53,54,55,57,58,59,60])
+
+#generators whose 16 bit amount is unsigned rather than signed
+unsignedGenerators = frozenset([41,43,44,53,54])
+
+kernelcopyunsupported = set() #kernel copy calls that failed once and are not retried
+preadlock = threading.Lock() #serializes the seek + read fallback where there is no os.pread
+
+def preadblock(fd, count, offset):
+	#count bytes at offset without moving anyone else's file position, so threads can share fd
+	if (hasattr(os, 'pread')): return os.pread(fd, count, offset)
+	with preadlock:
+		os.lseek(fd, offset, os.SEEK_SET)
+		return os.read(fd, count)
+
+def kernelcopyfilerange(sourcefd, outfd, offset, outpos, count):
+	#returns bytes copied by the kernel, or None when no kernel-side copy is available
+	if (hasattr(os, 'copy_file_range') and 'copy_file_range' not in kernelcopyunsupported):
+		try:
+			return os.copy_file_range(sourcefd, outfd, count, offset, outpos)
+		except OSError:
+			kernelcopyunsupported.add('copy_file_range')
+	if (hasattr(os, 'sendfile') and 'sendfile' not in kernelcopyunsupported):
+		try:
+			os.lseek(outfd, outpos, os.SEEK_SET)
+			return os.sendfile(outfd, sourcefd, offset, count)
+		except OSError:
+			kernelcopyunsupported.add('sendfile')
+	return None
+
+def hashfilerange(sourcefd, offset, length, blocksize=16*1024*1024):
+	#digest of length bytes at offset in sourcefd, read blocksize at a time and zero padded like copyfilerange()
+	digest = hashlib.blake2b(digest_size=20)
+	remaining = length
+	while (remaining > 0):
+		block = preadblock(sourcefd, min(remaining, blocksize), offset)
+		if (len(block) == 0): break
+		digest.update(block)
+		offset += len(block)
+		remaining -= len(block)
+	if (remaining > 0): digest.update(b'\x00' * remaining)
+	return digest.digest()
+
+def wavheader(channels, samplerate, rootnote, loopstart, loopend, datasize):
+	#RIFF/WAVE header of a 16 bit PCM file with a smpl chunk carrying the root note and one forward loop;
+	#loopstart/loopend are frame offsets, loopend exclusive like the SF2 endloop
+	header = bytearray(b'RIFF')
+	header.extend(struct.pack('<I', 4 + 24 + 68 + 8 + datasize))
+	header.extend(b'WAVEfmt ')
+	header.extend(struct.pack('<I', 16)) #chunk length
+	header.extend(struct.pack('<HHIIHH', 1, channels, samplerate, samplerate * channels * 2, channels * 2, 16)) #pcm, 16 bit
+	header.extend(b'smpl')
+	header.extend(struct.pack('<I', 60)) #chunk length
+	header.extend(b'\x00' * 8) #manufacturer, product
+	header.extend(struct.pack('<I', int((1 / samplerate) * 1000000000) if samplerate else 0)) #nanoseconds per sample
+	header.extend(struct.pack('<I', rootnote))
+	header.extend(b'\x00' * 12) #pitch fraction, SMPTE format and offset
+	header.extend(struct.pack('<II', 1, 0)) #1 sample loop follows, no sampler data
+	header.extend(struct.pack('<IIIIII', 1, 0, max(loopstart, 0), max(loopend - 1, 0), 0, 0)) #cue point 1, loop forward, start, last frame
+	header.extend(b'data')
+	header.extend(struct.pack('<I', datasize))
+	return header
+
+def interleave(left, right):
+	#16 bit frames of two mono channels as one stereo stream; the shorter channel is padded with silence
+	left = array.array('h', bytes(left))
+	right = array.array('h', bytes(right))
+	frames = max(len(left), len(right))
+	stereo = array.array('h', bytes(frames * 4))
+	stereo[0:len(left) * 2:2] = left
+	stereo[1:len(right) * 2:2] = right
+	return stereo
+
+def copyfilerange(sourcefd, outfile, offset, length, blocksize=16*1024*1024):
+	#copy length bytes at offset in sourcefd to the current position of outfile, at most blocksize at a time;
+	#a source shorter than its headers claim is zero padded so the chunk sizes already written stay valid
+	outfile.flush()
+	outfd = outfile.fileno()
+	outpos = outfile.tell()
+	remaining = length
+	while (remaining > 0):
+		copied = kernelcopyfilerange(sourcefd, outfd, offset, outpos, min(remaining, blocksize))
+		if (copied is None or copied == 0): break
+		offset += copied
+		outpos += copied
+		remaining -= copied
+	outfile.seek(outpos)
+	while (remaining > 0):
+		block = preadblock(sourcefd, min(remaining, blocksize), offset)
+		if (len(block) == 0): break
+		outfile.write(block)
+		offset += len(block)
+		remaining -= len(block)
+	if (remaining > 0): outfile.write(b'\x00' * remaining)
+
 class SF2Archive(object):
 	data = None
 	size = None #file size minus the first 8 bytes of the RIFF header
 	sampledataoffset = None
 	sampledatalength = None
 	pathname = None
+	loadmode = None
+	
+	samplemap = None     #mmap of the whole file when opened with load_samples="mmap"
+	samplemapview = None #memoryview over samplemap -- samples hand out slices of this
+	samplecache = None   #SF2SampleCache (or shared SF2SamplePool) used when opened with load_samples="lazy"
+	regionindex = None   #SF2RegionIndex, built on first findregions()
+	chunklayout = None   #LIST tag -> (file offset, total size), in file order
+	samplefile = None    #unbuffered read-only file whose descriptor every sample read shares, see descriptor()
+	samplefilelock = None
+	tracer = None #callable(phase, seconds, bytecount, records) told about every phase of open()/writeSF2()/save(),
+	              #e.g. an SF2PhaseStats or a plain function; set it on one archive, or on the class to trace every
+	              #archive (it is called as is, never as a method). None costs a perf_counter() per phase
 	
 	infochunk = None
 	presetdatachunk = None
@@ -24,13 +155,50 @@ class SF2Archive(object):
 		self.sampledataoffset = None
 		self.sampledatalength = None
 		self.pathname = None
+		self.loadmode = None
+		
+		self.samplemap = None
+		self.samplemapview = None
+		self.samplecache = None
+		self.regionindex = None
+		self.chunklayout = None
+		self.samplefile = None
+		self.samplefilelock = threading.Lock()
 			
 		self.infochunk = None
 		self.presetdatachunk = None
 	
-	def open(self, sf2file_name):
+	def trace(self, phase, started, bytecount=0, records=0):
+		#report a phase that began at started (a perf_counter() reading); returns now, where the next phase begins
+		now = time.perf_counter()
+		#looked up without binding: a function set on the class would otherwise be called as a method
+		tracer = self.__dict__.get('tracer')
+		if (tracer is None): tracer = type(self).tracer
+		if (tracer is not None): tracer(phase, now - started, bytecount, records)
+		return now
+	
+	def open(self, sf2file_name, load_samples="eager", cachebytes=64*1024*1024, objects=True, usenumpy=False, samplepool=None):
+		# load_samples: "eager" reads a private copy of every sample while parsing,
+		#               "mmap" maps the file once and hands out zero-copy memoryview slices,
+		#               "lazy" only parses headers; sample bodies are read on first access
+		#                      and kept in an LRU cache holding at most cachebytes
+		# objects=False stops after the columnar decode (presetdatachunk.tables); call buildobjects() later if needed
+		# usenumpy=True backs the tables with numpy structured arrays instead of array.array columns
+		# samplepool: with load_samples="lazy", an SF2SamplePool (e.g. sharedsamplepool()) to hold sample bodies
+		#             under one budget with other archives instead of a private cache of cachebytes
+		if (load_samples not in ("eager", "mmap", "lazy")): raise RuntimeError("unknown load_samples mode: " + str(load_samples))
+		if (samplepool is not None and load_samples != "lazy"): raise RuntimeError("a sample pool needs load_samples=\"lazy\"")
+		started = time.perf_counter()
 		with open(sf2file_name, 'rb') as sf2file:
 			self.pathname = sf2file_name
+			self.loadmode = load_samples
+			if (load_samples == "mmap"):
+				self.samplemap = mmap.mmap(sf2file.fileno(), 0, access=mmap.ACCESS_READ)
+				self.samplemapview = memoryview(self.samplemap)
+			elif (load_samples == "lazy"):
+				if (samplepool is not None): samplepool.register(self)
+				else: self.samplecache = SF2SampleCache(cachebytes)
+			started = self.trace('open.file', started)
 			# read the header
 			self.data = sf2file.read(12)
 			if (self.data[0:4]) != b'RIFF': raise RuntimeError("RIFF header not detected!")
@@ -38,26 +206,457 @@ class SF2Archive(object):
 			if (self.data[8:12]) != b'sfbk': raise RuntimeError("sfbk header not detected!")
 			
 			#now we read chunk-by-chunk
+			self.chunklayout = OrderedDict()
 			for x in range(3):
+				chunkoffset = sf2file.tell()
 				chunkheader = sf2file.read(12)
 				if (chunkheader[0:4]) != b'LIST': raise RuntimeError("LIST header not detected!")
 				chunksize = struct.unpack_from('<I', chunkheader, 4)[0] - 4 #minus 4 for the 'INFO' tag
 				chunktag = chunkheader[8:12]
+				self.chunklayout[chunktag] = (chunkoffset, chunksize + 12) #where each LIST sits, header included
 				if (chunktag == b'INFO'): #SoundFont Info Chunk
 					chunkdata = sf2file.read(chunksize)
 					self.infochunk = SF2InfoChunk()
 					self.infochunk.parse(chunkdata)
+					started = self.trace('open.info', started, 12 + chunksize)
 				elif (chunktag == b'sdta'): #Sample Data Chunk -- we're gonna take notes, but not load the samples into memory
 					if (sf2file.read(4)) != b'smpl': raise RuntimeError("smpl subheader not detected!")
 					self.sampledatalength = struct.unpack_from('<I', sf2file.read(4), 0)[0]
 					self.sampledataoffset = sf2file.tell()
 					sf2file.seek(self.sampledataoffset + self.sampledatalength) #skip past sampledata
+					started = self.trace('open.sdta', started, 20)
 				elif (chunktag == b'pdta'): #Preset Data Chunk
 					chunkdata = sf2file.read(chunksize)
+					started = self.trace('open.pdta', started, 12 + chunksize)
 					self.presetdatachunk = SF2PresetDataChunk(self)
-					self.presetdatachunk.parse(chunkdata)
+					self.presetdatachunk.parse(chunkdata, objects, usenumpy)
+	
+	def scan(self, sf2file_name, firsts=False):
+		#metadata only, for indexing: walks the RIFF skeleton, seeks past the sample data and decodes just the phdr,
+		#inst and shdr sub-chunks -- no zone, generator or sample objects, no sample bytes. firsts=True also decodes
+		#the bag/gen tables to name each preset's first instrument and each instrument's first sample (by index).
+		#Fills in infochunk, chunklayout and the sample data offsets like open() does and returns a plain dict:
+		#{'pathname', 'size', 'mtime', 'info': {field: value}, 'sampledatalength', 'presets': [...], 'instruments': [...], 'samples': [...]}
+		started = time.perf_counter()
+		wanted = [b'phdr', b'inst', b'shdr']
+		if (firsts): wanted.extend((b'pbag', b'pgen', b'ibag', b'igen'))
+		tables = SF2PresetDataTables()
+		with open(sf2file_name, 'rb') as sf2file:
+			self.pathname = sf2file_name
+			stat = os.fstat(sf2file.fileno())
+			self.data = sf2file.read(12)
+			if (self.data[0:4]) != b'RIFF': raise RuntimeError("RIFF header not detected!")
+			if (self.data[8:12]) != b'sfbk': raise RuntimeError("sfbk header not detected!")
+			self.chunklayout = OrderedDict()
+			bytesread = 12
+			for x in range(3):
+				chunkoffset = sf2file.tell()
+				chunkheader = sf2file.read(12)
+				if (chunkheader[0:4]) != b'LIST': raise RuntimeError("LIST header not detected!")
+				chunksize = struct.unpack_from('<I', chunkheader, 4)[0] - 4
+				chunktag = chunkheader[8:12]
+				self.chunklayout[chunktag] = (chunkoffset, chunksize + 12)
+				bytesread += 12
+				if (chunktag == b'INFO'):
+					self.infochunk = SF2InfoChunk()
+					self.infochunk.parse(sf2file.read(chunksize))
+					bytesread += chunksize
+				elif (chunktag == b'sdta'):
+					if (sf2file.read(4)) != b'smpl': raise RuntimeError("smpl subheader not detected!")
+					self.sampledatalength = struct.unpack_from('<I', sf2file.read(4), 0)[0]
+					self.sampledataoffset = sf2file.tell()
+					sf2file.seek(self.sampledataoffset + self.sampledatalength)
+					bytesread += 8
+				elif (chunktag == b'pdta'):
+					#hop from sub-chunk header to sub-chunk header, reading only the ones asked for
+					chunkend = chunkoffset + 12 + chunksize
+					pos = chunkoffset + 12
+					while (pos + 8 <= chunkend):
+						sf2file.seek(pos)
+						subchunkheader = sf2file.read(8)
+						subchunktag = subchunkheader[0:4]
+						subchunksize = struct.unpack_from('<I', subchunkheader, 4)[0]
+						bytesread += 8
+						if (subchunktag in wanted):
+							thistable = SF2Table(subchunktag)
+							thistable.parse(sf2file.read(subchunksize))
+							setattr(tables, subchunktag.decode(), thistable)
+							bytesread += subchunksize
+						pos += 8 + subchunksize
+					sf2file.seek(chunkend)
+		for tag in wanted:
+			if (getattr(tables, tag.decode()) is None): raise RuntimeError(tag.decode() + " sub-chunk not found!")
+
+		#the last phdr/inst record is the EOP/EOI terminator; a trailing EOS sample has no data
+		presetcount = max(tables.phdr.count - 1, 0)
+		instrumentcount = max(tables.inst.count - 1, 0)
+		samplecount = tables.shdr.count
+		if (samplecount and tables.shdr.end[samplecount-1] == 0): samplecount -= 1
+		presetinstruments = [None] * presetcount
+		instrumentsamples = [None] * instrumentcount
+		if (firsts):
+			presetinstruments = scanfirsts(tables.phdr.bagindex, presetcount, tables.pbag, tables.pgen, 41, instrumentcount)
+			instrumentsamples = scanfirsts(tables.inst.bagindex, instrumentcount, tables.ibag, tables.igen, 53, samplecount)
+
+		summary = {'pathname': sf2file_name, 'size': stat.st_size, 'mtime': stat.st_mtime,
+			'info': dict((attribute, getattr(self.infochunk, attribute)) for tag, attribute in infoSubchunkFields),
+			'sampledatalength': self.sampledatalength}
+		names, banks, programs = tables.phdr.name, tables.phdr.bank, tables.phdr.number
+		summary['presets'] = [{'name': names[x], 'bank': banks[x], 'program': programs[x], 'instrument': presetinstruments[x],
+			'sample': None if presetinstruments[x] is None else instrumentsamples[presetinstruments[x]]} for x in range(presetcount)]
+		summary['instruments'] = [{'name': tables.inst.name[x], 'sample': instrumentsamples[x]} for x in range(instrumentcount)]
+		summary['samples'] = [dict(zip(tables.shdr.columnnames, record)) for record in list(tables.shdr.records())[:samplecount]]
+		self.trace('scan', started, bytesread, presetcount + instrumentcount + samplecount)
+		return summary
+
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+	
+	def descriptor(self):
+		#the archive's file, opened once on first use and shared by all threads: every read through it is a
+		#positional preadblock(), so there is no file position to race on and one descriptor serves any number of readers
+		samplefile = self.samplefile
+		if (samplefile is None):
+			with self.samplefilelock:
+				if (self.samplefile is None): self.samplefile = open(self.pathname, 'rb', buffering=0)
+				samplefile = self.samplefile
+		return samplefile.fileno()
+	
+	def close(self):
+		#close the shared descriptor, drop cached sample bodies and the mapping; slices still held outside the archive
+		#keep the mapping alive until they are released. Call it once no reads are in flight -- a later read simply
+		#opens the file again
+		with self.samplefilelock:
+			if (self.samplefile is not None): self.samplefile.close()
+			self.samplefile = None
+		if (self.samplecache is not None): self.samplecache.forget(self) #in a shared pool, frees this archive's share
+		if (self.samplemap is None): return
+		if (self.presetdatachunk is not None):
+			for x in self.presetdatachunk.samples:
+				x.releasesampledata()
+		self.samplemapview.release()
+		self.samplemapview = None
+		try:
+			self.samplemap.close()
+		except BufferError:
+			pass
+		self.samplemap = None
+	
+	def buildregionindex(self):
+		#index every preset now, so later findregions() calls never have to build anything
+		if (self.regionindex is None): self.regionindex = SF2RegionIndex(self.presetdatachunk)
+		self.regionindex.build()
+		return self.regionindex
+	
+	def resolvedregions(self, thepreset):
+		#every region of thepreset with its generators fully resolved (region.generators[operator])
+		if (self.regionindex is None): self.regionindex = SF2RegionIndex(self.presetdatachunk)
+		return self.regionindex.regions(thepreset)
+	
+	def findregions(self, bank, program, key, velocity):
+		#the SF2Regions (preset zone x instrument zone x sample) sounding for this note-on
+		if (self.regionindex is None): self.regionindex = SF2RegionIndex(self.presetdatachunk)
+		return self.regionindex.lookup(bank, program, key, velocity)
+	
+	def pinpreset(self, thepreset, pinned=True):
+		#keep (or with pinned=False stop keeping) every sample thepreset plays resident in the sample cache/pool
+		samples = []
+		for x in self.resolvedregions(thepreset):
+			if (x.sample is not None and x.sample not in samples): samples.append(x.sample)
+		for x in samples:
+			if (x.sf2arch.samplecache is None): continue #eager/mmap samples are resident anyway
+			if (pinned): x.sf2arch.samplecache.pin(x)
+			else: x.sf2arch.samplecache.unpin(x)
+	
+	def dirtysections(self):
+		#what save() would have to write: 'INFO', 'pdta:<tag>' per changed sub-chunk, 'sample:<n>' per imported sample
+		dirty = []
+		if (self.infochunk.isdirty()): dirty.append('INFO')
+		original = self.presetdatachunk.data
+		spans = subchunkspans(original)
+		for tag in pdtaSubchunkOrder:
+			if (tag not in spans): dirty.append('pdta:' + tag.decode())
+			else:
+				pos, size = spans[tag]
+				if (self.presetdatachunk.exportsubchunk(tag, sourceoffsets=True) != original[pos:pos+size]): dirty.append('pdta:' + tag.decode())
+		for x in range(len(self.presetdatachunk.samples)):
+			if (self.presetdatachunk.samples[x].sampledataimported): dirty.append('sample:%d' % x)
+		return dirty
+	
+	def samplepatches(self):
+		#(file offset, bytes) for every imported sample that can be written back over its own range of the smpl chunk,
+		#or None when the sample data has to be laid out again (foreign samples, resized samples, overlapping ranges)
+		patches = []
+		kept = []
+		for x in self.presetdatachunk.samples:
+			if (x.sf2arch is not self): return None
+			if (x.end < x.start or x.end * 2 > self.sampledatalength): return None
+			if (x.sampledataimported):
+				data = x.sampledata
+				if (len(data) != (x.end - x.start) * 2): return None #a resized body no longer fits its slot
+				patches.append((x.start, x.end, data))
+			else: kept.append((x.start, x.end))
+		#a patch may not land on data some other sample still points at
+		patches.sort(key=lambda patch: patch[0])
+		for x in range(1, len(patches)):
+			if (patches[x][0] < patches[x-1][1]): return None
+		for start, end, data in patches:
+			for keptstart, keptend in kept:
+				if (start < keptend and keptstart < end): return None
+		return [(self.sampledataoffset + (start * 2), data) for start, end, data in patches]
+	
+	def save(self, sf2file_name=None):
+		#write the archive back (to its own file by default) rewriting only what changed: unchanged LISTs are
+		#copied verbatim or left alone, same-size sections are patched in place, and a pdta LIST at the end of
+		#the file is rewritten and the file truncated. Only when samples no longer fit the existing smpl chunk
+		#does this fall back to a full streaming writeSF2(). Returns {'mode': ..., 'dirty': [...], 'byteswritten': n}
+		if (sf2file_name is None): sf2file_name = self.pathname
+		started = time.perf_counter()
+		inplace = os.path.exists(sf2file_name) and os.path.samefile(sf2file_name, self.pathname)
+		dirty = self.dirtysections()
+		patches = self.samplepatches()
+		report = {'mode': None, 'dirty': dirty, 'byteswritten': 0}
+		
+		if (patches is None):
+			report['mode'] = 'rewrite'
+			temporary = sf2file_name + '.tmp' if inplace else sf2file_name
+			self.writeSF2(temporary, streaming=True)
+			report['byteswritten'] = os.path.getsize(temporary)
+			if (inplace): self.replacefile(temporary, relocated=True)
+			self.trace('save.rewrite', started, report['byteswritten'])
+			return report
+		
+		newinfo = None
+		if ('INFO' in dirty):
+			newinfo = self.infochunk.export()
+			newinfo = b'LIST' + struct.pack('<I', len(newinfo)) + newinfo
+		newpdta = None
+		pdtadirty = [x[5:].encode() for x in dirty if x.startswith('pdta:')]
+		if (pdtadirty):
+			newpdta = self.presetdatachunk.serialize(sourceoffsets=True)
+			newpdta = b'LIST' + struct.pack('<I', len(newpdta)) + newpdta
+		
+		layout = self.chunklayout
+		filesize = os.path.getsize(self.pathname)
+		infofits = (newinfo is None or len(newinfo) == layout[b'INFO'][1])
+		pdtaatend = (layout[b'pdta'][0] + layout[b'pdta'][1] == filesize)
+		if (inplace and infofits and (newpdta is None or pdtaatend or len(newpdta) == layout[b'pdta'][1])):
+			report['mode'] = 'inplace'
+			with open(self.pathname, 'r+b') as sf2file:
+				if (newinfo is not None):
+					sf2file.seek(layout[b'INFO'][0])
+					sf2file.write(newinfo)
+					report['byteswritten'] += len(newinfo)
+				for offset, data in patches:
+					sf2file.seek(offset)
+					sf2file.write(data)
+					report['byteswritten'] += len(data)
+				if (newpdta is not None):
+					pdtaoffset = layout[b'pdta'][0]
+					if (len(newpdta) == layout[b'pdta'][1]):
+						#same size: only the sub-chunks that changed are written
+						newspans = subchunkspans(memoryview(newpdta)[12:])
+						for tag in pdtadirty:
+							pos, size = newspans[tag]
+							sf2file.seek(pdtaoffset + 12 + pos)
+							sf2file.write(newpdta[12+pos:12+pos+size])
+							report['byteswritten'] += size
+					else:
+						sf2file.seek(pdtaoffset)
+						sf2file.write(newpdta)
+						sf2file.truncate()
+						sf2file.seek(4)
+						sf2file.write(struct.pack('<I', pdtaoffset + len(newpdta) - 8))
+						report['byteswritten'] += len(newpdta) + 4
+			if (newpdta is not None):
+				self.chunklayout[b'pdta'] = (layout[b'pdta'][0], len(newpdta))
+				self.savedsections(newpdta[12:])
+			else: self.savedsections()
+			self.trace('save.inplace', started, report['byteswritten'])
+			return report
+		
+		#new file: unchanged LISTs are copied byte for byte from the source
+		report['mode'] = 'copy'
+		temporary = sf2file_name + '.tmp' if inplace else sf2file_name
+		sourcefd = self.descriptor()
+		with open(temporary, 'wb') as outfile:
+			outfile.write(b'RIFF\x00\x00\x00\x00sfbk')
+			for tag, (offset, size) in layout.items():
+				replacement = {b'INFO': newinfo, b'pdta': newpdta}.get(tag)
+				if (replacement is not None):
+					outfile.write(replacement)
+					report['byteswritten'] += len(replacement)
+					continue
+				chunkstart = outfile.tell()
+				copyfilerange(sourcefd, outfile, offset, size)
+				report['byteswritten'] += size
+				if (tag == b'sdta'):
+					chunkend = outfile.tell()
+					for patchoffset, data in patches:
+						outfile.seek(chunkstart + (patchoffset - offset))
+						outfile.write(data)
+					outfile.seek(chunkend)
+			totalsize = outfile.tell()
+			outfile.seek(4)
+			outfile.write(struct.pack('<I', totalsize - 8))
+		if (inplace): self.replacefile(temporary)
+		self.trace('save.copy', started, report['byteswritten'])
+		return report
+	
+	def savedsections(self, pdtadata=None):
+		#what is on disk now is the new baseline for dirtysections()
+		self.infochunk.original = self.infochunk.fields()
+		if (pdtadata is not None):
+			tables = self.presetdatachunk.tables
+			usenumpy = (tables is not None and tables.phdr is not None and tables.phdr.usenumpy)
+			self.presetdatachunk.data = bytes(pdtadata)
+			self.presetdatachunk.tables = SF2PresetDataTables()
+			self.presetdatachunk.tables.parse(self.presetdatachunk.data, usenumpy)
+			self.presetdatachunk.trackgenerators()
+		for x in self.presetdatachunk.samples: x.sampledataimported = False
+	
+	def replacefile(self, temporary, relocated=False):
+		#swap a freshly written file in for our own and pick up its layout; relocated=True when writeSF2 laid
+		#the samples out again, so every sample now lives at its export offsets in this file
+		remap = (self.samplemap is not None)
+		self.close()
+		os.replace(temporary, self.pathname)
+		self.readlayout()
+		if (relocated):
+			for x in self.presetdatachunk.samples:
+				x.sf2arch = self
+				x.start, x.end, x.startloop, x.endloop = x.exportstart, x.exportend, x.exportstartloop, x.exportendloop
+		with open(self.pathname, 'rb') as sf2file:
+			pdtaoffset, pdtasize = self.chunklayout[b'pdta']
+			sf2file.seek(pdtaoffset + 12)
+			self.savedsections(sf2file.read(pdtasize - 12))
+			if (remap):
+				self.samplemap = mmap.mmap(sf2file.fileno(), 0, access=mmap.ACCESS_READ)
+				self.samplemapview = memoryview(self.samplemap)
+		if (remap):
+			for x in self.presetdatachunk.samples:
+				if (not x.sampledataloaded): x.loadsampledata()
+	
+	def readlayout(self):
+		#re-read just the RIFF skeleton: LIST offsets and where the sample data sits
+		with open(self.pathname, 'rb') as sf2file:
+			sf2file.seek(12)
+			self.chunklayout = OrderedDict()
+			for x in range(3):
+				chunkoffset = sf2file.tell()
+				chunkheader = sf2file.read(12)
+				if (chunkheader[0:4]) != b'LIST': raise RuntimeError("LIST header not detected!")
+				chunksize = struct.unpack_from('<I', chunkheader, 4)[0] - 4
+				self.chunklayout[chunkheader[8:12]] = (chunkoffset, chunksize + 12)
+				if (chunkheader[8:12] == b'sdta'):
+					sf2file.read(4)
+					self.sampledatalength = struct.unpack_from('<I', sf2file.read(4), 0)[0]
+					self.sampledataoffset = sf2file.tell()
+				sf2file.seek(chunkoffset + chunksize + 12)
+	
+	def extractsamples(self, outdir, select=None, stereo=True, workers=None):
+		#write samples to outdir as WAV files ('%05d name.wav', numbered like the sample headers), on a pool of
+		#workers threads; select(sample) picks which samples to write (all of them by default). With stereo=True
+		#a left/right pair (sampletype 4/2 linked to each other) becomes one interleaved stereo file named after
+		#the left sample. Sample bodies come from the mapping when there is one, else from one shared descriptor.
+		#Returns {'files': n, 'stereo': n, 'bytes': n}
+		samples = self.presetdatachunk.samples
+		jobs = []
+		paired = set()
+		for x in range(len(samples)):
+			thesample = samples[x]
+			if (x in paired or (select is not None and not select(thesample))): continue
+			partner = samples[thesample.link] if (stereo and thesample.sampletype in (2, 4) and thesample.link < len(samples)) else None
+			if (partner is not None and partner.link == x and partner.sampletype == 6 - thesample.sampletype):
+				left, right = (thesample, partner) if (thesample.sampletype == 4) else (partner, thesample)
+				paired.add(thesample.link)
+				jobs.append((left, right))
+			else: jobs.append((thesample, None))
+		os.makedirs(outdir, exist_ok=True)
+		sourcefd = None
+		if (self.samplemapview is None and self.pathname is not None): sourcefd = self.descriptor()
+		
+		def body(thesample):
+			if (thesample.sampledataloaded or sourcefd is None or thesample.sf2arch is not self): return thesample.sampledata
+			return preadblock(sourcefd, thesample.sampledatasize(), self.sampledataoffset + (thesample.start * 2))
+		
+		def extract(job):
+			left, right = job
+			pathname = os.path.join(outdir, '%05d %s.wav' % (left.identifier, left.name.strip().replace(os.sep, '_')))
+			if (right is None):
+				data = body(left)
+				channels = 1
+			else:
+				data = memoryview(interleave(body(left), body(right))).cast('B')
+				channels = 2
+			with open(pathname, 'wb') as wavfile:
+				wavfile.write(wavheader(channels, left.samplerate, left.rootnote, left.startloop - left.start, left.endloop - left.start, len(data)))
+				wavfile.write(data)
+				return (channels, wavfile.tell())
+		
+		report = {'files': 0, 'stereo': 0, 'bytes': 0}
+		with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+			for channels, size in pool.map(extract, jobs):
+				report['files'] += 1
+				report['stereo'] += (channels == 2)
+				report['bytes'] += size
+		return report
+	
+	def readsampledata(self, start, end):
+		#start/end are sample-point (16 bit) offsets into the smpl chunk
+		offset = self.sampledataoffset + (start * 2)
+		ckSize = (end - start) * 2 #samples to bytes (16bit)
+		if (self.samplemapview is not None):
+			return self.samplemapview[offset:offset + ckSize]
+		return preadblock(self.descriptor(), ckSize, offset)
 					
-	def writeSF2(self,sf2file_name):
+	def duplicatesamples(self, streaming=False):
+		#for every sample, the index of the first earlier sample with byte-identical data, or None if it is the first;
+		#only samples sharing a length are hashed, and with streaming=True bodies still in their source file are hashed from there
+		samples = self.presetdatachunk.samples
+		bysize = {}
+		for x in range(len(samples)):
+			if (streaming): size = samples[x].sampledatasize()
+			else: size = len(samples[x].sampledata)
+			bysize.setdefault(size, []).append(x)
+		duplicates = [None] * len(samples)
+		for size, candidates in bysize.items():
+			if (len(candidates) < 2): continue
+			firstbydigest = {}
+			for x in candidates:
+				thesample = samples[x]
+				if (streaming and not thesample.sampledataimported):
+					digest = hashfilerange(thesample.sf2arch.descriptor(), thesample.sf2arch.sampledataoffset + (thesample.start * 2), size)
+				else: digest = hashlib.blake2b(thesample.sampledata, digest_size=20).digest()
+				if (digest in firstbydigest): duplicates[x] = firstbydigest[digest]
+				else: firstbydigest[digest] = x
+		return duplicates
+	
+	def writeSF2(self,sf2file_name,streaming=False,dedup=False):
+		# streaming=True sizes the sample chunk from the sample headers and copies every sample that still
+		# lives in its source file straight into the output in bounded blocks, so memory use stays flat
+		# dedup=True stores byte-identical samples once and points all their headers at the shared data (loop
+		# points, root notes etc. stay per header); returns {'duplicates': n, 'bytessaved': n} in that case
+		if (os.path.exists(sf2file_name)):
+			#opening the output truncates it, so nothing may still be read from it: with streaming=True every sample
+			#not imported is copied from its source file, otherwise lazy/mapped samples are read from there
+			sources = {}
+			for x in self.presetdatachunk.samples:
+				if (x.sf2arch not in sources): sources[x.sf2arch] = (x.sf2arch.pathname is not None and os.path.exists(x.sf2arch.pathname)
+					and os.path.samefile(x.sf2arch.pathname, sf2file_name))
+				if (not sources[x.sf2arch]): continue
+				if (x.sampledataimported or (not streaming and x.sampledataprivate())): continue
+				if (streaming): raise RuntimeError("cannot stream samples into their own source file!")
+				raise RuntimeError("cannot write over the file samples are still read from; save() it or write elsewhere")
+		started = time.perf_counter()
+		if (dedup):
+			duplicates = self.duplicatesamples(streaming)
+			started = self.trace('write.dedup', started, 0, len(duplicates) - duplicates.count(None))
+		else: duplicates = [None] * len(self.presetdatachunk.samples)
+		bytessaved = 0
 		with open(sf2file_name, 'wb') as outfile:
 			outfile.write(b'RIFF')
 			outfile.write(b'\x00\x00\x00\x00') #we'll write over this later
@@ -66,11 +665,15 @@ class SF2Archive(object):
 			towrite = self.infochunk.export()
 			outfile.write(struct.pack("<I",len(towrite)))
 			outfile.write(towrite)
+			started = self.trace('write.info', started, 20 + len(towrite))
 			
 			outfile.write(b'LIST')
 			sampledatatotal = 0
-			for x in self.presetdatachunk.samples:
-				sampledatatotal += len(x.sampledata) + 92 #92 BYTES padding between samples
+			for x, duplicateof in zip(self.presetdatachunk.samples, duplicates):
+				if (streaming): samplesize = x.sampledatasize() + 92 #92 BYTES padding between samples
+				else: samplesize = len(x.sampledata) + 92 #92 BYTES padding between samples
+				if (duplicateof is None): sampledatatotal += samplesize
+				else: bytessaved += samplesize
 				
 			outfile.write(struct.pack("<I",sampledatatotal+12))
 			outfile.write(b'sdtasmpl')
@@ -78,89 +681,25 @@ class SF2Archive(object):
 			
 			sampledatastartoffset = outfile.tell()
 			
-			for x in self.presetdatachunk.samples:
-				currentsampleoffset = int((outfile.tell() - sampledatastartoffset) / 2)
+			for x, duplicateof in zip(self.presetdatachunk.samples, duplicates):
+				if (duplicateof is None): currentsampleoffset = int((outfile.tell() - sampledatastartoffset) / 2)
+				else: currentsampleoffset = self.presetdatachunk.samples[duplicateof].exportstart
 				
 				x.exportstart     = currentsampleoffset
 				x.exportend       = currentsampleoffset + (x.end - x.start)
 				x.exportstartloop = currentsampleoffset + (x.startloop - x.start)
 				x.exportendloop   = currentsampleoffset + (x.endloop - x.start)
-				outfile.write(x.sampledata)
+				if (duplicateof is not None): continue #shares the data already written
+				if (streaming and not x.sampledataimported):
+					#straight from the source archive's shared descriptor
+					copyfilerange(x.sf2arch.descriptor(), outfile, x.sf2arch.sampledataoffset + (x.start * 2), x.sampledatasize())
+				else:
+					outfile.write(x.sampledata)
 				outfile.write(b'\x00' * 92)
+			started = self.trace('write.samples', started, 20 + sampledatatotal, duplicates.count(None))
 				
 			outfile.write(b'LIST')
-			towrite = self.presetdatachunk.export()
-			
-			towrite.extend(b'pbag')
-			towrite.extend(struct.pack("<I",(len(self.presetdatachunk.presetzones)+1)*4))
-			for x in self.presetdatachunk.presetzones:
-				towrite.extend(struct.pack("<H",x.generatorIndex))
-				towrite.extend(struct.pack("<H",x.modIndex))
-				
-			#terminator
-			towrite.extend(struct.pack("<H",x.generatorIndex+2))
-			towrite.extend(struct.pack("<H",x.modIndex))
-			
-			towrite.extend(b'pmod')
-			towrite.extend(struct.pack("<I",(len(self.presetdatachunk.presetzonemodulators)*10)))
-			towrite.extend(b'\x00' * 10)
-			
-			towrite.extend(b'pgen')
-			towrite.extend(struct.pack("<I",((len(self.presetdatachunk.presetzonegenerators)+1)*4)))
-			for x in self.presetdatachunk.presetzonegenerators:
-				towrite.extend(struct.pack("<H",x.operator))
-				towrite.extend(struct.pack("<h",x.amount))
-			
-			towrite.extend(b'\x00' * 4)
-			
-			towrite.extend(b'inst')
-			towrite.extend(struct.pack("<I",((len(self.presetdatachunk.instruments)+1)*22)))
-			
-			
-			for x in self.presetdatachunk.instruments:
-				towrite.extend(x.name.strip().ljust(20,'\x00').encode())
-				towrite.extend(struct.pack("<H",x.bagindex))
-			
-			towrite.extend(b'\x00'*20)
-			towrite.extend(struct.pack("<H",x.bagindex + 1))
-			
-			towrite.extend(b'ibag')
-			towrite.extend(struct.pack("<I",((len(self.presetdatachunk.instrumentzones)+1)*4)))
-			for x in self.presetdatachunk.instrumentzones:
-				towrite.extend(struct.pack("<H",x.generatorIndex))
-				towrite.extend(struct.pack("<H",x.modIndex))
-				
-			towrite.extend(struct.pack("<H",x.generatorIndex+11))
-			towrite.extend(struct.pack("<H",x.modIndex))
-			
-			towrite.extend(b'imod')
-			towrite.extend(struct.pack("<I",(len(self.presetdatachunk.instrumentzonemodulators)*10)))
-			towrite.extend(b'\x00' * 10)
-			
-			towrite.extend(b'igen')
-			towrite.extend(struct.pack("<I",((len(self.presetdatachunk.instrumentzonegenerators)+1)*4)))
-			for x in self.presetdatachunk.instrumentzonegenerators:
-				towrite.extend(struct.pack("<H",x.operator))
-				towrite.extend(struct.pack("<h",x.amount))
-				
-			towrite.extend(b'\x00' * 4)
-			
-			towrite.extend(b'shdr')
-			towrite.extend(struct.pack("<I",((len(self.presetdatachunk.samples)+1)*46)))
-			for x in self.presetdatachunk.samples:
-				towrite.extend(x.name.strip().ljust(20,'\x00').encode())
-				towrite.extend(struct.pack("<I",x.exportstart))
-				towrite.extend(struct.pack("<I",x.exportend))
-				towrite.extend(struct.pack("<I",x.exportstartloop))
-				towrite.extend(struct.pack("<I",x.exportendloop))
-				towrite.extend(struct.pack("<I",x.samplerate))
-				towrite.extend(struct.pack( "B",x.rootnote))
-				towrite.extend(struct.pack( "b",x.finetune))
-				towrite.extend(struct.pack("<H",x.link))
-				towrite.extend(struct.pack("<H",x.sampletype))
-			
-			towrite.extend(b'\x00' * 46)
-			
+			towrite = self.presetdatachunk.serialize()
 			
 			outfile.write(struct.pack("<I",len(towrite)))
 			outfile.write(towrite)
@@ -168,9 +707,47 @@ class SF2Archive(object):
 			totalsize = outfile.tell()
 			outfile.seek(4)
 			outfile.write(struct.pack("<I",totalsize-8))
+		self.trace('write.pdta', started, 8 + len(towrite), len(self.presetdatachunk.presets) + len(self.presetdatachunk.instruments) + len(self.presetdatachunk.samples))
+		if (dedup): return {'duplicates': len(duplicates) - duplicates.count(None), 'bytessaved': bytessaved}
 			
 	
 					
+	def segments(self, blockframes=65536, dedup=False):
+		#the whole font as writeSF2(streaming=True) would write it, as SF2Sample.segments()-style pieces: the
+		#export offsets are laid out first so the RIFF sizes and the pdta chunk can be produced up front
+		samples = self.presetdatachunk.samples
+		duplicates = self.duplicatesamples(True) if (dedup) else [None] * len(samples)
+		sampledatatotal = 0
+		for x, duplicateof in zip(samples, duplicates):
+			if (duplicateof is None):
+				currentsampleoffset = int(sampledatatotal / 2)
+				sampledatatotal += x.sampledatasize() + 92 #92 BYTES padding between samples
+			else: currentsampleoffset = samples[duplicateof].exportstart
+			x.exportstart     = currentsampleoffset
+			x.exportend       = currentsampleoffset + (x.end - x.start)
+			x.exportstartloop = currentsampleoffset + (x.startloop - x.start)
+			x.exportendloop   = currentsampleoffset + (x.endloop - x.start)
+		infodata = self.infochunk.export()
+		pdtadata = self.presetdatachunk.serialize()
+		totalsize = 4 + (8 + len(infodata)) + (20 + sampledatatotal) + (8 + len(pdtadata))
+		yield b'RIFF' + struct.pack('<I', totalsize) + b'sfbk'
+		yield b'LIST' + struct.pack('<I', len(infodata)) + bytes(infodata)
+		yield b'LIST' + struct.pack('<I', sampledatatotal + 12) + b'sdtasmpl' + struct.pack('<I', sampledatatotal)
+		for x, duplicateof in zip(samples, duplicates):
+			if (duplicateof is not None): continue
+			for piece in x.segments(blockframes): yield piece
+			yield b'\x00' * 92
+		yield b'LIST' + struct.pack('<I', len(pdtadata)) + bytes(pdtadata)
+	
+	def itersamplebytes(self, frames=65536, dedup=False):
+		#the converted font (what writeSF2() writes) as bytes-like blocks of at most frames sample points each,
+		#e.g. for sending it over a socket without building the file first
+		return readsegments(self.segments(frames, dedup))
+	
+	def aitersamplebytes(self, frames=65536, dedup=False):
+		#async itersamplebytes(); the preparation (pdta serialization, dedup hashing) still runs before the first block
+		return areadsegments(self.segments(frames, dedup))
+	
 	def unusedPresetName(self):
 		trimmedname = self.presetdatachunk.presets[-1].name.strip()
 		if (trimmedname[-1].isnumeric()):
@@ -213,77 +790,77 @@ class SF2Archive(object):
 		else: #just add '1' and go
 			return (trimmedname + '1')
 			
+	#these look at the records as they are now, so renamed and removed records count too; names compare
+	#stripped of their padding
 	def unusedSampleNameFromBaseName(self,basename):
-		trimmedname = basename.strip()
-		newname = trimmedname
-		ctr = 1
-			
-		if (newname[-1].isnumeric() == False):
-			newname = (trimmedname + '1')
-				
-		while self.sampleNameAlreadyExists(newname):
-			while (newname[-1 * ctr:].isnumeric()):
-				ctr += 1
-					
-			ctr -= 1
-			identifier = int(newname[-1 * ctr:]) + 1
-			newname = (newname[:-1 * ctr] + str(identifier))
-				
-		return newname
+		return SF2NameRegistry(x.name for x in self.presetdatachunk.samples).unusedname(basename)
 		
 	def unusedInstrumentNameFromBaseName(self,basename):
-			trimmedname = basename.strip()
-			newname = trimmedname
-			ctr = 1
-				
-			if (newname[-1].isnumeric() == False):
-				newname = (trimmedname + '1')
-					
-			while self.instrumentNameAlreadyExists(newname):
-				while (newname[-1 * ctr:].isnumeric()):
-					ctr += 1
-						
-				ctr -= 1
-				identifier = int(newname[-1 * ctr:]) + 1
-				newname = (newname[:-1 * ctr] + str(identifier))
-					
-			return newname
+		return SF2NameRegistry(x.name for x in self.presetdatachunk.instruments).unusedname(basename)
 			
 	def unusedPresetNameFromBaseName(self,basename):
-				trimmedname = basename.strip()
-				newname = trimmedname
-				ctr = 1
-					
-				if (newname[-1].isnumeric() == False):
-					newname = (trimmedname + '1')
-						
-				while self.presetNameAlreadyExists(newname):
-					while (newname[-1 * ctr:].isnumeric()):
-						ctr += 1
-							
-					ctr -= 1
-					identifier = int(newname[-1 * ctr:]) + 1
-					newname = (newname[:-1 * ctr] + str(identifier))
-						
-				return newname
+		return SF2NameRegistry(x.name for x in self.presetdatachunk.presets).unusedname(basename)
 		
 	def sampleNameAlreadyExists(self,samplename):
-		for x in self.presetdatachunk.samples:
-			if (x.name == samplename):
-				return True
-		return False
+		samplename = samplename.strip()
+		return any(x.name.strip() == samplename for x in self.presetdatachunk.samples)
 		
 	def instrumentNameAlreadyExists(self,instrumentname):
-			for x in self.presetdatachunk.instruments:
-				if (x.name == instrumentname):
-					return True
-			return False
+		instrumentname = instrumentname.strip()
+		return any(x.name.strip() == instrumentname for x in self.presetdatachunk.instruments)
 	
 	def presetNameAlreadyExists(self,presetname):
-				for x in self.presetdatachunk.presets:
-					if (x.name == presetname):
-						return True
-				return False
+		presetname = presetname.strip()
+		return any(x.name.strip() == presetname for x in self.presetdatachunk.presets)
+
+class SF2NameRegistry(object):
+	#the names in use for one kind of record, with a counter per base name, so finding an unused numbered
+	#name is a couple of set lookups instead of a scan over every record for every candidate suffix
+	names = None
+	counters = None
+	
+	def __init__(self, names=()):
+		self.names = set(x.strip() for x in names)
+		self.counters = {}
+	
+	def __contains__(self, name):
+		return (name.strip() in self.names)
+	
+	def __len__(self):
+		return len(self.names)
+	
+	def add(self, name):
+		self.names.add(name.strip())
+	
+	def unusedname(self, basename):
+		#numbered like the original helpers: a name ending in digits is used as is when free, otherwise its trailing
+		#number counts up ('Piano' -> 'Piano1', 'Piano1' -> 'Piano2'); longer names lose characters from the base,
+		#not the number, so they stay unique within 20 bytes. The returned name is reserved
+		trimmedname = basename.strip()
+		stem = trimmedname.rstrip('0123456789')
+		if (stem == trimmedname):
+			number = 1
+			newname = numberedname(stem, number)
+		else:
+			number = int(trimmedname[len(stem):])
+			newname = trimmedname
+		if (newname in self.names):
+			number = max(number, self.counters.get(stem, 0)) + 1
+			newname = numberedname(stem, number)
+			while (newname in self.names):
+				number += 1
+				newname = numberedname(stem, number)
+		self.counters[stem] = max(number, self.counters.get(stem, 0))
+		self.names.add(newname)
+		return newname
+
+def numberedname(stem, number):
+	suffix = str(number)
+	return stem[:20 - len(suffix)] + suffix
+
+#INFO sub-chunks in the order the SF2 spec lists them, with the SF2InfoChunk attribute each one maps to
+infoSubchunkFields = ((b'ifil', 'version'), (b'isng', 'soundengine'), (b'INAM', 'name'), (b'irom', 'romname'), (b'iver', 'romversion'),
+	(b'ICRD', 'date'), (b'IENG', 'engineers'), (b'IPRD', 'product'), (b'ICOP', 'copyright'), (b'ICMT', 'comments'), (b'ISFT', 'tool'))
 
 class SF2InfoChunk(object):
 	data = None
@@ -301,6 +878,8 @@ class SF2InfoChunk(object):
 	comments    = None #ICMT
 	tool        = None #ISFT
 	
+	original = None #field values as parsed, to tell whether the chunk needs rewriting
+	
 	def parse(self, theData):
 		self.data = theData
 		self.size = len(theData)
@@ -324,34 +903,32 @@ class SF2InfoChunk(object):
 			if (subchunktag == b'ICMT'): self.comments    = subchunkdata.decode('utf-8')
 			if (subchunktag == b'ISFT'): self.tool        = subchunkdata.decode('utf-8')
 			pos += (8 + subchunksize)
+		self.original = self.fields()
 			
 	def export(self):
 		toexport = bytearray(b'INFO')
-		if (self.version is not None):
-			toexport.extend(b'ifil')
-			toexport.extend(struct.pack('<I', 4))
-			major = self.version.split('.')[0]
-			minor = self.version.split('.')[1]
-			toexport.extend(struct.pack('<H', int(major)))
-			toexport.extend(struct.pack('<H', int(minor)))
-		if (self.soundengine is not None):
-			toexport.extend(b'isng')
-			toexport.extend(struct.pack('<I', len(self.soundengine)))
-			toexport.extend(self.soundengine.encode())
-		if (self.name is not None):
-			toexport.extend(b'INAM')
-			toexport.extend(struct.pack('<I', len(self.name)))
-			toexport.extend(self.name.encode())
-		if (self.date is not None):
-			toexport.extend(b'ICRD')
-			toexport.extend(struct.pack('<I', len(self.date)))
-			toexport.extend(self.date.encode())
-		if (self.tool is not None):
-			toexport.extend(b'ISFT')
-			toexport.extend(struct.pack('<I', len(self.tool)))
-			toexport.extend(self.tool.encode())
+		for tag, attribute in infoSubchunkFields:
+			value = getattr(self, attribute)
+			if (value is None): continue
+			toexport.extend(tag)
+			if (tag in (b'ifil', b'iver')): #version numbers are two WORDs, major and minor
+				toexport.extend(struct.pack('<I', 4))
+				major = value.split('.')[0]
+				minor = value.split('.')[1]
+				toexport.extend(struct.pack('<H', int(major)))
+				toexport.extend(struct.pack('<H', int(minor)))
+			else:
+				toexport.extend(struct.pack('<I', len(value)))
+				toexport.extend(value.encode())
 		return toexport
 	
+	def fields(self):
+		return tuple(getattr(self, attribute) for tag, attribute in infoSubchunkFields)
+	
+	def isdirty(self):
+		#True once any field differs from what parse() read
+		return (self.original is None or self.fields() != self.original)
+	
 class SF2PresetDataChunk(object):
 	
 	sf2arch = None
@@ -377,8 +954,14 @@ class SF2PresetDataChunk(object):
 	instrumentzonemodulators = None
 	samples = None
 	
+	tables = None #SF2PresetDataTables -- columnar decode of every sub-chunk
+	editlisteners = None #callables told about every preset/instrument that reports an edit
+	storedgenerators = None #pgen/igen tag -> (generator list, offset of its records in data), see trackgenerators()
+	storedgeneratorsowned = None #ownedgenerators() result for storedgenerators, None until first asked
+	
 	def __init__(self,thearchive):
 		self.sf2arch = thearchive
+		self.editlisteners = []
 		self.presets = []
 		self.presetzones = []
 		self.presetzonegenerators = []
@@ -389,81 +972,94 @@ class SF2PresetDataChunk(object):
 		self.instrumentzonemodulators = []
 		self.samples = []
 	
-	def parse(self, theData):
+	def parse(self, theData, objects=True, usenumpy=False):
 		self.data = theData
 		self.size = len(theData)
-		pos = 0
+		
+		#decode every sub-chunk in one bulk pass; the object model is a view built on top of the tables
+		started = time.perf_counter()
+		self.tables = SF2PresetDataTables()
+		self.tables.parse(theData, usenumpy)
+		self.sf2arch.trace('parse.tables', started, len(theData), sum(x.count for x in self.tables.tables()))
+		if (objects): self.buildobjects()
 	
-		while (pos < len(self.data)):
-			subchunktag = self.data[pos:pos+4]
-			subchunksize = struct.unpack_from('<I', self.data[pos+4:pos+8], 0)[0]
-			subchunkdata = self.data[pos+8:pos+8+subchunksize]
-			if (subchunktag == b'phdr'): #preset listing
-				self.presetcount = int(subchunksize / 38) #each preset header is 38 bytes wide
-				for x in range(self.presetcount):
-					thispreset = SF2Preset() #create a new preset
-					thispreset.parseheader(subchunkdata[x * 38: (x+1) * 38])
-					self.presets.append(thispreset)
-			elif (subchunktag == b'pbag'): #preset zones
-				self.presetzonecount = int(subchunksize / 4) #each preset zone is 4 bytes wide
-				for x in range(self.presetzonecount):
-					thispresetzone = SF2PresetZone() #create a new preset zone
-					thispresetzone.parse(subchunkdata[x * 4: (x+1) * 4])
-					self.presetzones.append(thispresetzone)
-			elif (subchunktag == b'pmod'): #preset zone modulators
-				self.presetzonemodulatorcount = int(subchunksize / 10) #each preset zone modulator is 10 bytes wide
-				for x in range(self.presetzonemodulatorcount):
-					thispresetzonemodulator = SF2PresetZoneModulator() #create a new preset zone generator
-					thispresetzonemodulator.parse(subchunkdata[x * 10: (x+1) * 10])
-					self.presetzonemodulators.append(thispresetzonemodulator)
-			elif (subchunktag == b'pgen'): #preset zone generators
-				self.presetzonegeneratorcount = int(subchunksize / 4) #each preset zone is 4 bytes wide
-				for x in range(self.presetzonegeneratorcount):
-					thispresetzonegenerator = SF2PresetZoneGenerator() #create a new preset zone generator
-					thispresetzonegenerator.parse(subchunkdata[x * 4: (x+1) * 4])
-					self.presetzonegenerators.append(thispresetzonegenerator)
-			elif (subchunktag == b'inst'): #instruments
-				self.instrumentcount = int(subchunksize / 22) #each instrument is 22 bytes wide
-				for x in range(self.instrumentcount):
-					thisinstrument = SF2Instrument() #create a new instrument
-					thisinstrument.parse(subchunkdata[x * 22: (x+1) * 22])
-					self.instruments.append(thisinstrument)
-			elif (subchunktag == b'ibag'): #instrument zones
-				self.instrumentzonecount = int(subchunksize / 4) #each instrument zone is 4 bytes wide
-				for x in range(self.instrumentzonecount):
-					thisinstrumentzone = SF2InstrumentZone() #create a new instrument zone
-					thisinstrumentzone.parse(subchunkdata[x * 4: (x+1) * 4])
-					self.instrumentzones.append(thisinstrumentzone)
-			elif (subchunktag == b'imod'): #instrument zone modulators
-				self.instrumentzonemodulatorcount = int(subchunksize / 10) #each instrument zone modulator is 10 bytes wide
-				for x in range(self.instrumentzonemodulatorcount):
-					thisinstrumentzonemodulator = SF2InstrumentZoneModulator() #create a new preset zone generator
-					thisinstrumentzonemodulator.parse(subchunkdata[x * 10: (x+1) * 10])
-					self.instrumentzonemodulators.append(thisinstrumentzonemodulator)
-			elif (subchunktag == b'igen'): #instrument zone generators
-				self.instrumentzonegeneratorcount = int(subchunksize / 4) #each preset zone is 4 bytes wide
-				for x in range(self.instrumentzonegeneratorcount):
-					thisinstrumentzonegenerator = SF2InstrumentZoneGenerator() #create a new preset zone generator
-					thisinstrumentzonegenerator.parse(subchunkdata[x * 4: (x+1) * 4])
-					self.instrumentzonegenerators.append(thisinstrumentzonegenerator)
-			elif (subchunktag == b'shdr'): #sample listing
-				presetcount = int(subchunksize / 46) #each preset header is 46 bytes wide
-				for x in range(presetcount):
-					thissample = SF2Sample(self.sf2arch) #create a new sample
-					thissample.parseheader(subchunkdata[x * 46: (x+1) * 46])
-					thissample.loadsampledata()
-					self.samples.append(thissample)
-			else:
-				print (subchunktag)
-						
-			pos += (8 + subchunksize)
+	def buildobjects(self):
+		#hundreds of thousands of records are created here and none of them are garbage yet, so the cyclic
+		#collector is held off until they are all linked
+		gcenabled = gc.isenabled()
+		gc.disable()
+		try:
+			self.createobjects()
+		finally:
+			if (gcenabled): gc.enable()
+	
+	def createobjects(self):
+		tables = self.tables
+		thearchive = self.sf2arch
+		started = time.perf_counter()
+		if (tables.phdr is not None): #preset listing
+			self.presetcount = tables.phdr.count
+			for record, rawname in zip(tables.phdr.records(), tables.phdr.rawnames):
+				thispreset = SF2Preset() #create a new preset
+				thispreset.parserecord(record, rawname)
+				self.presets.append(thispreset)
+		if (tables.pbag is not None): #preset zones
+			self.presetzonecount = tables.pbag.count
+			for record in tables.pbag.records():
+				thispresetzone = SF2PresetZone() #create a new preset zone
+				thispresetzone.parserecord(record)
+				self.presetzones.append(thispresetzone)
+		if (tables.pmod is not None): #preset zone modulators
+			self.presetzonemodulatorcount = tables.pmod.count
+			for record in tables.pmod.records():
+				thispresetzonemodulator = SF2PresetZoneModulator() #create a new preset zone modulator
+				thispresetzonemodulator.parserecord(record)
+				self.presetzonemodulators.append(thispresetzonemodulator)
+		if (tables.pgen is not None): #preset zone generators
+			self.presetzonegeneratorcount = tables.pgen.count
+			self.presetzonegenerators.extend([SF2PresetZoneGenerator(operator, amount) for operator, amount in tables.pgen.records()]) #the bulk of the records: built in one pass
+		if (tables.inst is not None): #instruments
+			self.instrumentcount = tables.inst.count
+			for record, rawname in zip(tables.inst.records(), tables.inst.rawnames):
+				thisinstrument = SF2Instrument() #create a new instrument
+				thisinstrument.parserecord(record, rawname)
+				self.instruments.append(thisinstrument)
+		if (tables.ibag is not None): #instrument zones
+			self.instrumentzonecount = tables.ibag.count
+			for record in tables.ibag.records():
+				thisinstrumentzone = SF2InstrumentZone() #create a new instrument zone
+				thisinstrumentzone.parserecord(record)
+				self.instrumentzones.append(thisinstrumentzone)
+		if (tables.imod is not None): #instrument zone modulators
+			self.instrumentzonemodulatorcount = tables.imod.count
+			for record in tables.imod.records():
+				thisinstrumentzonemodulator = SF2InstrumentZoneModulator() #create a new instrument zone modulator
+				thisinstrumentzonemodulator.parserecord(record)
+				self.instrumentzonemodulators.append(thisinstrumentzonemodulator)
+		if (tables.igen is not None): #instrument zone generators
+			self.instrumentzonegeneratorcount = tables.igen.count
+			self.instrumentzonegenerators.extend([SF2InstrumentZoneGenerator(operator, amount) for operator, amount in tables.igen.records()]) #the bulk of the records: built in one pass
+		if (tables.shdr is not None): #sample listing
+			for record, rawname in zip(tables.shdr.records(), tables.shdr.rawnames):
+				thissample = SF2Sample(self.sf2arch) #create a new sample
+				thissample.parserecord(record, rawname)
+				self.samples.append(thissample)
+		started = thearchive.trace('parse.records', started, 0, len(self.presets) + len(self.presetzones) + len(self.presetzonemodulators) + len(self.presetzonegenerators)
+			+ len(self.instruments) + len(self.instrumentzones) + len(self.instrumentzonemodulators) + len(self.instrumentzonegenerators) + len(self.samples))
+		if (thearchive.loadmode != "lazy"):
+			loaded = 0
+			for thissample in self.samples:
+				thissample.loadsampledata()
+				loaded += len(thissample.sampledata)
+			started = thearchive.trace('parse.samples', started, loaded, len(self.samples))
 		
 		for x in range(1,len(self.presets)):
 			self.presets[x-1].hizonenumber = self.presets[x].lowzonenumber - 1
 		
 		for thispreset in self.presets:
-			for x in range(thispreset.lowzonenumber,thispreset.hizonenumber+1):
-				thispreset.zones.append(self.presetzones[x])
+			thispreset.owner = self
+			thispreset.zones = self.presetzones[thispreset.lowzonenumber:thispreset.hizonenumber+1]
+			for thiszone in thispreset.zones: thiszone.owner = thispreset
 		
 		for x in range(1,len(self.presets)):
 			self.presets[x-1].zones[-1].higeneratornumber = self.presets[x].zones[0].lowgeneratornumber - 1
@@ -474,15 +1070,16 @@ class SF2PresetDataChunk(object):
 		
 		for thispreset in self.presets:
 			for thiszone in thispreset.zones:
-				for x in range(thiszone.lowgeneratornumber,thiszone.higeneratornumber+1):
-					thiszone.generators.append(self.presetzonegenerators[x])
+				thiszone.generators = self.presetzonegenerators[thiszone.lowgeneratornumber:thiszone.higeneratornumber+1]
+				for thisgenerator in thiszone.generators: thisgenerator.owner = thiszone
 
 		for x in range(1,len(self.instruments)):
 			self.instruments[x-1].hizonenumber = self.instruments[x].lowzonenumber - 1
 			
 		for thisinstrument in self.instruments:
-			for x in range(thisinstrument.lowzonenumber,thisinstrument.hizonenumber+1):
-				thisinstrument.zones.append(self.instrumentzones[x])
+			thisinstrument.owner = self
+			thisinstrument.zones = self.instrumentzones[thisinstrument.lowzonenumber:thisinstrument.hizonenumber+1]
+			for thiszone in thisinstrument.zones: thiszone.owner = thisinstrument
 				
 		for x in range(1,len(self.instruments)):
 			self.instruments[x-1].zones[-1].higeneratornumber = self.instruments[x].zones[0].lowgeneratornumber - 1
@@ -493,34 +1090,26 @@ class SF2PresetDataChunk(object):
 				
 		for thisinstrument in self.instruments:
 			for thiszone in thisinstrument.zones:
-				for x in range(thiszone.lowgeneratornumber,thiszone.higeneratornumber+1):
-					thiszone.generators.append(self.instrumentzonegenerators[x])
+				thiszone.generators = self.instrumentzonegenerators[thiszone.lowgeneratornumber:thiszone.higeneratornumber+1]
+				for thisgenerator in thiszone.generators: thisgenerator.owner = thiszone
+		
+		#the terminal bag's modIndex closes the last real zone's modulator range
+		for x in range(len(self.presetzones) - 1):
+			self.presetzones[x].modulators = self.presetzonemodulators[self.presetzones[x].modIndex:self.presetzones[x+1].modIndex]
+		for x in range(len(self.instrumentzones) - 1):
+			self.instrumentzones[x].modulators = self.instrumentzonemodulators[self.instrumentzones[x].modIndex:self.instrumentzones[x+1].modIndex]
 		
 		for x in range(len(self.presets)): self.presets[x].identifier = x
 		for x in range(len(self.instruments)): self.instruments[x].identifier = x
 		for x in range(len(self.samples)): self.samples[x].identifier = x
 		
-		for thisinstrument in self.instruments:
-			for thisinstrumentzone in thisinstrument.zones:
-				for thisinstrumentzonegenerator in thisinstrumentzone.generators:
-					if (thisinstrumentzonegenerator.operator == 53):
-						thisinstrument.firstsample = self.samples[thisinstrumentzonegenerator.amount]
-						break
-				if (thisinstrument.firstsample is not None): break
-		
-		for thispreset in self.presets:
-			for thispresetzone in thispreset.zones:
-				for thispresetzonegenerator in thispresetzone.generators:
-					if (thispresetzonegenerator.operator == 41):
-						thispreset.firstinstrument = self.instruments[thispresetzonegenerator.amount]
-						thispreset.firstsample = thispreset.firstinstrument.firstsample
-						thispreset.firstsample.firstinstrument = thispreset.firstinstrument
-						thispreset.firstsample.firstpreset = thispreset
-						break
-				if (thispreset.firstinstrument is not None): break
+		self.linkfirstrecords()
+		started = thearchive.trace('parse.link', started, 0, len(self.presetzones) + len(self.presetzonegenerators) + len(self.instrumentzones) + len(self.instrumentzonegenerators))
 		
 		#wipe out terminators
 		if (self.presets[-1].firstinstrument is None):
+			if (len(self.presetzones) > self.presets[-1].bagindex): #the terminal bag counts the real modulators
+				del(self.presetzonemodulators[self.presetzones[self.presets[-1].bagindex].modIndex:])
 			while (len(self.presetzones) > self.presets[-1].bagindex):
 				while len(self.presetzonegenerators) > self.presetzones[-1].generatorIndex:
 					del(self.presetzonegenerators[-1])
@@ -528,117 +1117,465 @@ class SF2PresetDataChunk(object):
 			del(self.presets[-1])
 			
 		if (self.instruments[-1].firstsample is None): 
+			if (len(self.instrumentzones) > self.instruments[-1].bagindex):
+				del(self.instrumentzonemodulators[self.instrumentzones[self.instruments[-1].bagindex].modIndex:])
 			while (len(self.instrumentzones) > self.instruments[-1].bagindex):
 				while len(self.instrumentzonegenerators) > self.instrumentzones[-1].generatorIndex:
 					del(self.instrumentzonegenerators[-1])
 				del(self.instrumentzones[-1])
 			del(self.instruments[-1])
 		if (self.samples[-1].end == 0): del(self.samples[-1])
+		self.trackgenerators()
+		thearchive.trace('parse.terminators', started)
 		
 		
+	def linkfirstrecords(self):
+		#each instrument's first sample and each preset's first instrument/sample
+		for thisinstrument in self.instruments:
+			for thisinstrumentzone in thisinstrument.zones:
+				for thisinstrumentzonegenerator in thisinstrumentzone.generators:
+					if (thisinstrumentzonegenerator.operator == 53):
+						thisinstrument.firstsample = self.samples[thisinstrumentzonegenerator.amount]
+						break
+				if (thisinstrument.firstsample is not None): break
+		
+		for thispreset in self.presets:
+			for thispresetzone in thispreset.zones:
+				for thispresetzonegenerator in thispresetzone.generators:
+					if (thispresetzonegenerator.operator == 41):
+						thispreset.firstinstrument = self.instruments[thispresetzonegenerator.amount]
+						thispreset.firstsample = thispreset.firstinstrument.firstsample
+						if (thispreset.firstsample is not None):
+							thispreset.firstsample.firstinstrument = thispreset.firstinstrument
+							thispreset.firstsample.firstpreset = thispreset
+						break
+				if (thispreset.firstinstrument is not None): break
+	
+	def reindex(self):
+		#rebuild the flat zone/generator/modulator lists and every index the writer packs (bag, generator and
+		#modulator indexes, identifiers) from the preset/instrument -> zone -> generator hierarchy, e.g. after
+		#adding, removing or reordering records by hand; instrument and sampleID generator amounts are left as they are
+		self.presetzones = []
+		self.presetzonegenerators = []
+		self.presetzonemodulators = []
+		for thispreset in self.presets:
+			thispreset.owner = self
+			thispreset.bagindex = thispreset.lowzonenumber = len(self.presetzones)
+			thispreset.hizonenumber = thispreset.bagindex + len(thispreset.zones) - 1
+			thispreset.firstinstrument = thispreset.firstsample = None
+			for thiszone in thispreset.zones:
+				thiszone.owner = thispreset
+				thiszone.generatorIndex = thiszone.lowgeneratornumber = len(self.presetzonegenerators)
+				thiszone.higeneratornumber = thiszone.generatorIndex + len(thiszone.generators) - 1
+				thiszone.modIndex = len(self.presetzonemodulators)
+				for thisgenerator in thiszone.generators: thisgenerator.owner = thiszone
+				self.presetzones.append(thiszone)
+				self.presetzonegenerators.extend(thiszone.generators)
+				self.presetzonemodulators.extend(thiszone.modulators)
+		self.instrumentzones = []
+		self.instrumentzonegenerators = []
+		self.instrumentzonemodulators = []
+		for thisinstrument in self.instruments:
+			thisinstrument.owner = self
+			thisinstrument.bagindex = thisinstrument.lowzonenumber = len(self.instrumentzones)
+			thisinstrument.hizonenumber = thisinstrument.bagindex + len(thisinstrument.zones) - 1
+			thisinstrument.firstsample = None
+			for thiszone in thisinstrument.zones:
+				thiszone.owner = thisinstrument
+				thiszone.generatorIndex = thiszone.lowgeneratornumber = len(self.instrumentzonegenerators)
+				thiszone.higeneratornumber = thiszone.generatorIndex + len(thiszone.generators) - 1
+				thiszone.modIndex = len(self.instrumentzonemodulators)
+				for thisgenerator in thiszone.generators: thisgenerator.owner = thiszone
+				self.instrumentzones.append(thiszone)
+				self.instrumentzonegenerators.extend(thiszone.generators)
+				self.instrumentzonemodulators.extend(thiszone.modulators)
+		for x in range(len(self.presets)): self.presets[x].identifier = x
+		for x in range(len(self.instruments)): self.instruments[x].identifier = x
+		for x in range(len(self.samples)): self.samples[x].identifier = x
+		self.linkfirstrecords()
+		if (self.sf2arch is not None and self.sf2arch.regionindex is not None): self.sf2arch.regionindex.invalidate()
+	
+	def recordedited(self, record):
+		#record is the SF2Preset or SF2Instrument whose zones or generators changed
+		self.storedgenerators = None
+		for listener in self.editlisteners: listener(record)
+	
+	def trackgenerators(self):
+		#the generator records are the bulk of pdta and the slowest part to pack from objects. While the generator
+		#lists hold the same objects as the records in data and none of them has reported an edit, packsubchunk()
+		#copies those records straight out of data. Opening only takes the snapshot; whether every generator's edits
+		#actually reach recordedited() is checked by ownedgenerators() the first time something is serialized
+		self.storedgenerators = None
+		self.storedgeneratorsowned = None
+		spans = subchunkspans(self.data)
+		if (b'pgen' not in spans or b'igen' not in spans): return
+		self.storedgenerators = {
+			b'pgen': (list(self.presetzonegenerators), spans[b'pgen'][0] + 8),
+			b'igen': (list(self.instrumentzonegenerators), spans[b'igen'][0] + 8),
+		}
+	
+	def ownedgenerators(self):
+		#True when every stored generator reports its edits to this chunk through its zone and preset/instrument
+		if (self.storedgeneratorsowned is None):
+			zones = set(map(attrgetter('owner'), self.storedgenerators[b'pgen'][0] + self.storedgenerators[b'igen'][0]))
+			self.storedgeneratorsowned = (None not in zones and set(map(attrgetter('owner'), set(map(attrgetter('owner'), zones)))) == set([self]))
+		return self.storedgeneratorsowned
+	
 	def export(self):
-		toexport = bytearray(b'pdtaphdr')
-		toexport.extend(struct.pack('<I',(len(self.presets)+1) * 38))
-		for x in self.presets:
-			thename = bytearray(x.name.strip().ljust(20,'\x00').encode())
-			toexport.extend(thename)
-			toexport.extend(struct.pack('<H',x.number))
-			toexport.extend(struct.pack('<H',x.bank))
-			toexport.extend(struct.pack('<H',x.bagindex))
-			toexport.extend(struct.pack('<I',x.library))
-			toexport.extend(struct.pack('<I',x.genre))
-			toexport.extend(struct.pack('<I',x.morph))
-			
-		#create a terminating chunk
-		toexport.extend(b'\x00' * 24)
-		toexport.extend(struct.pack('<H',x.bagindex + 1))
-		toexport.extend(b'\x00' * 12)
-			
+		#just the preset headers, prefixed with the pdta tag; serialize() produces the whole LIST payload
+		toexport = bytearray(b'pdta')
+		toexport.extend(self.exportsubchunk(b'phdr'))
 		return toexport
-					
+	
+	def serialize(self, sourceoffsets=False):
+		#size every sub-chunk up front, allocate the pdta payload once and pack the records straight into it;
+		#sourceoffsets=True writes each sample's start/end/loops as they are in the source smpl chunk
+		#instead of the export* offsets writeSF2 assigns
+		sizes = [self.subchunksize(tag) for tag in pdtaSubchunkOrder]
+		towrite = bytearray(4 + sum(sizes) + (8 * len(sizes)))
+		towrite[0:4] = b'pdta'
+		pos = 4
+		for tag, size in zip(pdtaSubchunkOrder, sizes):
+			self.packsubchunk(tag, towrite, pos, sourceoffsets)
+			pos += 8 + size
+		return towrite
+	
+	def exportsubchunk(self, tag, sourceoffsets=False):
+		towrite = bytearray(8 + self.subchunksize(tag))
+		self.packsubchunk(tag, towrite, 0, sourceoffsets)
+		return towrite
+	
+	def subchunksize(self, tag):
+		#every sub-chunk gets one extra terminating record
+		if (tag == b'phdr'): count = len(self.presets)
+		elif (tag == b'pbag'): count = len(self.presetzones)
+		elif (tag == b'pmod'): count = len(self.presetzonemodulators)
+		elif (tag == b'pgen'): count = len(self.presetzonegenerators)
+		elif (tag == b'inst'): count = len(self.instruments)
+		elif (tag == b'ibag'): count = len(self.instrumentzones)
+		elif (tag == b'imod'): count = len(self.instrumentzonemodulators)
+		elif (tag == b'igen'): count = len(self.instrumentzonegenerators)
+		elif (tag == b'shdr'): count = len(self.samples)
+		return (count + 1) * pdtaRecordStructs[tag].size
+	
+	def packsubchunk(self, tag, towrite, pos, sourceoffsets=False):
+		size = self.subchunksize(tag)
+		towrite[pos:pos+4] = tag
+		struct.pack_into('<I', towrite, pos+4, size)
+		pos += 8
+		if (tag == b'phdr'):
+			packer = pdtaRecordStructs[tag]
+			for x in self.presets:
+				packer.pack_into(towrite, pos, encodeSF2Name(x.name, x.rawname), x.number, x.bank, x.bagindex, x.library, x.genre, x.morph)
+				pos += 38
+			packer.pack_into(towrite, pos, b'EOP', 0, 0, len(self.presetzones), 0, 0, 0) #terminator
+		elif (tag == b'pbag'):
+			packwords(towrite, pos, [v for x in self.presetzones for v in (x.generatorIndex, x.modIndex)] + [len(self.presetzonegenerators), len(self.presetzonemodulators)])
+		elif (tag == b'pmod'):
+			packwords(towrite, pos, [v for x in self.presetzonemodulators for v in (x.srcOper, x.destOper, x.amount & 0xFFFF, x.amtSrcOper, x.transOper)] + [0] * 5)
+		elif (tag == b'pgen'):
+			self.packgenerators(tag, self.presetzonegenerators, towrite, pos)
+		elif (tag == b'inst'):
+			packer = pdtaRecordStructs[tag]
+			for x in self.instruments:
+				packer.pack_into(towrite, pos, encodeSF2Name(x.name, x.rawname), x.bagindex)
+				pos += 22
+			packer.pack_into(towrite, pos, b'EOI', len(self.instrumentzones)) #terminator
+		elif (tag == b'ibag'):
+			packwords(towrite, pos, [v for x in self.instrumentzones for v in (x.generatorIndex, x.modIndex)] + [len(self.instrumentzonegenerators), len(self.instrumentzonemodulators)])
+		elif (tag == b'imod'):
+			packwords(towrite, pos, [v for x in self.instrumentzonemodulators for v in (x.srcOper, x.destOper, x.amount & 0xFFFF, x.amtSrcOper, x.transOper)] + [0] * 5)
+		elif (tag == b'igen'):
+			self.packgenerators(tag, self.instrumentzonegenerators, towrite, pos)
+		elif (tag == b'shdr'):
+			packer = pdtaRecordStructs[tag]
+			for x in self.samples:
+				if (sourceoffsets): packer.pack_into(towrite, pos, encodeSF2Name(x.name, x.rawname), x.start, x.end, x.startloop, x.endloop, x.samplerate, x.rootnote, x.finetune, x.link, x.sampletype)
+				else: packer.pack_into(towrite, pos, encodeSF2Name(x.name, x.rawname), x.exportstart, x.exportend, x.exportstartloop, x.exportendloop, x.samplerate, x.rootnote, x.finetune, x.link, x.sampletype)
+				pos += 46
+			packer.pack_into(towrite, pos, b'EOS', 0, 0, 0, 0, 0, 0, 0, 0, 0) #terminator
+	
+	def packgenerators(self, tag, generators, towrite, pos):
+		stored = None if (self.storedgenerators is None) else self.storedgenerators[tag]
+		size = len(generators) * 4
+		if (stored is not None and stored[0] == generators and self.ownedgenerators()): #same objects, none edited: the records in data are current
+			towrite[pos:pos + size] = self.data[stored[1]:stored[1] + size]
+			towrite[pos + size:pos + size + 4] = bytes(4) #terminator
+		else: packwords(towrite, pos, [v for x in generators for v in (x._operator, x._amount)] + [0, 0])
 		
-class SF2Preset(object):
-	firstinstrument = None
-	firstsample = None
-	headerdata = None
-	data = None
-	size = None	
-	identifier = None
+#record layouts of the pdta sub-chunks as (column name, struct code) pairs
+pdtaRecordLayouts = {
+	b'phdr': (('name','20s'),('number','H'),('bank','H'),('bagindex','H'),('library','I'),('genre','I'),('morph','I')),
+	b'pbag': (('generatorIndex','H'),('modIndex','H')),
+	b'pmod': (('srcOper','H'),('destOper','H'),('amount','h'),('amtSrcOper','H'),('transOper','H')),
+	b'pgen': (('operator','H'),('amount','h')),
+	b'inst': (('name','20s'),('bagindex','H')),
+	b'ibag': (('generatorIndex','H'),('modIndex','H')),
+	b'imod': (('srcOper','H'),('destOper','H'),('amount','h'),('amtSrcOper','H'),('transOper','H')),
+	b'igen': (('operator','H'),('amount','h')),
+	b'shdr': (('name','20s'),('start','I'),('end','I'),('startloop','I'),('endloop','I'),('samplerate','I'),('rootnote','B'),('finetune','b'),('link','H'),('sampletype','H')),
+}
+
+pdtaSubchunkOrder = (b'phdr', b'pbag', b'pmod', b'pgen', b'inst', b'ibag', b'imod', b'igen', b'shdr')
+
+pdtaRecordStructs = dict((tag, struct.Struct('<' + ''.join(x[1] for x in layout))) for tag, layout in pdtaRecordLayouts.items())
+
+def packwords(towrite, pos, words):
+	#bulk-pack a flat list of 16 bit values into towrite at pos
+	words = array.array('H', words)
+	if (sys.byteorder == 'big'): words.byteswap()
+	towrite[pos:pos + (len(words) * 2)] = words
+
+def subchunkspans(theData):
+	#tag -> (offset, size) of each sub-chunk in a LIST payload, 8 byte header included
+	spans = OrderedDict()
+	pos = 0
+	while (pos + 8 <= len(theData)):
+		subchunksize = struct.unpack_from('<I', theData, pos+4)[0]
+		spans[bytes(theData[pos:pos+4])] = (pos, 8 + subchunksize)
+		pos += (8 + subchunksize)
+	return spans
+
+numpyFieldTypes = {'20s': 'S20', 'H': '<u2', 'h': '<i2', 'I': '<u4', 'B': 'u1', 'b': 'i1'}
+
+def scanfirsts(bagindexes, count, bags, generators, operator, targetcount):
+	#for each of count headers, the amount of the first operator generator in its zones (None if it has none or
+	#the amount is out of range) -- one bisect per header into the positions where operator occurs
+	positions = [x for x, value in enumerate(generators.operator) if value == operator]
+	amounts = generators.amount
+	firsts = [None] * count
+	lastbag = len(bags) - 1
+	for x in range(count):
+		if (lastbag < 0): break
+		first = bags.generatorIndex[min(bagindexes[x], lastbag)]
+		end = bags.generatorIndex[min(bagindexes[x+1], lastbag)]
+		found = bisect_left(positions, first)
+		if (found < len(positions) and positions[found] < end):
+			amount = amounts[positions[found]] & 0xFFFF
+			if (amount < targetcount): firsts[x] = amount
+	return firsts
+
+def decodeSF2Name(rawname):
+	terminator = rawname.find(b'\x00')
+	if terminator == -1: terminator = 20 #in case no string terminator found in the 20 characters
+	try:
+		return rawname[0:terminator].decode('utf-8')
+	except UnicodeDecodeError: #plenty of fonts carry Latin-1 names
+		return rawname[0:terminator].decode('latin-1')
+
+def encodeSF2Name(name, rawname=None):
+	#the 20 byte name field to write for name: rawname, the field it was read from, for as long as it still reads as
+	#name -- so Latin-1 names, padding and bytes after the terminator are written back as they were -- else UTF-8
+	if (rawname is not None and decodeSF2Name(rawname).strip() == name.strip()): return rawname
+	return name.strip().encode()
+
+class SF2Table(object):
+	#one pdta sub-chunk decoded into typed columns, e.g. table.operator[i]
+	tag = None
+	count = 0
+	columnnames = None
+	recordformat = None
+	usenumpy = False
+	rawnames = None #for tables with a name column, the undecoded 20 byte name fields
+	
+	def __init__(self, tag):
+		self.tag = tag
+		self.count = 0
+		self.usenumpy = False
+		layout = pdtaRecordLayouts[tag]
+		self.columnnames = tuple(x[0] for x in layout)
+		self.recordformat = pdtaRecordStructs[tag]
+	
+	def parse(self, theData, usenumpy=False):
+		layout = pdtaRecordLayouts[self.tag]
+		self.count = int(len(theData) / self.recordformat.size)
+		theData = theData[:self.count * self.recordformat.size]
+		self.usenumpy = usenumpy
+		if (usenumpy):
+			if (numpy is None): raise RuntimeError("numpy tables requested but numpy is not installed")
+			records = numpy.frombuffer(theData, dtype=[(name, numpyFieldTypes[code]) for name, code in layout])
+			for name, code in layout:
+				if (code == '20s'):
+					self.rawnames = [x.ljust(20, b'\x00') for x in records[name].tolist()] #numpy drops the trailing NULs
+					setattr(self, name, [decodeSF2Name(x) for x in self.rawnames])
+				else: setattr(self, name, records[name])
+		elif (all(code in ('H', 'h') for name, code in layout)):
+			#bag/mod/gen records are runs of 16 bit words: read the chunk as words once and slice out each column
+			stride = int(self.recordformat.size / 2)
+			words = {}
+			for column, (name, code) in enumerate(layout):
+				if (code not in words):
+					words[code] = array.array(code, theData)
+					if (sys.byteorder == 'big'): words[code].byteswap()
+				setattr(self, name, words[code][column::stride])
+		else:
+			columns = list(zip(*struct.iter_unpack(self.recordformat.format, theData))) or [()] * len(layout)
+			for (name, code), column in zip(layout, columns):
+				if (code == '20s'):
+					self.rawnames = list(column)
+					setattr(self, name, [decodeSF2Name(x) for x in column])
+				else: setattr(self, name, array.array(code, column))
 	
-	name   = None
-	number = None
-	bank   = None
-	bagindex  = None
+	def column(self, name):
+		return getattr(self, name)
 	
-	library = None
-	genre   = None
-	morph   = None
+	def records(self):
+		#row tuples in layout order, names already decoded
+		return zip(*[(x if isinstance(x, list) else x.tolist()) for x in (getattr(self, name) for name in self.columnnames)])
 	
-	zones   = None
-	lowzonenumber = None
-	hizonenumber  = None
+	def export(self):
+		#tag, size and records straight from the columns
+		layout = pdtaRecordLayouts[self.tag]
+		towrite = bytearray(8 + (self.count * self.recordformat.size))
+		towrite[0:4] = self.tag
+		struct.pack_into('<I', towrite, 4, self.count * self.recordformat.size)
+		if (self.usenumpy):
+			records = numpy.zeros(self.count, dtype=[(name, numpyFieldTypes[code]) for name, code in layout])
+			for name, code in layout:
+				if (code == '20s'): records[name] = [encodeSF2Name(x, rawname) for x, rawname in zip(getattr(self, name), self.rawnames)]
+				else: records[name] = getattr(self, name)
+			towrite[8:] = records.tobytes()
+		elif (all(code in ('H', 'h') for name, code in layout)):
+			stride = int(self.recordformat.size / 2)
+			words = array.array('H', bytes(self.count * self.recordformat.size))
+			for column, (name, code) in enumerate(layout):
+				values = getattr(self, name)
+				if (code == 'h'): values = array.array('H', values.tobytes())
+				words[column::stride] = values
+			if (sys.byteorder == 'big'): words.byteswap()
+			towrite[8:] = words
+		else:
+			pos = 8
+			for record, rawname in zip(self.records(), self.rawnames):
+				self.recordformat.pack_into(towrite, pos, encodeSF2Name(record[0], rawname), *record[1:])
+				pos += self.recordformat.size
+		return towrite
 	
-	zonecount = 1
+	def __len__(self):
+		return self.count
 
-	def __init__(self):
-		self.zones = []
+class SF2PresetDataTables(object):
+	phdr = None
+	pbag = None
+	pmod = None
+	pgen = None
+	inst = None
+	ibag = None
+	imod = None
+	igen = None
+	shdr = None
+	
+	def parse(self, theData, usenumpy=False):
+		pos = 0
+		while (pos < len(theData)):
+			subchunktag = bytes(theData[pos:pos+4])
+			subchunksize = struct.unpack_from('<I', theData, pos+4)[0]
+			subchunkdata = theData[pos+8:pos+8+subchunksize]
+			if (subchunktag in pdtaRecordLayouts):
+				thistable = SF2Table(subchunktag)
+				thistable.parse(subchunkdata, usenumpy)
+				setattr(self, subchunktag.decode(), thistable)
+			else:
+				print (subchunktag)
+			pos += (8 + subchunksize)
+	
+	def tables(self):
+		return [x for x in (self.phdr, self.pbag, self.pmod, self.pgen, self.inst, self.ibag, self.imod, self.igen, self.shdr) if x is not None]
+	
+	def serialize(self):
+		#pdta LIST payload packed column-wise from the tables, bypassing the object model
+		towrite = bytearray(b'pdta')
+		for x in self.tables(): towrite.extend(x.export())
+		return towrite
 
-	def parseheader(self, theData):
-		self.headerdata = theData
+class SF2Preset(object):
+	__slots__ = ('firstinstrument', 'firstsample', 'identifier', 'name', 'rawname', 'number', 'bank', 'bagindex',
+		'library', 'genre', 'morph', 'zones', 'lowzonenumber', 'hizonenumber', 'zonecount', 'owner')
+
+	def __init__(self):
+		self.owner = None #the SF2PresetDataChunk, once linked
+		self.firstinstrument = None
+		self.firstsample = None
+		self.identifier = None
 		
-		terminator = self.headerdata[0:20].find(b'\x00')
-		if terminator == -1: terminator = 20 #in case no string terminator found in the 20 characters
-		self.name = self.headerdata[0:terminator].decode('utf-8').ljust(20)
+		self.name   = None
+		self.rawname = None
+		self.number = None
+		self.bank   = None
+		self.bagindex  = None
 		
-		self.number  = struct.unpack_from('<H', self.headerdata, 20)[0]
-		self.bank    = struct.unpack_from('<H', self.headerdata, 22)[0]
-		self.bagindex   = struct.unpack_from('<H', self.headerdata, 24)[0]
-		self.lowzonenumber = self.bagindex
-		self.hizonenumber = self.bagindex
+		self.library = None
+		self.genre   = None
+		self.morph   = None
 		
-		self.library = struct.unpack_from('<I', self.headerdata, 26)[0]
-		self.genre   = struct.unpack_from('<I', self.headerdata, 30)[0]
-		self.morph   = struct.unpack_from('<I', self.headerdata, 34)[0]
+		self.zones   = []
+		self.lowzonenumber = None
+		self.hizonenumber  = None
+		
+		self.zonecount = 1
 
-class SF2PresetZone(object):
-	data = None
-	size = None
+	def parseheader(self, theData):
+		record = struct.unpack_from('<20sHHHIII', theData, 0)
+		self.parserecord((decodeSF2Name(record[0]),) + record[1:], record[0])
 	
-	generators = None
+	def parserecord(self, record, rawname=None):
+		#rawname: the 20 byte field the name was decoded from, written back while the name is unchanged
+		name, self.number, self.bank, self.bagindex, self.library, self.genre, self.morph = record
+		self.name = name.ljust(20)
+		self.rawname = rawname
+		self.lowzonenumber = self.bagindex
+		self.hizonenumber = self.bagindex
 	
-	generatorIndex = None
-	lowgeneratornumber = None
-	higeneratornumber = None
-	modIndex = None
+	def edited(self):
+		#call after changing bank/number or the zone list by hand; generator edits call this themselves
+		if (self.owner is not None): self.owner.recordedited(self)
+
+class SF2PresetZone(object):
+	__slots__ = ('generators', 'modulators', 'generatorIndex', 'lowgeneratornumber', 'higeneratornumber', 'modIndex', 'owner')
 	
 	def __init__(self):
+		self.owner = None #the preset/instrument this zone belongs to, once linked
 		self.generators = []
+		self.modulators = []
+		
+		self.generatorIndex = None
+		self.lowgeneratornumber = None
+		self.higeneratornumber = None
+		self.modIndex = None
 	
 	def parse(self, theData):
-		self.data = theData
-		self.generatorIndex  = struct.unpack_from('<H', self.data, 0)[0]
+		self.parserecord(struct.unpack_from('<HH', theData, 0))
+	
+	def parserecord(self, record):
+		self.generatorIndex, self.modIndex = record
 		self.lowgeneratornumber = self.generatorIndex
 		self.higeneratornumber = self.generatorIndex
-		self.modIndex        = struct.unpack_from('<H', self.data, 2)[0]
+	
+	def edited(self):
+		if (self.owner is not None): self.owner.edited()
 		
 
 class SF2PresetZoneModulator(object):
-	data = None
-	size = None
+	__slots__ = ('srcOper', 'destOper', 'amount', 'amtSrcOper', 'transOper')
+	
+	def __init__(self):
+		self.srcOper = None
+		self.destOper = None
+		self.amount = None
+		self.amtSrcOper = None
+		self.transOper = None
 	
 	def parse(self, theData):
-		self.data = theData
+		self.parserecord(struct.unpack_from('<HHhHH', theData, 0))
+	
+	def parserecord(self, record):
+		self.srcOper, self.destOper, self.amount, self.amtSrcOper, self.transOper = record
 		
 
-class SF2PresetZoneGenerator(object):
-	data = None
-	size = None
-	
-	operator = None
-	amount = None
-	amountunsigned = None
-	amountrangel = None
-	amountrangeh = None
+class SF2ZoneGenerator(object):
+	#the generator amount is kept once, as the raw 16 bit word; the signed, unsigned
+	#and lo/hi byte (range) readings are all derived from it on demand
+	__slots__ = ('_operator', '_amount', 'owner')
 	
 	#kStartAddrsOffset = 0, 
 	#kEndAddrsOffset, kStartloopAddrsOffset, kEndloopAddrsOffset,
@@ -660,205 +1597,1593 @@ class SF2PresetZoneGenerator(object):
 	
 	# 16 = REVERB % -- 700 = 70.0%
 	
+	def __init__(self, operator=None, amount=0):
+		self._operator = operator
+		self._amount = amount & 0xFFFF
+		self.owner = None #the zone this generator belongs to, once linked
+	
 	def parse(self, theData):
-		self.data = theData
-		self.operator  = struct.unpack_from('<H', self.data, 0)[0]
-		self.amount    = struct.unpack_from('<h', self.data, 2)[0]
-		self.amountunsigned = struct.unpack_from('<H', self.data, 2)[0]
-		self.amountrangel = struct.unpack_from('B', self.data, 2)[0]
-		self.amountrangeh = struct.unpack_from('B', self.data, 3)[0]
-		
-class SF2Instrument(object):
-	firstsample = None
-	data = None
-	size = None
-	identifier = None
+		self.parserecord(struct.unpack_from('<Hh', theData, 0))
 	
-	name = None
-	bagindex = None
+	def parserecord(self, record):
+		self._operator = record[0]
+		self._amount = record[1] & 0xFFFF
 	
-	lowzonenumber = None
-	hizonenumber  = None
+	def edited(self):
+		if (self.owner is not None): self.owner.edited()
 	
-	zones   = None	
+	@property
+	def operator(self):
+		return self._operator
+	
+	@operator.setter
+	def operator(self, value):
+		self._operator = value
+		self.edited()
+	
+	@property
+	def amountunsigned(self):
+		return self._amount
+	
+	@amountunsigned.setter
+	def amountunsigned(self, value):
+		self._amount = value & 0xFFFF
+		self.edited()
+	
+	@property
+	def amount(self):
+		if (self._amount & 0x8000): return self._amount - 0x10000
+		return self._amount
+	
+	@amount.setter
+	def amount(self, value):
+		self.amountunsigned = value
+	
+	@property
+	def amountrangel(self):
+		return self._amount & 0xFF
+	
+	@amountrangel.setter
+	def amountrangel(self, value):
+		self.amountunsigned = (self._amount & 0xFF00) | (value & 0xFF)
+	
+	@property
+	def amountrangeh(self):
+		return self._amount >> 8
+	
+	@amountrangeh.setter
+	def amountrangeh(self, value):
+		self.amountunsigned = ((value & 0xFF) << 8) | (self._amount & 0xFF)
+
+class SF2PresetZoneGenerator(SF2ZoneGenerator):
+	__slots__ = ()
+		
+class SF2Instrument(object):
+	__slots__ = ('firstsample', 'identifier', 'name', 'rawname', 'bagindex', 'lowzonenumber', 'hizonenumber', 'zones', 'owner')
 	
 	def __init__(self):
-		self.zones = []
+		self.owner = None #the SF2PresetDataChunk, once linked
+		self.firstsample = None
+		self.identifier = None
+		
+		self.name = None
+		self.rawname = None
+		self.bagindex = None
+		
+		self.lowzonenumber = None
+		self.hizonenumber  = None
+		
+		self.zones   = []
 	
 	def parse(self, theData):
-		self.data = theData
-		terminator = self.data[0:20].find(b'\x00')
-		if terminator == -1: terminator = 20 #in case no string terminator found in the 20 characters
-		self.name = self.data[0:terminator].decode('utf-8').ljust(20)
-		self.bagindex  = struct.unpack_from('<H', self.data, 20)[0]
+		record = struct.unpack_from('<20sH', theData, 0)
+		self.parserecord((decodeSF2Name(record[0]),) + record[1:], record[0])
+	
+	def parserecord(self, record, rawname=None):
+		name, self.bagindex = record
+		self.name = name.ljust(20)
+		self.rawname = rawname
 		self.lowzonenumber = self.bagindex
 		self.hizonenumber = self.bagindex
+	
+	def edited(self):
+		#call after changing the zone list by hand; generator edits call this themselves
+		if (self.owner is not None): self.owner.recordedited(self)
 		
 class SF2InstrumentZone(object):
-	data = None
-	size = None
-	
-	generators = None
-	
-	generatorIndex = None
-	lowgeneratornumber = None
-	higeneratornumber = None
-	modIndex = None
+	__slots__ = ('generators', 'modulators', 'generatorIndex', 'lowgeneratornumber', 'higeneratornumber', 'modIndex', 'owner')
 	
 	def __init__(self):
+		self.owner = None #the preset/instrument this zone belongs to, once linked
 		self.generators = []
+		self.modulators = []
+		
+		self.generatorIndex = None
+		self.lowgeneratornumber = None
+		self.higeneratornumber = None
+		self.modIndex = None
 	
 	def parse(self, theData):
-		self.data = theData
-		self.generatorIndex  = struct.unpack_from('<H', self.data, 0)[0]
+		self.parserecord(struct.unpack_from('<HH', theData, 0))
+	
+	def parserecord(self, record):
+		self.generatorIndex, self.modIndex = record
 		self.lowgeneratornumber = self.generatorIndex
 		self.higeneratornumber = self.generatorIndex
-		self.modIndex        = struct.unpack_from('<H', self.data, 2)[0]
+	
+	def edited(self):
+		if (self.owner is not None): self.owner.edited()
 
 class SF2InstrumentZoneModulator(object):
-	data = None
-	size = None
+	__slots__ = ('srcOper', 'destOper', 'amount', 'amtSrcOper', 'transOper')
 	
-	def parse(self, theData):
-		self.data = theData
-
-class SF2InstrumentZoneGenerator(object):
-	data = None
-	size = None
+	def __init__(self):
+		self.srcOper = None
+		self.destOper = None
+		self.amount = None
+		self.amtSrcOper = None
+		self.transOper = None
 	
-	operator = None
-	amount = None
-	amountunsigned = None
-	amountrangel = None
-	amountrangeh = None
-		
 	def parse(self, theData):
-		self.data = theData
-		self.operator  = struct.unpack_from('<H', self.data, 0)[0]
-		self.amount    = struct.unpack_from('<h', self.data, 2)[0]
-		self.amountunsigned = struct.unpack_from('<H', self.data, 2)[0]
-		self.amountrangel = struct.unpack_from('B', self.data, 2)[0]
-		self.amountrangeh = struct.unpack_from('B', self.data, 3)[0]
+		self.parserecord(struct.unpack_from('<HHhHH', theData, 0))
+	
+	def parserecord(self, record):
+		self.srcOper, self.destOper, self.amount, self.amtSrcOper, self.transOper = record
+
+class SF2InstrumentZoneGenerator(SF2ZoneGenerator):
+	__slots__ = ()
 
 class SF2Sample(object):
-	firstinstrument = None
-	firstpreset = None
-	matched = False
-	
-	sf2arch = None
-	
-	headerdata = None
-	__sampledata = None
-	data       = None
-	size       = None
-	identifier = None
-	
-		
-	name       = None
-	#start/end/startloop/endloop are all pointers into the gigantic sample data chunk...
-	start      = None
-	end        = None
-	startloop  = None
-	endloop    = None
-	
-	localstart = None
-	localend   = None
-	localstartloop = None
-	localendloop   = None
-	
-	samplerate = None
-	rootnote   = None
-	finetune   = None
-	link       = None
-	sampletype = None # 1 = monoSample, 2 = rightSample, 4 = leftSample, 8 = linkedSample, 32769 = romMonoSample, 32770 = romRightSample, 32772 = romLeftSample, 32776 = romLinkedSample
-	
-	sampledataloaded = False
+	__slots__ = ('firstinstrument', 'firstpreset', 'matched', 'sf2arch', '__sampledata', 'identifier',
+		'name', 'rawname', 'start', 'end', 'startloop', 'endloop', 'localstart', 'localend', 'localstartloop', 'localendloop',
+		'exportstart', 'exportend', 'exportstartloop', 'exportendloop',
+		'samplerate', 'rootnote', 'finetune', 'link', 'sampletype', 'sampledataloaded', 'sampledataimported')
 	
 	def __init__(self,thearchive):
+		self.firstinstrument = None
+		self.firstpreset = None
+		self.matched = False
+		
 		self.sf2arch = thearchive
+		
+		self.__sampledata = None
+		self.identifier = None
+		
+		self.name       = None
+		self.rawname    = None
+		#start/end/startloop/endloop are all pointers into the gigantic sample data chunk...
+		self.start      = None
+		self.end        = None
+		self.startloop  = None
+		self.endloop    = None
+		
+		self.localstart = None
+		self.localend   = None
+		self.localstartloop = None
+		self.localendloop   = None
+		
+		self.exportstart = 0
+		self.exportend = 0
+		self.exportstartloop = 0
+		self.exportendloop = 0
+		
+		self.samplerate = None
+		self.rootnote   = None
+		self.finetune   = None
+		self.link       = None
+		self.sampletype = None # 1 = monoSample, 2 = rightSample, 4 = leftSample, 8 = linkedSample, 32769 = romMonoSample, 32770 = romRightSample, 32772 = romLeftSample, 32776 = romLinkedSample
+		
+		self.sampledataloaded = False
+		self.sampledataimported = False #True once importsampledata() replaced what the source file holds
 	
 	def parseheader(self, theData):
-		self.headerdata = theData
-		
-		terminator = self.headerdata[0:20].find(b'\x00')
-		if terminator == -1: terminator = 20 #in case terminator wasn't found in the 20 characters
-		self.name = self.headerdata[0:terminator].decode('utf-8').ljust(20)
+		record = struct.unpack_from('<20sIIIIIBbHH', theData, 0)
+		self.parserecord((decodeSF2Name(record[0]),) + record[1:], record[0])
+	
+	def parserecord(self, record, rawname=None):
+		name, self.start, self.end, self.startloop, self.endloop, self.samplerate, self.rootnote, self.finetune, self.link, self.sampletype = record
+		self.name = name.ljust(20)
+		self.rawname = rawname
 		
-		self.start      = struct.unpack_from('<I', self.headerdata, 20)[0]
-		self.end        = struct.unpack_from('<I', self.headerdata, 24)[0]
-		self.startloop  = struct.unpack_from('<I', self.headerdata, 28)[0]
-		self.endloop    = struct.unpack_from('<I', self.headerdata, 32)[0]
-
 		self.exportstart = 0
 		self.exportend = 0
 		self.exportstartloop = 0
 		self.exportendloop = 0
-		self.samplerate = struct.unpack_from('<I', self.headerdata, 36)[0]
-		self.rootnote   = struct.unpack_from( 'B', self.headerdata, 40)[0]
-		self.finetune   = struct.unpack_from( 'b', self.headerdata, 41)[0]
-		self.link       = struct.unpack_from('<H', self.headerdata, 42)[0]
-		self.sampletype = struct.unpack_from('<H', self.headerdata, 44)[0]
 	
 	def loadsampledata(self):
-		with open(self.sf2arch.pathname, 'rb') as sf2file:
-			sf2file.seek(self.sf2arch.sampledataoffset + (self.start * 2))
-			ckSize = (self.end - self.start) * 2 #samples to bytes (16bit) 
-			self.__sampledata = sf2file.read(ckSize)
+		self.__sampledata = self.sf2arch.readsampledata(self.start, self.end)
 		self.sampledataloaded = True
+	
+	def releasesampledata(self):
+		#forget a mapped slice so the archive's mapping can be closed
+		if (isinstance(self.__sampledata, memoryview)):
+			self.__sampledata.release()
+			self.__sampledata = None
+			self.sampledataloaded = False
 		
 	def writeWAV(self,pathname):
 		with open(pathname, 'wb') as fo:
-			fo = open(outfile,"wb")
-			ckSize = (self.end - self.start) * 2 #samples to bytes (16bit) 
-			loopstart = (self.startloop - self.start)
-			loopend = (self.endloop - self.start)
-
 			rawdata = self.sampledata
-			wSamplesPerSec = self.samplerate
-			wChannels = 1
-
-			fo.write(str.encode('RIFF')+b"\x00\x00\x00\x00"+str.encode('WAVEfmt '))
-			fo.write(struct.pack('I', 16)) #chunk length
-			fo.write(struct.pack('H', 1))  #pcm format
-			fo.write(struct.pack('H', wChannels)) # channel count 
-			fo.write(struct.pack('I', wSamplesPerSec)) # sample rate
-			fo.write(struct.pack('I', int((wSamplesPerSec * wChannels * 16) / 8)))
-			fo.write(struct.pack('H', int((wChannels * 16) / 8)))
-			fo.write(struct.pack('H', 16)) #16 bit
-
-			fo.write(b'smpl')
-			fo.write(struct.pack('I', 60)) #chunk length
-			fo.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
-			fo.write(struct.pack('I', int((1/wSamplesPerSec)*1000000000))) #nanoseconds per sample
-			#rootnote = int(os.path.splitext(filename)[0].split('-')[-1])
-			fo.write(struct.pack('I', thesample.rootnote))
-			fo.write(b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-			fo.write(struct.pack('I', 1)) # 1 sample loop follows
-			fo.write(struct.pack('I', 0)) # of size 24 bytes...
-			fo.write(struct.pack('I', 1)) # cue point 1
-			fo.write(struct.pack('I', 0)) # loop forward
-			fo.write(struct.pack('I', loopstart * wChannels)) # byte offset to start of loop
-			fo.write(struct.pack('I', (loopend-1) * wChannels)) # byte offset to start of loop
-			fo.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
-
-			fo.write(b'data')
-			fo.write(struct.pack('I', int(len(rawdata))))
+			fo.write(wavheader(1, self.samplerate, self.rootnote, self.startloop - self.start, self.endloop - self.start, len(rawdata)))
 			fo.write(rawdata)
-
-			filesize = fo.tell()
-			fo.seek(4)
-			fo.write(struct.pack('I', int(filesize-8)))
 	
 	@property
 	def sampledata(self):
 		if (self.sampledataloaded == False):
-			with open(self.sf2arch.pathname, 'rb') as sf2file:
-				sf2file.seek(self.sf2arch.sampledataoffset + (self.start * 2))
-				ckSize = (self.end - self.start) * 2 #samples to bytes (16bit) 
-				return (sf2file.read(ckSize))
+			if (self.sf2arch.samplecache is not None):
+				return self.sf2arch.samplecache.fetch(self)
+			return self.sf2arch.readsampledata(self.start, self.end)
 		else:
 			return self.__sampledata
 	
+	def segments(self, blockframes):
+		#the sample body in blocks of at most blockframes points: buffers already in memory (imported, loaded or
+		#mapped data) come out as slices, anything still on disk as an (archive, offset, count) read for the caller to make
+		blockbytes = blockframes * 2
+		if (self.sampledataloaded): data = memoryview(self.__sampledata)
+		elif (self.sf2arch.samplemapview is not None): data = self.sf2arch.readsampledata(self.start, self.end)
+		else: data = None
+		if (data is not None):
+			for x in range(0, len(data), blockbytes): yield data[x:x+blockbytes]
+			return
+		offset = self.sf2arch.sampledataoffset + (self.start * 2)
+		end = offset + self.sampledatasize()
+		for x in range(offset, end, blockbytes): yield (self.sf2arch, x, min(blockbytes, end - x))
+	
+	def iterchunks(self, frames=65536):
+		#the sample body as bytes-like blocks of at most frames points, so a long sample never has to be held whole
+		return readsegments(self.segments(frames))
+	
+	def aiterchunks(self, frames=65536):
+		#async iterchunks(): disk reads run on the loop's default executor, so the event loop never blocks on them
+		return areadsegments(self.segments(frames))
+	
+	def sampledataprivate(self):
+		#True when the body is held in memory of its own (eager or imported), not read from or mapped onto the file
+		return self.sampledataloaded and not isinstance(self.__sampledata, memoryview)
+	
+	def sampledatasize(self):
+		#size in bytes, without touching the sample body unless it has already been loaded
+		if (self.sampledataloaded): return len(self.__sampledata)
+		return (self.end - self.start) * 2
+	
 	def importsampledata(self,newsampledata):
+		if (self.sf2arch.samplecache is not None): self.sf2arch.samplecache.discard(self)
 		self.__sampledata = newsampledata
 		self.sampledataloaded = True
+		self.sampledataimported = True
+
+def readsegments(segments):
+	#turn SF2Sample.segments()-style pieces into bytes-like blocks, making the (archive, offset, count) reads
+	#through each archive's shared descriptor
+	for x in segments:
+		if (isinstance(x, tuple)):
+			thearchive, offset, count = x
+			x = preadblock(thearchive.descriptor(), count, offset)
+		yield x
+
+async def areadsegments(segments):
+	#readsegments() for asyncio: the positional reads are handed to the default executor one block at a time,
+	#so each stream holds one block at a time and the event loop never waits on the disk
+	loop = asyncio.get_running_loop()
+	for x in segments:
+		if (isinstance(x, tuple)):
+			thearchive, offset, count = x
+			if (thearchive.samplefile is None): await loop.run_in_executor(None, thearchive.descriptor)
+			x = await loop.run_in_executor(None, preadblock, thearchive.descriptor(), count, offset)
+		yield x
+
+class SF2SampleCache(object):
+	#least-recently-used store for sample bodies, bounded by the total number of bytes held. Safe to share between
+	#threads and archives (see SF2SamplePool); pinned samples stay resident and are never evicted, but their bytes
+	#still count against maxbytes
+	maxbytes = None
+	currentbytes = 0
+	pinnedbytes = 0
+	hits = 0
+	misses = 0
+	evictions = 0
+	entries = None       #unpinned sample -> data, least recently used first
+	pinnedentries = None #pinned sample -> data
+	pincounts = None     #sample -> how many times it is pinned
+	lock = None
+	
+	def __init__(self, maxbytes=64*1024*1024):
+		self.maxbytes = maxbytes
+		self.currentbytes = 0
+		self.pinnedbytes = 0
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.entries = OrderedDict()
+		self.pinnedentries = {}
+		self.pincounts = {}
+		self.lock = threading.RLock()
+	
+	def fetch(self, thesample):
+		with self.lock:
+			data = self.pinnedentries.get(thesample)
+			if (data is None):
+				data = self.entries.get(thesample)
+				if (data is not None): self.entries.move_to_end(thesample)
+			if (data is not None):
+				self.hits += 1
+				return data
+			self.misses += 1
+		#read without holding the lock; two threads missing the same sample both read it and the last store wins
+		data = thesample.sf2arch.readsampledata(thesample.start, thesample.end)
+		self.store(thesample, data)
+		return data
+	
+	def store(self, thesample, data):
+		with self.lock:
+			self.discard(thesample)
+			if (thesample in self.pincounts):
+				self.pinnedentries[thesample] = data
+				self.pinnedbytes += len(data)
+				self.currentbytes += len(data)
+				self.evict()
+				return
+			if (len(data) > self.maxbytes - self.pinnedbytes): return #never cache something that would flush everything else
+			self.entries[thesample] = data
+			self.currentbytes += len(data)
+			self.evict()
+	
+	def evict(self):
+		#drop least recently used unpinned samples until the budget holds (or only pinned ones are left)
+		with self.lock:
+			while (self.currentbytes > self.maxbytes and self.entries):
+				evicted = self.entries.popitem(last=False)[1]
+				self.currentbytes -= len(evicted)
+				self.evictions += 1
+	
+	def discard(self, thesample):
+		with self.lock:
+			data = self.entries.pop(thesample, None)
+			if (data is None):
+				data = self.pinnedentries.pop(thesample, None)
+				if (data is not None): self.pinnedbytes -= len(data)
+			if (data is not None): self.currentbytes -= len(data)
+	
+	def pin(self, thesample):
+		#keep thesample resident (reading it now if need be) until a matching unpin(); pins nest
+		with self.lock:
+			self.pincounts[thesample] = self.pincounts.get(thesample, 0) + 1
+			if (self.pincounts[thesample] > 1): return
+			data = self.entries.pop(thesample, None)
+			if (data is not None):
+				self.pinnedentries[thesample] = data
+				self.pinnedbytes += len(data)
+				return
+		if (not thesample.sampledataloaded): self.fetch(thesample)
+	
+	def unpin(self, thesample):
+		#undo one pin(); the last one hands the sample back to the LRU as its most recently used entry
+		with self.lock:
+			count = self.pincounts.get(thesample, 0)
+			if (count > 1):
+				self.pincounts[thesample] = count - 1
+				return
+			self.pincounts.pop(thesample, None)
+			data = self.pinnedentries.pop(thesample, None)
+			if (data is not None):
+				self.pinnedbytes -= len(data)
+				self.entries[thesample] = data
+				self.evict()
+	
+	def resize(self, maxbytes):
+		with self.lock:
+			self.maxbytes = maxbytes
+			self.evict()
+	
+	def forget(self, thearchive):
+		#drop every sample of thearchive, pinned or not
+		with self.lock:
+			for x in [x for x in list(self.entries) + list(self.pinnedentries) if x.sf2arch is thearchive]: self.discard(x)
+			for x in [x for x in self.pincounts if x.sf2arch is thearchive]: del(self.pincounts[x])
+	
+	def clear(self):
+		with self.lock:
+			self.entries.clear()
+			self.pinnedentries.clear()
+			self.currentbytes = 0
+			self.pinnedbytes = 0
+	
+	def stats(self):
+		with self.lock:
+			return {'entries': len(self.entries) + len(self.pinnedentries), 'bytes': self.currentbytes, 'maxbytes': self.maxbytes,
+				'pinned': len(self.pincounts), 'pinnedbytes': self.pinnedbytes,
+				'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class SF2SamplePool(SF2SampleCache):
+	#one sample cache for many archives, so a whole library of lazily opened fonts shares a single byte budget:
+	#open(..., load_samples="lazy", samplepool=pool) registers the archive, close() drops its samples again and
+	#unregister() leaves the pool for good
+	archives = None
+	
+	def __init__(self, maxbytes=256*1024*1024):
+		SF2SampleCache.__init__(self, maxbytes)
+		self.archives = weakref.WeakSet()
+	
+	def register(self, thearchive):
+		with self.lock:
+			self.archives.add(thearchive)
+		thearchive.samplecache = self
+	
+	def unregister(self, thearchive):
+		with self.lock:
+			self.forget(thearchive)
+			self.archives.discard(thearchive)
+	
+	def stats(self):
+		#SF2SampleCache.stats() plus 'archives': id() of each archive holding samples or registered with the pool ->
+		#{'pathname', 'entries', 'bytes'}; keyed by archive, as several archives may have the same file open
+		with self.lock:
+			result = SF2SampleCache.stats(self)
+			occupancy = dict((id(x), {'pathname': x.pathname, 'entries': 0, 'bytes': 0}) for x in self.archives)
+			for entries in (self.entries, self.pinnedentries):
+				for thesample, data in entries.items():
+					thearchive = thesample.sf2arch
+					usage = occupancy.setdefault(id(thearchive), {'pathname': thearchive.pathname, 'entries': 0, 'bytes': 0})
+					usage['entries'] += 1
+					usage['bytes'] += len(data)
+			result['archives'] = occupancy
+			return result
+
+sharedpool = None
+sharedpoollock = threading.Lock()
+
+def sharedsamplepool(maxbytes=None):
+	#the process-wide SF2SamplePool, made on first use; maxbytes (re)sets its budget
+	global sharedpool
+	with sharedpoollock:
+		if (sharedpool is None): sharedpool = SF2SamplePool() if maxbytes is None else SF2SamplePool(maxbytes)
+		elif (maxbytes is not None): sharedpool.resize(maxbytes)
+	return sharedpool
+
+class SF2PhaseStats(object):
+	#a tracer for SF2Archive.tracer that totals calls, seconds, bytes and records per phase; safe to share
+	#between threads, e.g. SF2Archive.tracer = stats = SF2PhaseStats() ... print(json.dumps(stats.export()))
+	phases = None
+	lock = None
+
+	def __init__(self):
+		self.phases = OrderedDict()
+		self.lock = threading.Lock()
+
+	def __call__(self, phase, seconds, bytecount=0, records=0):
+		with self.lock:
+			totals = self.phases.get(phase)
+			if (totals is None): totals = self.phases[phase] = [0, 0.0, 0, 0]
+			totals[0] += 1
+			totals[1] += seconds
+			totals[2] += bytecount
+			totals[3] += records
+
+	def export(self):
+		#phase -> {'calls', 'seconds', 'bytes', 'records', 'mbps'} in the order the phases were first seen
+		result = OrderedDict()
+		with self.lock:
+			for phase, (calls, seconds, bytecount, records) in self.phases.items():
+				result[phase] = {'calls': calls, 'seconds': seconds, 'bytes': bytecount, 'records': records,
+					'mbps': (bytecount / seconds / 1e6) if (seconds > 0) else 0.0}
+		return result
+
+	def reset(self):
+		with self.lock: self.phases.clear()
+
+def findgenerator(zone, operator):
+	for x in zone.generators:
+		if (x._operator == operator): return x
+	return None
+
+def zonerange(zone, operator, default):
+	#keyRange/velRange of a zone as (low, high), or default when the zone doesn't set it
+	if (zone is None): return default
+	thegenerator = findgenerator(zone, operator)
+	if (thegenerator is None): return default
+	return (thegenerator._amount & 0xFF, thegenerator._amount >> 8)
+
+def zonevalues(zone, values):
+	#lay a zone's generator amounts over values (a dict or the 61 entry list), last one wins
+	if (zone is None): return values
+	for x in zone.generators:
+		if (x._operator < 61): values[x._operator] = x._amount if (x._operator in unsignedGenerators) else x.amount
+	return values
+
+class SF2Region(object):
+	#one playable combination of preset zone, instrument zone and sample with its effective key/velocity ranges;
+	#generators holds the resolved value of all 61 generators, indexed like generatorEnumerators
+	__slots__ = ('preset', 'presetzone', 'instrument', 'instrumentzone', 'sample', 'keylo', 'keyhi', 'vello', 'velhi', 'generators')
+	
+	def __init__(self, preset, presetzone, instrument, instrumentzone, sample, keyrange, velrange, generators=None):
+		self.preset = preset
+		self.presetzone = presetzone
+		self.instrument = instrument
+		self.instrumentzone = instrumentzone
+		self.sample = sample
+		self.keylo, self.keyhi = keyrange
+		self.vello, self.velhi = velrange
+		self.generators = generators
+	
+	def generator(self, name):
+		return self.generators[generatorEnumerators.index(name)]
+
+class SF2RegionIndex(object):
+	#per preset, a 128 entry key table whose entries split the velocity axis into segments,
+	#each holding the regions that sound there -- a lookup is a dict hit, a list index and a bisect.
+	#Each preset's regions are resolved once (layering rules of SF2 2.04 section 9.4) and cached alongside.
+	#Presets are indexed on first lookup (or all at once by build()) and dropped again when
+	#they, or an instrument they use, report an edit
+	chunk = None
+	presetmap = None
+	presettables = None
+	presetregions = None
+	instrumentusers = None
+	
+	def __init__(self, thechunk):
+		self.chunk = thechunk
+		self.presetmap = None
+		self.presettables = {}
+		self.presetregions = {}
+		self.instrumentusers = {}
+		thechunk.editlisteners.append(self.recordedited)
+	
+	def recordedited(self, record):
+		if (isinstance(record, SF2Preset)):
+			self.forgetpreset(record)
+			self.presetmap = None #bank/program may have changed
+		elif (isinstance(record, SF2Instrument)):
+			for thepreset in self.instrumentusers.pop(record, ()):
+				self.forgetpreset(thepreset)
+	
+	def forgetpreset(self, thepreset):
+		self.presettables.pop(thepreset, None)
+		self.presetregions.pop(thepreset, None)
+	
+	def invalidate(self):
+		#forget everything, e.g. after adding or removing presets/instruments
+		self.presetmap = None
+		self.presettables = {}
+		self.presetregions = {}
+		self.instrumentusers = {}
+	
+	def regions(self, thepreset):
+		regions = self.presetregions.get(thepreset)
+		if (regions is None):
+			regions = self.resolvepreset(thepreset)
+			self.presetregions[thepreset] = regions
+		return regions
+	
+	def build(self):
+		for thepreset in self.chunk.presets:
+			if (thepreset not in self.presettables): self.presettables[thepreset] = self.buildpreset(thepreset)
+	
+	def lookup(self, bank, program, key, velocity):
+		if (self.presetmap is None):
+			self.presetmap = dict(((x.bank, x.number), x) for x in reversed(self.chunk.presets)) #first preset wins on duplicates
+		thepreset = self.presetmap.get((bank, program))
+		if (thepreset is None): return ()
+		table = self.presettables.get(thepreset)
+		if (table is None):
+			table = self.buildpreset(thepreset)
+			self.presettables[thepreset] = table
+		splits, segments = table[key]
+		return segments[bisect_right(splits, velocity) - 1]
+	
+	def resolvepreset(self, thepreset):
+		regions = []
+		zones = thepreset.zones
+		presetglobal = None
+		if (len(zones) > 0 and findgenerator(zones[0], 41) is None): presetglobal = zones[0]
+		presetkeys = zonerange(presetglobal, 43, (0, 127))
+		presetvels = zonerange(presetglobal, 44, (0, 127))
+		presetdefaults = zonevalues(presetglobal, {})
+		for thepresetzone in zones:
+			instrumentgenerator = findgenerator(thepresetzone, 41)
+			if (instrumentgenerator is None or instrumentgenerator._amount >= len(self.chunk.instruments)): continue
+			theinstrument = self.chunk.instruments[instrumentgenerator._amount]
+			self.instrumentusers.setdefault(theinstrument, set()).add(thepreset)
+			keys = zonerange(thepresetzone, 43, presetkeys)
+			vels = zonerange(thepresetzone, 44, presetvels)
+			presetvalues = [(operator, amount) for operator, amount in zonevalues(thepresetzone, dict(presetdefaults)).items() if operator in presetAdditiveGenerators]
+			
+			instrumentglobal = None
+			if (len(theinstrument.zones) > 0 and findgenerator(theinstrument.zones[0], 53) is None): instrumentglobal = theinstrument.zones[0]
+			instrumentkeys = zonerange(instrumentglobal, 43, (0, 127))
+			instrumentvels = zonerange(instrumentglobal, 44, (0, 127))
+			instrumentdefaults = zonevalues(instrumentglobal, list(generatorDefaults))
+			for theinstrumentzone in theinstrument.zones:
+				samplegenerator = findgenerator(theinstrumentzone, 53)
+				if (samplegenerator is None or samplegenerator._amount >= len(self.chunk.samples)): continue
+				zonekeys = zonerange(theinstrumentzone, 43, instrumentkeys)
+				zonevels = zonerange(theinstrumentzone, 44, instrumentvels)
+				keyrange = (max(keys[0], zonekeys[0]), min(keys[1], zonekeys[1]))
+				velrange = (max(vels[0], zonevels[0]), min(vels[1], zonevels[1]))
+				if (keyrange[0] > keyrange[1] or velrange[0] > velrange[1]): continue
+				
+				generators = array.array('i', zonevalues(theinstrumentzone, list(instrumentdefaults)))
+				for operator, amount in presetvalues: generators[operator] += amount
+				generators[41] = instrumentgenerator._amount
+				generators[43] = keyrange[0] | (keyrange[1] << 8)
+				generators[44] = velrange[0] | (velrange[1] << 8)
+				regions.append(SF2Region(thepreset, thepresetzone, theinstrument, theinstrumentzone, self.chunk.samples[samplegenerator._amount], keyrange, velrange, generators))
+		return regions
+	
+	def buildpreset(self, thepreset):
+		regions = self.regions(thepreset)
+		table = []
+		shared = {} #keys hit by the same regions share one velocity split
+		for key in range(128):
+			candidates = tuple(x for x in regions if x.keylo <= key <= x.keyhi)
+			entry = shared.get(candidates)
+			if (entry is None):
+				splits = sorted(set([0] + [x.vello for x in candidates] + [x.velhi + 1 for x in candidates if x.velhi < 127]))
+				segments = [tuple(x for x in candidates if x.vello <= velocity <= x.velhi) for velocity in splits]
+				entry = (splits, segments)
+				shared[candidates] = entry
+			table.append(entry)
+		return table
+
+#offline rendering of note lists -- needs numpy
+
+def timecentseconds(timecents):
+	return 2.0 ** (timecents / 1200.0)
+
+class SF2Voice(object):
+	#one region sounding for one note: where it plays from, how fast, how loud and for how long
+	__slots__ = ('sample', 'startframe', 'frames', 'releaseframe', 'position', 'step', 'start', 'end', 'startloop', 'endloop',
+		'loopmode', 'gain', 'leftgain', 'rightgain', 'delay', 'attack', 'hold', 'decay', 'sustain', 'release')
+	
+	def __init__(self, region, key, velocity, startframe, noteframes, samplerate):
+		g = region.generators
+		thesample = region.sample
+		if (g[46] >= 0): key = g[46] #keynum
+		if (g[47] >= 0): velocity = g[47] #velocity
+		self.sample = thesample
+		self.startframe = startframe
+		#sample addresses relative to the sample's own data, with the fine and coarse (32768 frame) offsets applied
+		length = thesample.end - thesample.start
+		self.start = min(max(g[0] + (g[4] * 32768), 0), length)
+		self.end = min(max(length + g[1] + (g[12] * 32768), self.start), length)
+		self.startloop = min(max(thesample.startloop - thesample.start + g[2] + (g[45] * 32768), self.start), self.end)
+		self.endloop = min(max(thesample.endloop - thesample.start + g[3] + (g[50] * 32768), self.startloop), self.end)
+		self.loopmode = g[54] & 3
+		if (self.endloop - self.startloop < 2): self.loopmode = 0
+		self.position = float(self.start)
+		
+		rootkey = g[58] if (g[58] >= 0) else thesample.rootnote
+		cents = ((key - rootkey) * g[56]) + (g[51] * 100) + g[52] + thesample.finetune
+		self.step = (2.0 ** (cents / 1200.0)) * thesample.samplerate / samplerate
+		
+		#initial attenuation plus the standard velocity-to-attenuation curve, then constant power panning
+		attenuation = max(g[48], 0) + (-400.0 * numpy.log10(max(velocity, 1) / 127.0))
+		self.gain = 10.0 ** (-attenuation / 200.0)
+		pan = (min(max(g[17], -500), 500) + 500) / 1000.0
+		self.leftgain = numpy.cos(pan * numpy.pi / 2)
+		self.rightgain = numpy.sin(pan * numpy.pi / 2)
+		
+		#volume envelope, in frames; sustain is a linear level
+		self.delay = timecentseconds(g[33]) * samplerate
+		self.attack = timecentseconds(g[34]) * samplerate
+		self.hold = timecentseconds(g[35] + ((60 - key) * g[39])) * samplerate
+		self.decay = timecentseconds(g[36] + ((60 - key) * g[40])) * samplerate
+		self.sustain = 10.0 ** (-min(max(g[37], 0), 1440) / 200.0)
+		self.release = timecentseconds(g[38]) * samplerate
+		self.releaseframe = int(noteframes)
+		self.frames = int(noteframes + self.release) + 1
+		if (self.loopmode == 0): #a one shot ends with its data
+			self.frames = min(self.frames, int((self.end - self.start) / self.step) + 1)
+	
+	def envelope(self, offsets):
+		#level at each frame offset since the note started; decay and release fall linearly in dB
+		offsets = offsets.astype(numpy.float64)
+		level = numpy.ones(len(offsets))
+		delayed = offsets - self.delay
+		level[delayed < 0] = 0.0
+		attacking = (delayed >= 0) & (delayed < self.attack)
+		level[attacking] = delayed[attacking] / self.attack
+		decaytime = delayed - self.attack - self.hold
+		decaying = decaytime >= 0
+		#-100 dB over the full decay time, held at the sustain level
+		decaylevel = numpy.maximum(10.0 ** (-5.0 * decaytime[decaying] / self.decay), self.sustain)
+		level[decaying] = decaylevel
+		releasing = offsets >= self.releaseframe
+		if (numpy.any(releasing)):
+			releaselevel = self.envelope(numpy.array([self.releaseframe - 1]))[0] if (self.releaseframe > 0) else 0.0
+			level[releasing] = releaselevel * (10.0 ** (-5.0 * (offsets[releasing] - self.releaseframe) / self.release))
+		return level
+	
+	def positions(self, offsets):
+		#read position in the sample data for each frame offset, looping while the loop mode asks for it
+		positions = self.start + (offsets * self.step)
+		if (self.loopmode in (1, 3)):
+			looplength = self.endloop - self.startloop
+			if (self.loopmode == 3):
+				#loop only while the key is held, then play on from wherever the loop was
+				held = offsets < self.releaseframe
+				releaseposition = self.start + (self.releaseframe * self.step)
+				if (releaseposition >= self.endloop): releaseposition = self.startloop + ((releaseposition - self.startloop) % looplength)
+				positions = numpy.where(held, positions, releaseposition + ((offsets - self.releaseframe) * self.step))
+				looping = held & (positions >= self.endloop)
+			else: looping = positions >= self.endloop
+			positions[looping] = self.startloop + ((positions[looping] - self.startloop) % looplength)
+		return positions
+
+class SF2Renderer(object):
+	#renders (time, bank, program, key, velocity, duration) events -- times in seconds -- to a float32 stereo
+	#buffer of shape (frames, 2). Each voice is computed a block of frames at a time with numpy: sample
+	#positions, linear interpolation, looping and the volume envelope are whole-array operations.
+	#Covers sample playback, tuning, loops, attenuation, panning and the volume envelope; no filters,
+	#LFOs, modulation envelope or modulators
+	archive = None
+	samplerate = None
+	blockframes = None
+	sampledata = None
+	
+	def __init__(self, archive, samplerate=44100, blockframes=65536):
+		if (numpy is None): raise RuntimeError("rendering needs numpy, which is not installed")
+		self.archive = archive
+		self.samplerate = samplerate
+		self.blockframes = blockframes
+		self.sampledata = {} #SF2Sample -> float32 data, converted once per sample
+	
+	def samplearray(self, thesample):
+		data = self.sampledata.get(thesample)
+		if (data is None):
+			pcm = numpy.frombuffer(thesample.sampledata, dtype='<i2')
+			data = numpy.zeros(len(pcm) + 1, dtype=numpy.float32) #one guard frame for the interpolation
+			data[:len(pcm)] = pcm * (1.0 / 32768.0)
+			self.sampledata[thesample] = data
+		return data
+	
+	def voices(self, events):
+		voices = []
+		for time, bank, program, key, velocity, duration in events:
+			startframe = int(round(time * self.samplerate))
+			noteframes = int(round(duration * self.samplerate))
+			for region in self.archive.findregions(bank, program, key, velocity):
+				voices.append(SF2Voice(region, key, velocity, startframe, noteframes, self.samplerate))
+		return voices
+	
+	def render(self, events):
+		voices = self.voices(events)
+		totalframes = max([x.startframe + x.frames for x in voices] + [0])
+		output = numpy.zeros((totalframes, 2), dtype=numpy.float32)
+		for voice in voices:
+			data = self.samplearray(voice.sample)
+			lastframe = len(data) - 2
+			for blockstart in range(0, voice.frames, self.blockframes):
+				offsets = numpy.arange(blockstart, min(blockstart + self.blockframes, voice.frames), dtype=numpy.float64)
+				positions = voice.positions(offsets)
+				playing = positions < min(voice.end, lastframe + 1)
+				if (not numpy.any(playing)): break
+				offsets = offsets[playing]
+				positions = positions[playing]
+				indexes = positions.astype(numpy.int64)
+				fractions = (positions - indexes).astype(numpy.float32)
+				block = data[indexes] + ((data[indexes + 1] - data[indexes]) * fractions)
+				block *= (voice.envelope(offsets) * voice.gain).astype(numpy.float32)
+				frames = voice.startframe + offsets.astype(numpy.int64)
+				output[frames, 0] += block * voice.leftgain
+				output[frames, 1] += block * voice.rightgain
+		return output
+
+#batch sample transforms: each one takes a float32 array of shape (channels, frames) -- a stereo pair is
+#processed as one two-channel array so both sides stay aligned -- plus the loop points/rate header, and
+#returns both updated. Loop points are frame offsets from the start of the sample
+
+def normalizepcm(data, header, peak):
+	#scale so the loudest point (of either channel) sits at peak, 1.0 being full scale
+	loudest = float(numpy.abs(data).max()) if (data.size) else 0.0
+	if (loudest > 0): data = data * (peak * 32767.0 / loudest)
+	return data, header
+
+def trimpcm(data, header, threshold):
+	#cut leading frames quieter than threshold (fraction of full scale), but never into the loop
+	loud = numpy.flatnonzero(numpy.any(numpy.abs(data) > threshold * 32768.0, axis=0))
+	cut = min(int(loud[0]) if (loud.size) else data.shape[1], header['startloop'])
+	if (cut <= 0): return data, header
+	header = dict(header, startloop=header['startloop'] - cut, endloop=header['endloop'] - cut)
+	return data[:, cut:], header
+
+def resamplepcm(data, header, samplerate):
+	#linear interpolation to samplerate; loop points move with the audio
+	if (samplerate == header['samplerate'] or data.shape[1] == 0): return data, header
+	ratio = samplerate / header['samplerate']
+	frames = max(int(round(data.shape[1] * ratio)), 1)
+	positions = numpy.arange(frames, dtype=numpy.float64) / ratio
+	original = numpy.arange(data.shape[1], dtype=numpy.float64)
+	data = numpy.stack([numpy.interp(positions, original, channel) for channel in data]).astype(numpy.float32)
+	header = dict(header, samplerate=samplerate, startloop=min(int(round(header['startloop'] * ratio)), frames),
+		endloop=min(int(round(header['endloop'] * ratio)), frames))
+	return data, header
+
+def crossfadepcm(data, header, frames):
+	#fade the last frames before endloop into the frames leading up to startloop, so the jump back is seamless
+	startloop, endloop = header['startloop'], header['endloop']
+	frames = min(frames, startloop, endloop - startloop)
+	if (frames <= 0): return data, header
+	fade = numpy.arange(1, frames + 1, dtype=numpy.float32) / frames
+	data = data.copy()
+	data[:, endloop-frames:endloop] = (data[:, endloop-frames:endloop] * (1 - fade)) + (data[:, startloop-frames:startloop] * fade)
+	return data, header
+
+pcmTransforms = {'normalize': normalizepcm, 'trim': trimpcm, 'resample': resamplepcm, 'crossfadeloop': crossfadepcm}
+
+def transformpcm(job):
+	#one job of SF2SampleTransforms.apply(), in whatever process runs it: (steps, [pcm bytes per channel], header)
+	steps, channels, header = job
+	data = numpy.stack([numpy.frombuffer(x, dtype='<i2') for x in channels]).astype(numpy.float32)
+	for name, value in steps: data, header = pcmTransforms[name](data, header, value)
+	data = numpy.clip(numpy.rint(data), -32768, 32767).astype('<i2')
+	return [x.tobytes() for x in data], header
+
+class SF2SampleTransforms(object):
+	#a chain of whole-array sample transforms, e.g.
+	#  SF2SampleTransforms().trim(0.001).resample(44100).normalize(0.9).crossfadeloop(256).apply(archive.presetdatachunk.samples)
+	#apply() imports the results into the samples and keeps end/startloop/endloop/samplerate in step, so
+	#writeSF2()/save() write them out like any other edit
+	steps = None
+
+	def __init__(self):
+		if (numpy is None): raise RuntimeError("sample transforms need numpy, which is not installed")
+		self.steps = []
+
+	def normalize(self, peak=1.0):
+		self.steps.append(('normalize', peak))
+		return self
+
+	def trim(self, threshold=0.001):
+		self.steps.append(('trim', threshold))
+		return self
+
+	def resample(self, samplerate):
+		self.steps.append(('resample', samplerate))
+		return self
+
+	def crossfadeloop(self, frames=256):
+		self.steps.append(('crossfadeloop', frames))
+		return self
+
+	def apply(self, samples, processes=None):
+		#run the chain over samples (ROM samples are skipped); processes=n spreads the work over a pool of n
+		#worker processes, None does it all here. Returns {'samples': n, 'framesbefore': n, 'framesafter': n}
+		samples = [x for x in samples if not (x.sampletype & 0x8000)]
+		selected = set(samples)
+		groups = []
+		grouped = set()
+		for x in samples:
+			if (x in grouped): continue
+			group = [x]
+			partner = x.sf2arch.presetdatachunk.samples[x.link] if (x.sampletype in (2, 4) and x.link < len(x.sf2arch.presetdatachunk.samples)) else None
+			if (partner is not None and partner in selected and partner not in grouped and partner.sampletype == 6 - x.sampletype
+					and partner.end - partner.start == x.end - x.start and partner.samplerate == x.samplerate
+					and partner.startloop - partner.start == x.startloop - x.start and partner.endloop - partner.start == x.endloop - x.start):
+				group.append(partner) #a stereo pair with matching geometry is transformed as one
+			grouped.update(group)
+			groups.append(group)
+		jobs = [(self.steps, [bytes(x.sampledata) for x in group], {'startloop': group[0].startloop - group[0].start,
+			'endloop': group[0].endloop - group[0].start, 'samplerate': group[0].samplerate}) for group in groups]
+		if (processes is None): results = map(transformpcm, jobs)
+		else:
+			pool = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+			results = pool.map(transformpcm, jobs, chunksize=max(1, len(jobs) // (processes * 4)))
+		report = {'samples': len(samples), 'framesbefore': 0, 'framesafter': 0}
+		try:
+			for group, (channels, header) in zip(groups, results):
+				for thesample, data in zip(group, channels):
+					report['framesbefore'] += thesample.end - thesample.start
+					report['framesafter'] += len(data) // 2
+					thesample.importsampledata(data)
+					thesample.end = thesample.start + (len(data) // 2)
+					thesample.startloop = thesample.start + header['startloop']
+					thesample.endloop = thesample.start + header['endloop']
+					thesample.samplerate = header['samplerate']
+		finally:
+			if (processes is not None): pool.shutdown()
+		return report
+
+#building new archives out of records taken from other ones
+
+def infostring(text):
+	#INFO strings are stored zero terminated and padded to an even length
+	text = text + '\x00'
+	if (len(text.encode()) % 2): text = text + '\x00'
+	return text
+
+class SF2ArchiveBuilder(object):
+	#assembles a new SF2Archive from presets of other archives. A preset brings along what it needs -- its
+	#instruments, their samples and the stereo partners of those -- every source record is copied once however
+	#often it is referenced, with uniquenames=True repeated names are renumbered through SF2NameRegistry (SF2 allows
+	#duplicates, uniquenames=False keeps every name as it is) and bank/program clashes are resolved
+	#by bankclash: "renumber" moves the preset to the next free program (then bank), "skip" leaves it out.
+	#Sample bodies are not read: the copied headers still point into their source files, so
+	#writeSF2(streaming=True) on the built archive copies each sample straight across
+	archive = None
+	bankclash = None
+	programs = None
+	copies = None
+	samplepartners = None
+	presetnames = None
+	instrumentnames = None
+	samplenames = None
+	uniquenames = True
+	
+	def __init__(self, name="Merged", bankclash="renumber", uniquenames=True):
+		if (bankclash not in ("renumber", "skip")): raise RuntimeError("unknown bankclash mode: " + str(bankclash))
+		self.bankclash = bankclash
+		self.uniquenames = uniquenames
+		self.archive = SF2Archive()
+		self.archive.infochunk = SF2InfoChunk()
+		self.archive.infochunk.version = '2.1'
+		self.archive.infochunk.soundengine = infostring('EMU8000')
+		self.archive.infochunk.name = infostring(name)
+		self.archive.infochunk.tool = infostring('sf2tools')
+		self.archive.presetdatachunk = SF2PresetDataChunk(self.archive)
+		self.programs = set()
+		self.copies = {} #source record -> its copy
+		self.samplepartners = []
+		self.presetnames = SF2NameRegistry()
+		self.instrumentnames = SF2NameRegistry()
+		self.samplenames = SF2NameRegistry()
+	
+	def copyname(self, registry, name):
+		#the name a copied record gets: name itself, or with uniquenames=True an unused variant of it
+		if (not self.uniquenames): return name
+		name = registry.unusedname(name) if (name in registry) else name.strip()
+		registry.add(name)
+		return name.ljust(20)
+	
+	def freeprogram(self, bank, number):
+		#(bank, number) itself, or the next pair nobody uses yet
+		for x in range((bank * 128) + number, 129 * 128):
+			if ((x // 128, x % 128) not in self.programs): return (x // 128, x % 128)
+		raise RuntimeError("no free bank/program left for preset!")
+	
+	def addpreset(self, thepreset, bank=None, number=None):
+		#copy of thepreset (optionally moved to bank/number), or None when bankclash="skip" drops it
+		if (thepreset in self.copies): return self.copies[thepreset]
+		if (bank is None): bank = thepreset.bank
+		if (number is None): number = thepreset.number
+		if ((bank, number) in self.programs):
+			if (self.bankclash == "skip"): return None
+			bank, number = self.freeprogram(bank, number)
+		self.programs.add((bank, number))
+		thechunk = thepreset.owner
+		newpreset = SF2Preset()
+		newpreset.name = self.copyname(self.presetnames, thepreset.name)
+		newpreset.rawname = thepreset.rawname #only used while the name is unchanged
+		newpreset.bank = bank
+		newpreset.number = number
+		newpreset.library = thepreset.library
+		newpreset.genre = thepreset.genre
+		newpreset.morph = thepreset.morph
+		for thezone in thepreset.zones:
+			newzone = SF2PresetZone()
+			for thegenerator in thezone.generators:
+				amount = thegenerator.amountunsigned
+				if (thegenerator.operator == 41): #instrument
+					if (amount >= len(thechunk.instruments)): raise RuntimeError("preset " + thepreset.name.strip() + " refers to a missing instrument!")
+					amount = self.addinstrument(thechunk.instruments[amount]).identifier
+				newzone.generators.append(SF2PresetZoneGenerator(thegenerator.operator, amount))
+			newzone.modulators = [self.copymodulator(x, SF2PresetZoneModulator()) for x in thezone.modulators]
+			newpreset.zones.append(newzone)
+		newpreset.identifier = len(self.archive.presetdatachunk.presets)
+		self.archive.presetdatachunk.presets.append(newpreset)
+		self.copies[thepreset] = newpreset
+		return newpreset
+	
+	def addinstrument(self, theinstrument):
+		if (theinstrument in self.copies): return self.copies[theinstrument]
+		thechunk = theinstrument.owner
+		newinstrument = SF2Instrument()
+		newinstrument.name = self.copyname(self.instrumentnames, theinstrument.name)
+		newinstrument.rawname = theinstrument.rawname #only used while the name is unchanged
+		newinstrument.identifier = len(self.archive.presetdatachunk.instruments)
+		self.archive.presetdatachunk.instruments.append(newinstrument)
+		self.copies[theinstrument] = newinstrument
+		for thezone in theinstrument.zones:
+			newzone = SF2InstrumentZone()
+			for thegenerator in thezone.generators:
+				amount = thegenerator.amountunsigned
+				if (thegenerator.operator == 53): #sampleID
+					if (amount >= len(thechunk.samples)): raise RuntimeError("instrument " + theinstrument.name.strip() + " refers to a missing sample!")
+					amount = self.addsample(thechunk.samples[amount], thechunk).identifier
+				newzone.generators.append(SF2InstrumentZoneGenerator(thegenerator.operator, amount))
+			newzone.modulators = [self.copymodulator(x, SF2InstrumentZoneModulator()) for x in thezone.modulators]
+			newinstrument.zones.append(newzone)
+		return newinstrument
+	
+	def addsample(self, thesample, thechunk):
+		#thechunk is the SF2PresetDataChunk thesample is listed in, which its stereo link indexes into
+		if (thesample in self.copies): return self.copies[thesample]
+		newsample = SF2Sample(thesample.sf2arch)
+		newsample.name = self.copyname(self.samplenames, thesample.name)
+		newsample.rawname = thesample.rawname #only used while the name is unchanged
+		for field in ('start', 'end', 'startloop', 'endloop', 'samplerate', 'rootnote', 'finetune', 'sampletype'):
+			setattr(newsample, field, getattr(thesample, field))
+		newsample.link = 0
+		if (thesample.sampledataimported or thesample.sf2arch.pathname is None): newsample.importsampledata(thesample.sampledata)
+		newsample.identifier = len(self.archive.presetdatachunk.samples)
+		self.archive.presetdatachunk.samples.append(newsample)
+		self.copies[thesample] = newsample
+		if ((thesample.sampletype & 0x0E) and thesample.link < len(thechunk.samples)): #right/left/linked: bring the partner along
+			self.samplepartners.append((newsample, self.addsample(thechunk.samples[thesample.link], thechunk)))
+		return newsample
+	
+	def copymodulator(self, themodulator, newmodulator):
+		for field in ('srcOper', 'destOper', 'amount', 'amtSrcOper', 'transOper'):
+			setattr(newmodulator, field, getattr(themodulator, field))
+		return newmodulator
+	
+	def build(self):
+		#link the stereo pairs up and lay out every index; the archive is ready for writeSF2()
+		for newsample, newpartner in self.samplepartners: newsample.link = newpartner.identifier
+		self.archive.presetdatachunk.reindex()
+		return self.archive
+
+def mergeSF2(archives, name="Merged", bankclash="renumber"):
+	#one SF2Archive holding every preset of archives (in order) and what they use; see SF2ArchiveBuilder
+	builder = SF2ArchiveBuilder(name, bankclash)
+	for thearchive in archives:
+		for thepreset in thearchive.presetdatachunk.presets: builder.addpreset(thepreset)
+	return builder.build()
+
+def mergeSF2Files(pathnames, outputpath, name="Merged", bankclash="renumber"):
+	#merge fonts on disk without loading their samples: headers are parsed, sample data streamed to outputpath
+	archives = []
+	for pathname in pathnames:
+		thearchive = SF2Archive()
+		thearchive.open(pathname, load_samples="lazy")
+		archives.append(thearchive)
+	merged = mergeSF2(archives, name, bankclash)
+	merged.writeSF2(outputpath, streaming=True)
+	return merged
+
+def extractPresets(archive, selection, outputpath=None):
+	#a new SF2Archive with just the selected presets of archive and what they depend on (instruments, samples,
+	#stereo partners), every index renumbered; selection holds SF2Preset objects, (bank, program) pairs or preset
+	#names. Names are copied unchanged, duplicates included. With outputpath the subset is also written there,
+	#streaming only the sample ranges it references
+	presetsbyprogram = {}
+	presetsbyname = {}
+	for thepreset in archive.presetdatachunk.presets:
+		presetsbyprogram.setdefault((thepreset.bank, thepreset.number), thepreset)
+		presetsbyname.setdefault(thepreset.name.strip(), thepreset)
+	builder = SF2ArchiveBuilder(uniquenames=False)
+	for item in selection:
+		if (isinstance(item, SF2Preset)): thepreset = item
+		elif (isinstance(item, str)): thepreset = presetsbyname.get(item.strip())
+		else: thepreset = presetsbyprogram.get(tuple(item))
+		if (thepreset is None): raise RuntimeError("no such preset: " + str(item))
+		builder.addpreset(thepreset)
+	subset = builder.build()
+	for tag, attribute in infoSubchunkFields: setattr(subset.infochunk, attribute, getattr(archive.infochunk, attribute))
+	if (outputpath is not None): subset.writeSF2(outputpath, streaming=True)
+	return subset
+
+#integrity checks over the raw file, before anything trusts it
+
+class SF2Diagnostics(object):
+	#collects checkSF2() findings: one entry per failed check with the offending record indexes (the first
+	#limit of them) and how many there were in all
+	limit = None
+	entries = None
+
+	def __init__(self, limit=100):
+		self.limit = limit
+		self.entries = []
+
+	def add(self, severity, check, table, message, indexes=None):
+		#indexes: a numpy index array, list or None for a file-level problem; nothing is added for an empty array
+		if (indexes is not None and len(indexes) == 0): return
+		entry = {'severity': severity, 'check': check, 'table': table, 'message': message}
+		if (indexes is not None):
+			entry['count'] = len(indexes)
+			entry['indexes'] = [int(x) for x in indexes[:self.limit]]
+		self.entries.append(entry)
+
+	def report(self):
+		return {'errors': sum(1 for x in self.entries if x['severity'] == 'error'),
+			'warnings': sum(1 for x in self.entries if x['severity'] == 'warning'), 'diagnostics': self.entries}
+
+def checkSF2(sf2file_name, limit=100):
+	#validate a font without building its object model: the RIFF layout and chunk sizes, then one pass of
+	#whole-column numpy checks over the decoded pdta tables -- terminator records, bag/generator/modulator index
+	#runs, instrument and sample references, sample bounds and loop points against the smpl chunk and stereo links.
+	#Returns {'errors': n, 'warnings': n, 'diagnostics': [{'severity', 'check', 'table', 'message'[, 'count', 'indexes']}]}
+	if (numpy is None): raise RuntimeError("checkSF2 needs numpy, which is not installed")
+	diagnostics = SF2Diagnostics(limit)
+	with open(sf2file_name, 'rb') as sf2file:
+		filesize = os.fstat(sf2file.fileno()).st_size
+		header = sf2file.read(12)
+		if (len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'sfbk'):
+			diagnostics.add('error', 'riff', None, 'not a RIFF sfbk file')
+			return diagnostics.report()
+		riffsize = struct.unpack_from('<I', header, 4)[0]
+		if (riffsize + 8 != filesize):
+			diagnostics.add('warning' if (riffsize + 8 < filesize) else 'error', 'riff', None,
+				'RIFF size %d does not match the file size %d' % (riffsize + 8, filesize))
+		lists = OrderedDict()
+		pos = 12
+		while (pos + 12 <= filesize):
+			sf2file.seek(pos)
+			chunkheader = sf2file.read(12)
+			chunksize = struct.unpack_from('<I', chunkheader, 4)[0]
+			if (chunkheader[0:4] != b'LIST'):
+				diagnostics.add('error', 'chunks', None, 'expected a LIST chunk at offset %d' % pos)
+				break
+			if (pos + 8 + chunksize > filesize):
+				diagnostics.add('error', 'chunks', chunkheader[8:12].decode('latin-1'), 'LIST at offset %d runs past the end of the file' % pos)
+				chunksize = filesize - pos - 8
+			lists[chunkheader[8:12]] = (pos + 12, chunksize - 4)
+			pos += 8 + chunksize + (chunksize & 1)
+		for tag in (b'INFO', b'sdta', b'pdta'):
+			if (tag not in lists): diagnostics.add('error', 'chunks', tag.decode(), 'missing %s LIST' % tag.decode())
+		if (list(lists)[:3] != [b'INFO', b'sdta', b'pdta'] and len(lists) >= 3):
+			diagnostics.add('warning', 'chunks', None, 'LISTs are not in INFO, sdta, pdta order')
+		if (b'sdta' not in lists or b'pdta' not in lists): return diagnostics.report()
+
+		sampledatalength = 0
+		sdtaoffset, sdtasize = lists[b'sdta']
+		if (sdtasize >= 8):
+			sf2file.seek(sdtaoffset)
+			smplheader = sf2file.read(8)
+			if (smplheader[0:4] != b'smpl'): diagnostics.add('error', 'chunks', 'sdta', 'sdta does not start with a smpl chunk')
+			else:
+				sampledatalength = struct.unpack_from('<I', smplheader, 4)[0]
+				if (sampledatalength > sdtasize - 8):
+					diagnostics.add('error', 'chunks', 'smpl', 'smpl chunk of %d bytes does not fit its sdta LIST' % sampledatalength)
+					sampledatalength = max(sdtasize - 8, 0)
+
+		pdtaoffset, pdtasize = lists[b'pdta']
+		sf2file.seek(pdtaoffset)
+		pdtadata = sf2file.read(pdtasize)
+
+	tables = {}
+	pos = 0
+	while (pos + 8 <= len(pdtadata)):
+		tag = bytes(pdtadata[pos:pos+4])
+		size = struct.unpack_from('<I', pdtadata, pos + 4)[0]
+		if (pos + 8 + size > len(pdtadata)):
+			diagnostics.add('error', 'chunks', tag.decode('latin-1'), 'sub-chunk runs past the end of pdta')
+			size = len(pdtadata) - pos - 8
+		if (tag not in pdtaRecordLayouts): diagnostics.add('warning', 'chunks', tag.decode('latin-1'), 'unknown pdta sub-chunk')
+		elif (tag in tables): diagnostics.add('error', 'chunks', tag.decode(), 'sub-chunk appears more than once')
+		else:
+			if (size % pdtaRecordStructs[tag].size):
+				diagnostics.add('error', 'chunks', tag.decode(), 'size %d is not a multiple of the %d byte record' % (size, pdtaRecordStructs[tag].size))
+			thistable = SF2Table(tag)
+			thistable.parse(pdtadata[pos+8:pos+8+size], usenumpy=True)
+			tables[tag] = thistable
+			if ('name' in thistable.columnnames):
+				#names that are not UTF-8 still decode (as Latin-1), but are worth a warning
+				notutf8 = []
+				for x, rawname in enumerate(thistable.rawnames):
+					try:
+						rawname.split(b'\x00', 1)[0].decode('utf-8')
+					except UnicodeDecodeError:
+						notutf8.append(x)
+				diagnostics.add('warning', 'name', tag.decode(), 'name is not valid UTF-8 (read as Latin-1)', notutf8)
+		pos += 8 + size
+	missing = [tag.decode() for tag in pdtaSubchunkOrder if tag not in tables]
+	if (missing):
+		diagnostics.add('error', 'chunks', None, 'missing pdta sub-chunks: ' + ', '.join(missing))
+		return diagnostics.report()
+	if ([tag for tag in tables] != list(pdtaSubchunkOrder)): diagnostics.add('warning', 'chunks', None, 'pdta sub-chunks are out of order')
+	for tag, minimum in ((b'phdr', 2), (b'pbag', 1), (b'pmod', 1), (b'pgen', 1), (b'inst', 2), (b'ibag', 1), (b'imod', 1), (b'igen', 1), (b'shdr', 1)):
+		if (tables[tag].count < minimum):
+			diagnostics.add('error', 'chunks', tag.decode(), 'needs at least %d records, has %d' % (minimum, tables[tag].count))
+	if (diagnostics.report()['errors']): return diagnostics.report()
+
+	#terminal records
+	for tag, name in ((b'phdr', 'EOP'), (b'inst', 'EOI'), (b'shdr', 'EOS')):
+		if (tables[tag].name[-1].rstrip() != name):
+			diagnostics.add('warning', 'terminator', tag.decode(), 'last record is %r rather than %r' % (tables[tag].name[-1], name))
+
+	#header -> bag -> generator/modulator runs: non-decreasing, starting at 0 and ending on the terminal record
+	for headers, bags, generators, modulators in ((b'phdr', b'pbag', b'pgen', b'pmod'), (b'inst', b'ibag', b'igen', b'imod')):
+		for table, column, target in ((headers, 'bagindex', bags), (bags, 'generatorIndex', generators), (bags, 'modIndex', modulators)):
+			values = getattr(tables[table], column).astype(numpy.int64)
+			diagnostics.add('error', 'index', table.decode(), '%s goes backwards' % column, numpy.flatnonzero(numpy.diff(values) < 0) + 1)
+			diagnostics.add('error', 'index', table.decode(), '%s points past the %s records' % (column, target.decode()),
+				numpy.flatnonzero(values > tables[target].count - 1))
+			if (values[-1] != tables[target].count - 1):
+				diagnostics.add('warning', 'index', table.decode(), 'terminal %s is %d, expected %d' % (column, values[-1], tables[target].count - 1))
+			if (values[0] != 0):
+				diagnostics.add('warning', 'index', table.decode(), 'first %s is %d rather than 0' % (column, values[0]))
+
+	#generator operators and references, terminal generator records excluded
+	instrumentcount = tables[b'inst'].count - 1
+	samplecount = tables[b'shdr'].count - 1
+	for tag, operator, targetcount, targetname in ((b'pgen', 41, instrumentcount, 'instrument'), (b'igen', 53, samplecount, 'sample')):
+		operators = tables[tag].operator[:-1]
+		amounts = tables[tag].amount[:-1].view(numpy.uint16)
+		diagnostics.add('warning', 'generator', tag.decode(), 'unknown generator operator', numpy.flatnonzero(operators >= len(generatorEnumerators)))
+		diagnostics.add('error', 'reference', tag.decode(), '%s generator refers to a %s that does not exist' % (generatorEnumerators[operator], targetname),
+			numpy.flatnonzero((operators == operator) & (amounts >= targetcount)))
+
+	#sample headers against the smpl chunk, ROM samples excluded
+	shdr = tables[b'shdr']
+	start, end = shdr.start[:-1].astype(numpy.int64), shdr.end[:-1].astype(numpy.int64)
+	startloop, endloop = shdr.startloop[:-1].astype(numpy.int64), shdr.endloop[:-1].astype(numpy.int64)
+	sampletype, link = shdr.sampletype[:-1].astype(numpy.int64), shdr.link[:-1].astype(numpy.int64)
+	inrom = (sampletype & 0x8000) != 0
+	inbounds = (start <= end) & (end <= sampledatalength // 2)
+	diagnostics.add('error', 'bounds', 'shdr', 'sample lies outside the sample data', numpy.flatnonzero(~inrom & ~inbounds))
+	diagnostics.add('error', 'loop', 'shdr', 'loop points lie outside the sample',
+		numpy.flatnonzero(~inrom & inbounds & ~((start <= startloop) & (startloop <= endloop) & (endloop <= end))))
+	diagnostics.add('warning', 'type', 'shdr', 'unknown sample type', numpy.flatnonzero(~numpy.isin(sampletype & 0x7FFF, (1, 2, 4, 8))))
+	diagnostics.add('warning', 'samplerate', 'shdr', 'sample rate of 0', numpy.flatnonzero(shdr.samplerate[:-1] == 0))
+
+	#stereo links: a left/right sample must point at a sample of the other side that points back
+	stereo = numpy.isin(sampletype & 0x7FFF, (2, 4))
+	linkvalid = link < samplecount
+	diagnostics.add('error', 'link', 'shdr', 'stereo sample links to a sample that does not exist', numpy.flatnonzero(stereo & ~linkvalid))
+	partner = numpy.where(linkvalid, link, 0)
+	paired = (link[partner] == numpy.arange(samplecount)) & ((sampletype[partner] & 0x7FFF) == 6 - (sampletype & 0x7FFF))
+	diagnostics.add('warning', 'link', 'shdr', 'stereo sample is not linked back by a sample of the other side', numpy.flatnonzero(stereo & linkvalid & ~paired))
+	return diagnostics.report()
+
+#batch processing over directories of SoundFonts -- the workers below run in a process pool
+
+def findSF2Files(pathnames):
+	#(root, file) pairs for every .sf2 under the given files/directories, in a stable order
+	found = []
+	for pathname in pathnames:
+		if (os.path.isdir(pathname)):
+			for dirpath, dirnames, filenames in os.walk(pathname):
+				dirnames.sort()
+				for filename in sorted(filenames):
+					if (filename.lower().endswith('.sf2')): found.append((pathname, os.path.join(dirpath, filename)))
+		else:
+			found.append((os.path.dirname(pathname), pathname))
+	return found
+
+def batchoutputpath(options, root, pathname, keepextension=True):
+	relative = os.path.relpath(pathname, root) if root else os.path.basename(pathname)
+	if (not keepextension): relative = os.path.splitext(relative)[0]
+	return os.path.join(options['output'], relative)
+
+def inspectSF2(root, pathname, options):
+	summary = SF2Archive().scan(pathname)
+	result = {'name': summary['info']['name'], 'version': summary['info']['version'], 'size': summary['size'],
+		'presets': len(summary['presets']), 'instruments': len(summary['instruments']),
+		'samples': len(summary['samples']), 'sampledatabytes': summary['sampledatalength']}
+	if (options.get('presets')):
+		result['presetlist'] = [{'name': x['name'].strip(), 'bank': x['bank'], 'program': x['program']} for x in summary['presets']]
+	return result
+
+def validateSF2(root, pathname, options):
+	if (numpy is not None):
+		report = checkSF2(pathname)
+		if (report['errors']):
+			raise RuntimeError('; '.join('%s %s' % (x['table'] or 'file', x['message']) + (' (%d records, e.g. %s)' % (x['count'], x['indexes'][:5]) if ('count' in x) else '')
+				for x in report['diagnostics'] if x['severity'] == 'error'))
+		return {'warnings': report['warnings'], 'diagnostics': report['diagnostics']}
+	#without numpy: open the font and check the sample headers one by one
+	sf2 = SF2Archive()
+	sf2.open(pathname, load_samples="lazy")
+	problems = []
+	sampledataframes = int(sf2.sampledatalength / 2)
+	for x in sf2.presetdatachunk.samples:
+		if (x.sampletype & 0x8000): continue #ROM samples don't live in this file
+		if not (x.start <= x.end <= sampledataframes):
+			problems.append('sample %d (%s) lies outside the sample data' % (x.identifier, x.name.strip()))
+		elif not (x.start <= x.startloop <= x.endloop <= x.end):
+			problems.append('sample %d (%s) has loop points outside the sample' % (x.identifier, x.name.strip()))
+	if (problems): raise RuntimeError('; '.join(problems))
+	return {'samples': len(sf2.presetdatachunk.samples)}
+
+def extractSF2Samples(root, pathname, options):
+	with SF2Archive() as sf2:
+		sf2.open(pathname, load_samples="mmap")
+		outdir = batchoutputpath(options, root, pathname, keepextension=False)
+		result = sf2.extractsamples(outdir, stereo=not options.get('mono'), workers=options.get('threads'))
+		result.update({'samples': len(sf2.presetdatachunk.samples), 'output': outdir})
+		return result
+
+def rewriteSF2(root, pathname, options):
+	with SF2Archive() as sf2:
+		sf2.open(pathname, load_samples="lazy")
+		outpath = batchoutputpath(options, root, pathname)
+		os.makedirs(os.path.dirname(outpath) or '.', exist_ok=True)
+		result = sf2.writeSF2(outpath, streaming=True, dedup=bool(options.get('dedup'))) or {}
+	result.update({'output': outpath, 'size': os.path.getsize(outpath)})
+	return result
+
+def scanSF2(root, pathname, options):
+	return {'summary': SF2Archive().scan(pathname, firsts=True)}
+
+batchCommands = {'scan': scanSF2, 'inspect': inspectSF2, 'validate': validateSF2, 'extract-samples': extractSF2Samples, 'rewrite': rewriteSF2}
+
+class SF2BatchTimeout(Exception):
+	#raised by the SIGALRM handler when a batch file runs out of time. Not a TimeoutError: that is an OSError,
+	#and the except OSError fallbacks along the way would swallow it
+	pass
+
+def batchtimeout(signum, frame):
+	raise SF2BatchTimeout('timed out')
+
+def batchworker(job):
+	command, root, pathname, options = job
+	started = time.time()
+	timeout = options.get('timeout')
+	usealarm = bool(timeout) and hasattr(signal, 'SIGALRM') #per-file timeouts need SIGALRM, so POSIX only
+	previoushandler = None
+	try:
+		if (usealarm):
+			previoushandler = signal.signal(signal.SIGALRM, batchtimeout)
+			signal.setitimer(signal.ITIMER_REAL, timeout)
+		result = batchCommands[command](root, pathname, options)
+		result['status'] = 'ok'
+	except SF2BatchTimeout:
+		result = {'status': 'timeout'}
+	except Exception as e:
+		result = {'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)}
+	finally:
+		if (usealarm):
+			signal.setitimer(signal.ITIMER_REAL, 0)
+			signal.signal(signal.SIGALRM, previoushandler)
+	result['path'] = pathname
+	result['seconds'] = round(time.time() - started, 6)
+	return result
+
+def batchprocess(command, pathnames, options=None, workers=None, progresspath=None):
+	#run one batch command over every .sf2 under pathnames; finished files are appended to progresspath
+	#as JSON lines, so an interrupted run started again with the same progress file skips them
+	options = dict(options or {})
+	started = time.time()
+	results = OrderedDict()
+	if (progresspath is not None and os.path.exists(progresspath)):
+		with open(progresspath, 'r') as progressfile:
+			for line in progressfile:
+				if (line.strip()):
+					entry = json.loads(line)
+					results[entry['path']] = entry
+	jobs = [(command, root, x, options) for root, x in findSF2Files(pathnames) if x not in results]
+	progressfile = open(progresspath, 'a') if progresspath is not None else None
+	
+	def record(result):
+		results[result['path']] = result
+		if (progressfile is not None):
+			progressfile.write(json.dumps(result) + '\n')
+			progressfile.flush()
+	
+	try:
+		if (workers == 1):
+			for job in jobs: record(batchworker(job))
+		else:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+				futures = dict((pool.submit(batchworker, job), job) for job in jobs)
+				for future in concurrent.futures.as_completed(futures):
+					try:
+						record(future.result())
+					except Exception as e: #the worker process itself died
+						record({'path': futures[future][2], 'status': 'error', 'error': '%s: %s' % (type(e).__name__, e), 'seconds': None})
+	finally:
+		if (progressfile is not None): progressfile.close()
+	
+	report = {'command': command, 'files': len(results), 'processed': len(jobs), 'resumed': len(results) - len(jobs),
+		'seconds': round(time.time() - started, 6), 'status': {}, 'results': list(results.values())}
+	for x in results.values():
+		report['status'][x['status']] = report['status'].get(x['status'], 0) + 1
+	return report
+
+catalogSchema = '''
+CREATE TABLE IF NOT EXISTS archives (id INTEGER PRIMARY KEY, pathname TEXT UNIQUE NOT NULL, size INTEGER, mtime REAL,
+	name TEXT, version TEXT, sampledatalength INTEGER, error TEXT);
+CREATE TABLE IF NOT EXISTS presets (archive INTEGER NOT NULL, idx INTEGER NOT NULL, name TEXT COLLATE NOCASE,
+	bank INTEGER, program INTEGER, instrument INTEGER, sample INTEGER);
+CREATE TABLE IF NOT EXISTS instruments (archive INTEGER NOT NULL, idx INTEGER NOT NULL, name TEXT COLLATE NOCASE, sample INTEGER);
+CREATE TABLE IF NOT EXISTS samples (archive INTEGER NOT NULL, idx INTEGER NOT NULL, name TEXT COLLATE NOCASE,
+	start INTEGER, end INTEGER, startloop INTEGER, endloop INTEGER, samplerate INTEGER, rootnote INTEGER,
+	finetune INTEGER, link INTEGER, sampletype INTEGER);
+CREATE INDEX IF NOT EXISTS presetsarchive ON presets (archive);
+CREATE INDEX IF NOT EXISTS presetsname ON presets (name);
+CREATE INDEX IF NOT EXISTS presetsbankprogram ON presets (bank, program);
+CREATE INDEX IF NOT EXISTS instrumentsarchive ON instruments (archive);
+CREATE INDEX IF NOT EXISTS instrumentsname ON instruments (name);
+CREATE INDEX IF NOT EXISTS samplesarchive ON samples (archive);
+CREATE INDEX IF NOT EXISTS samplesname ON samples (name);
+CREATE INDEX IF NOT EXISTS samplesrootnote ON samples (rootnote);
+CREATE INDEX IF NOT EXISTS samplessamplerate ON samples (samplerate);
+'''
+
+class SF2Catalog(object):
+	#a SQLite index of every font under some directories, built from SF2Archive.scan() summaries. update() only
+	#rescans files whose size or mtime changed (in worker processes, written back by this process) and drops
+	#files that are gone; the find*() queries then answer from the indexes without touching the fonts
+	pathname = None
+	connection = None
+	
+	def __init__(self, pathname):
+		self.pathname = pathname
+		self.connection = sqlite3.connect(pathname)
+		self.connection.row_factory = sqlite3.Row
+		self.connection.executescript(catalogSchema)
+	
+	def close(self):
+		if (self.connection is not None): self.connection.close()
+		self.connection = None
+	
+	def __enter__(self):
+		return self
+	
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+	
+	def update(self, pathnames, workers=None, timeout=None, prune=True):
+		#bring the catalog in line with the .sf2 files under pathnames; prune=False keeps entries for fonts under them
+		#that are no longer there (entries outside pathnames are never touched). Fonts are stored by absolute path,
+		#so the working directory doesn't matter. Returns {'files', 'scanned', 'unchanged', 'removed', 'failed': [{'path', 'error'}], 'seconds'}
+		started = time.time()
+		known = dict((x['pathname'], (x['size'], x['mtime'])) for x in self.connection.execute('SELECT pathname, size, mtime FROM archives'))
+		roots = [os.path.abspath(x) for x in pathnames]
+		found = [(os.path.abspath(root), os.path.abspath(pathname)) for root, pathname in findSF2Files(roots)]
+		jobs = []
+		for root, pathname in found:
+			try:
+				stat = os.stat(pathname)
+			except OSError:
+				continue
+			if (known.get(pathname) != (stat.st_size, stat.st_mtime)): jobs.append(('scan', root, pathname, {'timeout': timeout}))
+		report = {'files': len(found), 'scanned': 0, 'unchanged': len(found) - len(jobs), 'removed': 0, 'failed': []}
+		
+		if (prune):
+			present = set(pathname for root, pathname in found)
+			for pathname in known:
+				underroots = any(pathname == x or pathname.startswith(os.path.join(x, '')) for x in roots)
+				if (underroots and pathname not in present):
+					self.forget(pathname)
+					report['removed'] += 1
+		
+		def record(result):
+			if (result['status'] == 'ok'):
+				self.store(result['summary'])
+				report['scanned'] += 1
+			else:
+				self.storefailure(result['path'], result.get('error', result['status']))
+				report['failed'].append({'path': result['path'], 'error': result.get('error', result['status'])})
+		
+		with self.connection:
+			if (workers == 1 or len(jobs) < 2):
+				for job in jobs: record(batchworker(job))
+			else:
+				with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+					futures = dict((pool.submit(batchworker, job), job) for job in jobs)
+					for future in concurrent.futures.as_completed(futures):
+						try:
+							record(future.result())
+						except Exception as e: #the worker process itself died
+							record({'path': futures[future][2], 'status': 'error', 'error': '%s: %s' % (type(e).__name__, e)})
+		report['seconds'] = round(time.time() - started, 6)
+		return report
+	
+	def forget(self, pathname):
+		row = self.connection.execute('SELECT id FROM archives WHERE pathname = ?', (pathname,)).fetchone()
+		if (row is None): return
+		for table in ('presets', 'instruments', 'samples'):
+			self.connection.execute('DELETE FROM %s WHERE archive = ?' % table, (row['id'],))
+		self.connection.execute('DELETE FROM archives WHERE id = ?', (row['id'],))
+	
+	def store(self, summary):
+		#replace whatever the catalog held for summary['pathname'] with this scan
+		self.forget(summary['pathname'])
+		info = summary['info']
+		archive = self.connection.execute('INSERT INTO archives (pathname, size, mtime, name, version, sampledatalength) VALUES (?, ?, ?, ?, ?, ?)',
+			(summary['pathname'], summary['size'], summary['mtime'], info['name'], info['version'], summary['sampledatalength'])).lastrowid
+		self.connection.executemany('INSERT INTO presets VALUES (?, ?, ?, ?, ?, ?, ?)',
+			[(archive, n, x['name'], x['bank'], x['program'], x['instrument'], x['sample']) for n, x in enumerate(summary['presets'])])
+		self.connection.executemany('INSERT INTO instruments VALUES (?, ?, ?, ?)',
+			[(archive, n, x['name'], x['sample']) for n, x in enumerate(summary['instruments'])])
+		self.connection.executemany('INSERT INTO samples VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+			[(archive, n, x['name'], x['start'], x['end'], x['startloop'], x['endloop'], x['samplerate'], x['rootnote'],
+				x['finetune'], x['link'], x['sampletype']) for n, x in enumerate(summary['samples'])])
+	
+	def storefailure(self, pathname, error):
+		#fonts that fail to scan are remembered with their size/mtime, so they are only retried once they change
+		self.forget(pathname)
+		try:
+			stat = os.stat(pathname)
+		except OSError:
+			return
+		self.connection.execute('INSERT INTO archives (pathname, size, mtime, error) VALUES (?, ?, ?, ?)',
+			(pathname, stat.st_size, stat.st_mtime, error))
+	
+	def query(self, table, conditions, limit=None):
+		#rows of table joined with their archive's path; conditions maps column -> value, None values are ignored
+		#and name is matched with LIKE ('Piano%' is answered from the index, '%piano%' has to scan)
+		sql = 'SELECT archives.pathname AS pathname, %s.* FROM %s JOIN archives ON archives.id = %s.archive' % (table, table, table)
+		clauses = []
+		values = []
+		for column, value in conditions.items():
+			if (value is None): continue
+			clauses.append('%s.%s %s ?' % (table, column, 'LIKE' if column == 'name' else '='))
+			values.append(value)
+		if (clauses): sql += ' WHERE ' + ' AND '.join(clauses)
+		sql += ' ORDER BY archives.pathname, %s.idx' % table
+		if (limit is not None):
+			sql += ' LIMIT ?'
+			values.append(limit)
+		return [dict(x) for x in self.connection.execute(sql, values)]
+	
+	def findpresets(self, name=None, bank=None, program=None, limit=None):
+		return self.query('presets', {'name': name, 'bank': bank, 'program': program}, limit)
+	
+	def findinstruments(self, name=None, limit=None):
+		return self.query('instruments', {'name': name}, limit)
+	
+	def findsamples(self, name=None, rootnote=None, samplerate=None, limit=None):
+		return self.query('samples', {'name': name, 'rootnote': rootnote, 'samplerate': samplerate}, limit)
+	
+	def archives(self, failed=False):
+		#every catalogued font, or only the ones that failed to scan
+		sql = 'SELECT * FROM archives' + (' WHERE error IS NOT NULL' if failed else '') + ' ORDER BY pathname'
+		return [dict(x) for x in self.connection.execute(sql)]
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(prog='python -m sf2tools', description='Batch tools for SoundFont (.sf2) files')
+	subparsers = parser.add_subparsers(dest='command', required=True)
+	for command, helptext in (('scan', 'list the presets, instruments and sample headers of each font'), ('inspect', 'summarize each font'), ('validate', 'check that each font opens and its samples are in bounds'),
+			('extract-samples', 'write every sample of each font as a WAV file'), ('rewrite', 'write each font back out with writeSF2')):
+		subparser = subparsers.add_parser(command, help=helptext)
+		subparser.add_argument('paths', nargs='+', help='.sf2 files or directories to search')
+		subparser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: one per core)')
+		subparser.add_argument('--timeout', type=float, default=None, help='seconds allowed per file')
+		subparser.add_argument('--progress', default=None, help='JSON-lines progress file; rerunning with it resumes')
+		subparser.add_argument('--report', default=None, help='write the JSON report here instead of stdout')
+		if (command in ('extract-samples', 'rewrite')):
+			subparser.add_argument('-o', '--output', required=True, help='output directory (input layout is mirrored)')
+		if (command == 'extract-samples'):
+			subparser.add_argument('--mono', action='store_true', help='write stereo pairs as two mono files')
+			subparser.add_argument('--threads', type=int, default=4, help='writer threads per file (default: 4)')
+		if (command == 'rewrite'):
+			subparser.add_argument('--dedup', action='store_true', help='store byte-identical samples only once')
+		if (command == 'inspect'):
+			subparser.add_argument('--presets', action='store_true', help='include every preset name/bank/program')
+	subparser = subparsers.add_parser('catalog', help='add new and changed fonts to a SQLite catalog, dropping deleted ones')
+	subparser.add_argument('database', help='catalog file (created if missing)')
+	subparser.add_argument('paths', nargs='+', help='.sf2 files or directories to search')
+	subparser.add_argument('-j', '--workers', type=int, default=None, help='worker processes (default: one per core)')
+	subparser.add_argument('--timeout', type=float, default=None, help='seconds allowed per file')
+	subparser.add_argument('--keep', action='store_true', help='keep entries for fonts that are no longer there')
+	subparser = subparsers.add_parser('query', help='search a catalog for presets, instruments or samples')
+	subparser.add_argument('database', help='catalog file')
+	subparser.add_argument('kind', choices=('presets', 'instruments', 'samples'))
+	subparser.add_argument('--name', default=None, help="SQL LIKE pattern, e.g. 'Piano%%'")
+	subparser.add_argument('--bank', type=int, default=None)
+	subparser.add_argument('--program', type=int, default=None)
+	subparser.add_argument('--rootnote', type=int, default=None)
+	subparser.add_argument('--samplerate', type=int, default=None)
+	subparser.add_argument('--limit', type=int, default=None)
+	args = parser.parse_args(argv)
+	
+	if (args.command in ('catalog', 'query')):
+		with SF2Catalog(args.database) as catalog:
+			if (args.command == 'catalog'):
+				report = catalog.update(args.paths, args.workers, args.timeout, prune=not args.keep)
+			elif (args.kind == 'presets'):
+				report = catalog.findpresets(args.name, args.bank, args.program, args.limit)
+			elif (args.kind == 'instruments'):
+				report = catalog.findinstruments(args.name, args.limit)
+			else:
+				report = catalog.findsamples(args.name, args.rootnote, args.samplerate, args.limit)
+		json.dump(report, sys.stdout, indent=1)
+		sys.stdout.write('\n')
+		return 1 if (args.command == 'catalog' and report['failed']) else 0
+	
+	options = {'timeout': args.timeout, 'output': getattr(args, 'output', None), 'presets': getattr(args, 'presets', False),
+		'dedup': getattr(args, 'dedup', False), 'mono': getattr(args, 'mono', False), 'threads': getattr(args, 'threads', None)}
+	report = batchprocess(args.command, args.paths, options, args.workers, args.progress)
+	if (args.report is not None):
+		with open(args.report, 'w') as reportfile:
+			json.dump(report, reportfile, indent=1)
+	else:
+		json.dump(report, sys.stdout, indent=1)
+		sys.stdout.write('\n')
+	return 0 if (set(report['status']) <= {'ok'}) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,247 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import pytest
+
+import sf2bench
+import sf2tools
+
+
+@pytest.fixture
+def fontpath(tmp_path):
+	pathname = str(tmp_path / 'font.sf2')
+	sf2bench.makeSyntheticSF2(pathname, presets=4, zones=2, generators=2, samples=8, pcmbytes=64*1024)
+	return pathname
+
+
+def test_save_rewrites_resized_sample(fontpath):
+	#an imported body longer than its (start, end) slot must not be patched over the next sample
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, load_samples="lazy")
+	samples = sf2.presetdatachunk.samples
+	following = bytes(samples[1].sampledata)
+	samples[0].importsampledata(b'\x7f' * (samples[0].sampledatasize() + 400))
+	assert sf2.samplepatches() is None
+	assert sf2.save()['mode'] == 'rewrite'
+	sf2.close()
+	reopened = sf2tools.SF2Archive()
+	reopened.open(fontpath)
+	assert bytes(reopened.presetdatachunk.samples[1].sampledata) == following
+
+
+@pytest.mark.parametrize('mode', ['lazy', 'mmap'])
+def test_writesf2_refuses_to_truncate_its_source(fontpath, mode):
+	size = os.path.getsize(fontpath)
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, load_samples=mode)
+	with pytest.raises(RuntimeError):
+		sf2.writeSF2(fontpath)
+	sf2.close()
+	assert os.path.getsize(fontpath) == size
+	assert sf2tools.checkSF2(fontpath)['errors'] == 0
+
+
+def test_writesf2_over_eager_source(fontpath):
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath)
+	sf2.writeSF2(fontpath)
+	assert sf2tools.checkSF2(fontpath)['errors'] == 0
+
+
+def test_catalog_prunes_only_scanned_roots(tmp_path, monkeypatch):
+	for name in ('a', 'sub/b'):
+		os.makedirs(os.path.dirname(str(tmp_path / 'lib' / name)), exist_ok=True)
+		sf2bench.makeSyntheticSF2(str(tmp_path / 'lib' / (name + '.sf2')), presets=2, zones=1, generators=1, samples=2, pcmbytes=4096)
+	with sf2tools.SF2Catalog(str(tmp_path / 'cat.db')) as catalog:
+		assert catalog.update([str(tmp_path / 'lib')], workers=1)['scanned'] == 2
+		report = catalog.update([str(tmp_path / 'lib' / 'sub')], workers=1)
+		assert (report['removed'], report['unchanged']) == (0, 1)
+		monkeypatch.chdir(str(tmp_path / 'lib'))
+		report = catalog.update(['.'], workers=1)
+		assert (report['scanned'], report['unchanged'], report['removed']) == (0, 2, 0)
+		os.remove(str(tmp_path / 'lib' / 'sub' / 'b.sf2'))
+		assert catalog.update(['sub'], workers=1)['removed'] == 1
+		assert [x['pathname'] for x in catalog.archives()] == [str(tmp_path / 'lib' / 'a.sf2')]
+
+
+def test_batch_timeout_is_not_swallowed(fontpath, monkeypatch):
+	if (not hasattr(sf2tools.signal, 'SIGALRM')): pytest.skip('per-file timeouts need SIGALRM')
+	def slowcommand(root, pathname, options):
+		try:
+			sf2tools.time.sleep(5)
+		except OSError: #a fallback like kernelcopyfilerange()'s must not eat the timeout
+			pass
+		return {}
+	monkeypatch.setitem(sf2tools.batchCommands, 'slow', slowcommand)
+	handler = sf2tools.signal.getsignal(sf2tools.signal.SIGALRM)
+	result = sf2tools.batchworker(('slow', '', fontpath, {'timeout': 0.05}))
+	assert result['status'] == 'timeout'
+	assert sf2tools.signal.getsignal(sf2tools.signal.SIGALRM) is handler
+
+
+def latin1samplename(fontpath):
+	#give the second sample a name that is Latin-1 but not UTF-8
+	data = bytearray(open(fontpath, 'rb').read())
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath)
+	pdtaoffset = sf2.chunklayout[b'pdta'][0] + 12
+	spans = sf2tools.subchunkspans(bytes(data[pdtaoffset:pdtaoffset + sf2.chunklayout[b'pdta'][1] - 12]))
+	position = pdtaoffset + spans[b'shdr'][0] + 8 + 46 #second sample's name
+	data[position:position + 4] = b'Caf\xe9'
+	with open(fontpath, 'wb') as sf2file: sf2file.write(data)
+
+
+def test_checksf2_reports_latin1_names(fontpath):
+	latin1samplename(fontpath)
+	sf2 = sf2tools.SF2Archive()
+	report = sf2tools.checkSF2(fontpath)
+	assert report['errors'] == 0
+	assert [(x['check'], x['table'], x['indexes']) for x in report['diagnostics']] == [('name', 'shdr', [1])]
+	sf2.open(fontpath)
+	assert sf2.presetdatachunk.samples[1].name.startswith('Caf\xe9')
+
+
+@pytest.mark.parametrize('usenumpy', [False, True])
+def test_latin1_names_round_trip(fontpath, usenumpy):
+	latin1samplename(fontpath)
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, usenumpy=usenumpy)
+	chunk = sf2.presetdatachunk
+	assert chunk.serialize(sourceoffsets=True)[4:] == chunk.data
+	assert chunk.tables.serialize()[4:] == chunk.data
+	assert sf2.dirtysections() == []
+	#a renamed record is written as UTF-8
+	chunk.samples[1].name = 'Caf\xe9 2'.ljust(20)
+	assert chunk.exportsubchunk(b'shdr')[8 + 46:8 + 46 + 7] == 'Caf\xe9 2'.encode()
+
+
+def test_plain_function_tracer_on_the_class(fontpath, monkeypatch):
+	phases = []
+	def tracer(phase, seconds, bytecount, records):
+		phases.append(phase)
+	monkeypatch.setattr(sf2tools.SF2Archive, 'tracer', tracer)
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath)
+	assert 'open.pdta' in phases and 'parse.records' in phases
+	stats = sf2tools.SF2PhaseStats()
+	sf2.tracer = stats
+	sf2.writeSF2(fontpath + '.out')
+	assert 'write.pdta' in stats.export() and 'write.pdta' not in phases
+
+
+def test_extractpresets_keeps_duplicate_names(fontpath):
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, load_samples="lazy")
+	presets = sf2.presetdatachunk.presets
+	presets[1].name = presets[0].name
+	subset = sf2tools.extractPresets(sf2, [presets[1], presets[0]])
+	assert [x.name for x in subset.presetdatachunk.presets] == [presets[0].name, presets[0].name]
+	merged = sf2tools.mergeSF2([sf2, sf2])
+	names = [x.name.strip() for x in merged.presetdatachunk.presets]
+	assert len(set(names)) == len(names)
+
+
+def test_serialize_copies_only_unedited_generators(fontpath):
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, load_samples="lazy")
+	chunk = sf2.presetdatachunk
+	assert chunk.storedgenerators is not None
+	assert chunk.serialize(sourceoffsets=True)[4:] == bytes(chunk.data)
+	#a replaced generator is packed from the objects
+	chunk.instrumentzonegenerators[0] = sf2tools.SF2InstrumentZoneGenerator(chunk.instrumentzonegenerators[0].operator, 1234)
+	assert chunk.exportsubchunk(b'igen')[10:12] == (1234).to_bytes(2, 'little')
+	#and so is one edited in place
+	chunk.presetzonegenerators[1].amount = -2
+	assert chunk.storedgenerators is None
+	assert chunk.exportsubchunk(b'pgen')[14:16] == (-2 & 0xFFFF).to_bytes(2, 'little')
+
+
+def layeredzone(zoneclass, generatorclass, generators):
+	zone = zoneclass()
+	zone.generators = [generatorclass(operator, amount) for operator, amount in generators]
+	return zone
+
+
+@pytest.fixture
+def layeredfont(fontpath):
+	#preset 0 and the instrument it plays, both with a global zone in front of their local ones
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath)
+	chunk = sf2.presetdatachunk
+	thepreset = chunk.presets[0]
+	instrument = chunk.instruments[0]
+	thepreset.zones = [
+		layeredzone(sf2tools.SF2PresetZone, sf2tools.SF2PresetZoneGenerator, [(44, 0 | (99 << 8)), (48, 10), (58, 60)]),
+		layeredzone(sf2tools.SF2PresetZone, sf2tools.SF2PresetZoneGenerator, [(43, 30 | (70 << 8)), (17, 50), (41, 0)]),
+	]
+	instrument.zones = [
+		layeredzone(sf2tools.SF2InstrumentZone, sf2tools.SF2InstrumentZoneGenerator, [(43, 10 | (127 << 8)), (48, 100), (17, -200)]),
+		layeredzone(sf2tools.SF2InstrumentZone, sf2tools.SF2InstrumentZoneGenerator, [(43, 20 | (40 << 8)), (48, 150), (53, 0)]),
+		layeredzone(sf2tools.SF2InstrumentZone, sf2tools.SF2InstrumentZoneGenerator, [(43, 50 | (90 << 8)), (53, 1)]),
+		layeredzone(sf2tools.SF2InstrumentZone, sf2tools.SF2InstrumentZoneGenerator, [(43, 100 | (127 << 8)), (53, 2)]),
+		layeredzone(sf2tools.SF2InstrumentZone, sf2tools.SF2InstrumentZoneGenerator, [(53, 3)]),
+	]
+	chunk.reindex()
+	return sf2
+
+
+def test_regions_layer_global_zones_and_preset_offsets(layeredfont):
+	thepreset = layeredfont.presetdatachunk.presets[0]
+	regions = layeredfont.resolvedregions(thepreset)
+	#the zone at keys 100-127 misses the preset's 30-70 and gives no region; the last zone inherits the global 10-127
+	assert [(x.sample.identifier, x.keylo, x.keyhi, x.vello, x.velhi) for x in regions] == [(0, 30, 40, 0, 99), (1, 50, 70, 0, 99), (3, 30, 70, 0, 99)]
+	#attenuation: local instrument value (or the instrument global one) plus the preset global offset
+	assert [x.generators[48] for x in regions] == [160, 110, 110]
+	#pan: instrument global plus the preset zone offset
+	assert [x.generators[17] for x in regions] == [-150, -150, -150]
+	#overridingRootKey is not additive at preset level, so the instrument default stands
+	assert [x.generators[58] for x in regions] == [-1, -1, -1]
+	assert [x.generators[8] for x in regions] == [13500, 13500, 13500]
+	assert [x.generators[43] for x in regions] == [30 | (40 << 8), 50 | (70 << 8), 30 | (70 << 8)]
+
+
+def test_findregions_follows_edits(layeredfont):
+	chunk = layeredfont.presetdatachunk
+	thepreset = chunk.presets[0]
+	lookup = lambda key, velocity: [(x.sample.identifier, x.generators[48]) for x in layeredfont.findregions(thepreset.bank, thepreset.number, key, velocity)]
+	assert lookup(35, 64) == [(0, 160), (3, 110)]
+	assert lookup(35, 100) == []
+	chunk.instruments[0].zones[1].generators[1].amount = 200
+	assert lookup(35, 64) == [(0, 210), (3, 110)]
+	thepreset.zones[1].generators[0].amountrangeh = 45
+	assert lookup(60, 64) == []
+	assert lookup(45, 64) == [(3, 110)]
+	thepreset.zones[0].generators[1].amount = 0
+	assert lookup(35, 64) == [(0, 200), (3, 100)]
+
+
+def test_name_helpers_see_renamed_records(fontpath):
+	sf2 = sf2tools.SF2Archive()
+	sf2.open(fontpath, load_samples="lazy")
+	samples = sf2.presetdatachunk.samples
+	assert sf2.sampleNameAlreadyExists('Sample 0')
+	for x in samples[:2]: x.name = 'Renamed'.ljust(20)
+	assert not sf2.sampleNameAlreadyExists('Sample 0')
+	assert sf2.sampleNameAlreadyExists('Renamed')
+	assert sf2.unusedSampleNameFromBaseName('Renamed') == sf2.unusedSampleNameFromBaseName('Renamed') == 'Renamed1'
+	assert sf2.unusedSampleNameFromBaseName('Sample 1') == 'Sample 4'
+
+
+def test_samplepool_stats_per_archive(fontpath):
+	pool = sf2tools.SF2SamplePool(16*1024*1024)
+	archives = []
+	for x in range(3):
+		sf2 = sf2tools.SF2Archive()
+		sf2.open(fontpath, load_samples="lazy", samplepool=pool)
+		archives.append(sf2)
+	for x in archives[0].presetdatachunk.samples[:2]: bytes(x.sampledata)
+	bytes(archives[1].presetdatachunk.samples[0].sampledata)
+	occupancy = pool.stats()['archives']
+	assert len(occupancy) == 3
+	assert [occupancy[id(x)]['entries'] for x in archives] == [2, 1, 0]
+	assert [occupancy[id(x)]['pathname'] for x in archives] == [fontpath] * 3
+	assert sum(x['bytes'] for x in occupancy.values()) == pool.stats()['bytes']
+	archives[0].close()
+	assert pool.stats()['archives'][id(archives[0])]['bytes'] == 0